@@ -0,0 +1,180 @@
+import logging
+import threading
+import time
+from collections import OrderedDict, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from prometheus_client import Counter, Gauge
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+
+attachment_resolutions = Counter('attachment_resolutions', 'Attachment URL resolutions by outcome', ['result'])
+attachment_resolutions_pending = Gauge('attachment_resolutions_pending', 'Attachment URLs queued or being resolved')
+
+USER_AGENT = "FediBGS/0.0.1"
+
+# Dead media hosts fail every attachment they serve, one line each would drown everything else
+head_log = instrumentation.RateLimitedLog()
+
+
+def head_attachment(session, url, timeout=2):
+    """Follows redirects of an attachment URL. Returns the final URL, or None if it does not serve a file."""
+    start = time.monotonic()
+    try:
+        response = session.head(url, allow_redirects=True, timeout=timeout, headers={"User-Agent": USER_AGENT})
+        # check that it returns a file (200 OK)
+        if response.status_code != 200:
+            instrumentation.attachment_head_seconds.labels("rejected").observe(time.monotonic() - start)
+            head_log.warning("Attachment URL returned non-200 status code", status=response.status_code, url=url)
+            return None
+        instrumentation.attachment_head_seconds.labels("ok").observe(time.monotonic() - start)
+        return response.url
+    except Exception as e:
+        instrumentation.attachment_head_seconds.labels("error").observe(time.monotonic() - start)
+        head_log.error("Error while checking attachment URL", url=url, error=e)
+        return None
+
+
+class TTLCache:
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """Returns (hit, value)."""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False, None
+            if entry[0] < time.monotonic():
+                del self.entries[key]
+                return False, None
+            self.entries.move_to_end(key)
+            return True, entry[1]
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class AttachmentResolver:
+    """Resolves attachment redirects off the stream thread.
+
+    HEAD requests run on a thread pool sharing one keep-alive session. Each media host gets at most
+    per_host requests in flight; the rest wait in a per-host queue so a slow host never occupies the
+    whole pool. Resolved URLs are cached for ttl seconds, failures for negative_ttl seconds.
+    """
+
+    def __init__(self, max_workers=32, per_host=4, max_queued_per_host=256, timeout=2, ttl=3600, negative_ttl=300):
+        self.per_host = per_host
+        self.max_queued_per_host = max_queued_per_host
+        self.timeout = timeout
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = TTLCache()
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=256, pool_maxsize=per_host)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="resolver")
+
+        self.lock = threading.Lock()
+        self.active = defaultdict(int)
+        self.queued = defaultdict(deque)
+        self.closed = False
+
+    def resolve_post(self, post, candidates, callback):
+        """Resolves candidates [(description, url), ...] and calls callback(post, attachments) once all are done.
+
+        Never blocks; callback runs on a resolver thread, or inline if nothing needs a request.
+        """
+        results = [None] * len(candidates)
+        remaining = [len(candidates)]
+
+        def finish():
+            attachments = []
+            for (description, _), url in zip(candidates, results):
+                if url:
+                    attachments.append({"description": description, "url": url})
+            callback(post, attachments)
+
+        def done(index, url):
+            results[index] = url
+            with self.lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if last:
+                finish()
+
+        if not candidates:
+            finish()
+            return
+
+        for index, (_, url) in enumerate(candidates):
+            hit, resolved = self.cache.get(url)
+            if hit:
+                attachment_resolutions.labels("cached").inc()
+                done(index, resolved)
+            else:
+                self._enqueue(url, lambda resolved, index=index: done(index, resolved))
+
+    def _enqueue(self, url, on_done):
+        host = urlsplit(url).netloc
+        with self.lock:
+            overflow = False
+            if self.closed:
+                overflow = True
+            elif self.active[host] < self.per_host:
+                self.active[host] += 1
+                attachment_resolutions_pending.inc()
+                # Submitted under the lock so that shutdown() cannot close the executor in between
+                self.executor.submit(self._work, host, url, on_done)
+            elif len(self.queued[host]) < self.max_queued_per_host:
+                self.queued[host].append((url, on_done))
+                attachment_resolutions_pending.inc()
+            else:
+                overflow = True
+        if overflow:
+            # Host is hopelessly behind (or we are shutting down), give up on this one instead of queueing without bound
+            attachment_resolutions.labels("overflow").inc()
+            on_done(None)
+
+    def _work(self, host, url, on_done):
+        while url is not None:
+            try:
+                hit, resolved = self.cache.get(url)
+                if not hit:
+                    resolved = head_attachment(self.session, url, timeout=self.timeout)
+                    self.cache.set(url, resolved, self.ttl if resolved else self.negative_ttl)
+                    attachment_resolutions.labels("ok" if resolved else "rejected").inc()
+                on_done(resolved)
+            except Exception as e:
+                logging.error("Attachment resolver callback failed: %s" % e)
+            finally:
+                attachment_resolutions_pending.dec()
+
+            # Keep this thread on the host's queue instead of resubmitting
+            with self.lock:
+                if self.queued[host]:
+                    url, on_done = self.queued[host].popleft()
+                else:
+                    self.active[host] -= 1
+                    if not self.active[host]:
+                        del self.active[host]
+                        del self.queued[host]
+                    url = None
+
+    def shutdown(self, wait=True):
+        """Stops taking new requests. With wait, returns once every post already handed over has had its
+        callback, queued requests included."""
+        with self.lock:
+            self.closed = True
+        self.executor.shutdown(wait=wait)
@@ -0,0 +1,139 @@
+import logging
+import time
+from collections import OrderedDict
+from threading import Lock
+
+from prometheus_client import Counter, Gauge
+from redis import RedisError
+
+author_cache_lookups = Counter('author_cache_lookups', 'Author ID lookups by the layer that answered them', ['layer'])
+author_cache_size = Gauge('author_cache_size', 'Author IDs held in the in-process LRU')
+
+REDIS_PREFIX = "fedibgs:author_ids:"
+# The unbounded hash of earlier versions; nothing reads it anymore, clear(shared=True) removes it
+LEGACY_REDIS_KEY = "fedibgs:author_ids"
+
+
+class AuthorCache:
+    """Author URL -> ID, as a bounded in-process LRU in front of Redis hashes shared by all workers.
+
+    Like the ingest filter, the shared hashes are generations: every window seconds a new one starts, lookups
+    read the current and the previous one, and each expires two windows after it started. An author found only
+    in the previous generation is carried over, so the hashes hold the authors seen in the last window or two
+    instead of every author ever seen.
+
+    IDs must only be stored once the transaction that created the author has committed. An ID that turns out
+    to be stale (e.g. the database was reset under a live Redis) must be dropped with forget().
+    """
+
+    def __init__(self, redis, max_size=50000, window=86400):
+        self.redis = redis
+        self.max_size = max_size
+        self.window = window
+        self.local = OrderedDict()
+        self.lock = Lock()
+
+    def _keys(self):
+        generation = int(time.time() // self.window)
+        return "%s%d" % (REDIS_PREFIX, generation), "%s%d" % (REDIS_PREFIX, generation - 1)
+
+    def __len__(self):
+        return len(self.local)
+
+    def _remember(self, mapping):
+        with self.lock:
+            for url, author_id in mapping.items():
+                self.local[url] = author_id
+                self.local.move_to_end(url)
+            while len(self.local) > self.max_size:
+                self.local.popitem(last=False)
+            author_cache_size.set(len(self.local))
+
+    def get_many(self, urls):
+        """Returns ({url: id} for every known author, [urls still missing]), asking Redis once for all local misses."""
+        found = {}
+        missing = []
+        with self.lock:
+            for url in urls:
+                author_id = self.local.get(url)
+                if author_id is None:
+                    missing.append(url)
+                else:
+                    self.local.move_to_end(url)
+                    found[url] = author_id
+        author_cache_lookups.labels("local").inc(len(found))
+
+        if missing:
+            current, previous = self._keys()
+            try:
+                pipeline = self.redis.pipeline(transaction=False)
+                pipeline.hmget(current, missing)
+                pipeline.hmget(previous, missing)
+                in_current, in_previous = pipeline.execute()
+            except RedisError as e:
+                logging.warning("Author cache: Redis lookup failed: %s" % e)
+                in_current = in_previous = [None] * len(missing)
+
+            from_redis = {}
+            carry_over = {}
+            for url, author_id, old_author_id in zip(missing, in_current, in_previous):
+                if author_id is not None:
+                    from_redis[url] = int(author_id)
+                elif old_author_id is not None:
+                    from_redis[url] = carry_over[url] = int(old_author_id)
+            if carry_over:
+                self._store(carry_over)
+            if from_redis:
+                self._remember(from_redis)
+                found.update(from_redis)
+                missing = [url for url in missing if url not in from_redis]
+            author_cache_lookups.labels("redis").inc(len(from_redis))
+            author_cache_lookups.labels("database").inc(len(missing))
+
+        return found, missing
+
+    def get(self, url):
+        found, _ = self.get_many([url])
+        return found.get(url)
+
+    def put_many(self, mapping):
+        if not mapping:
+            return
+        self._remember(mapping)
+        self._store(mapping)
+
+    def _store(self, mapping):
+        current, _ = self._keys()
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.hset(current, mapping=mapping)
+            pipeline.expire(current, 2 * self.window)
+            pipeline.execute()
+        except RedisError as e:
+            logging.warning("Author cache: Redis store failed: %s" % e)
+
+    def put(self, url, author_id):
+        self.put_many({url: author_id})
+
+    def forget(self, urls):
+        """Drops the IDs of urls here and in Redis, so that the next lookup asks the database again."""
+        if not urls:
+            return
+        with self.lock:
+            for url in urls:
+                self.local.pop(url, None)
+            author_cache_size.set(len(self.local))
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for key in self._keys():
+                pipeline.hdel(key, *urls)
+            pipeline.execute()
+        except RedisError as e:
+            logging.warning("Author cache: Redis delete failed: %s" % e)
+
+    def clear(self, shared=False):
+        with self.lock:
+            self.local.clear()
+            author_cache_size.set(0)
+        if shared:
+            self.redis.delete(*self._keys(), LEGACY_REDIS_KEY)
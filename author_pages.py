@@ -0,0 +1,111 @@
+"""Author pages: per-author aggregates kept on the authors row, and the author's posts as keyset pages.
+
+Ingest adds every inserted post to its author's post_count, attachment_count, first_seen and last_seen in the
+post's own transaction, and retention (partitions.py) takes the posts it removes off the counts again in the
+transaction that detaches them, so an author page reads its totals from one row instead of counting the
+author's posts. first_seen and last_seen are when the author's first and latest posts were indexed and stay
+as they are through retention. The posts are read off the (author_id, indexed_at DESC, id DESC) index, so a
+page costs the same for a bot with hundreds of thousands of posts as for an account with three, and the
+hundredth page as much as the first.
+
+Databases that predate the aggregates need the authors statements from init.sql, then backfill().
+"""
+import logging
+
+import hydrate
+from post_search import PAGE_SIZE, SearchCache, encode_cursor
+
+
+def update_aggregates(cursor, rows):
+    """Adds inserted posts to their authors' aggregates. rows: [(author_id, attachment count, indexed_at)].
+
+    Called in the transaction that inserts the posts, after their IDs are claimed. The author rows are locked
+    in ID order first, so concurrent ingests of overlapping authors cannot deadlock."""
+    if not rows:
+        return
+    author_ids = sorted({row[0] for row in rows})
+    if len(author_ids) > 1:
+        # A single author's row is locked by the UPDATE itself
+        cursor.execute("SELECT 1 FROM authors WHERE id = ANY(%s) ORDER BY id FOR NO KEY UPDATE", (author_ids,))
+    cursor.execute(
+        "UPDATE authors SET post_count = post_count + d.posts, attachment_count = attachment_count + d.attachments, "
+        "first_seen = LEAST(authors.first_seen, d.first_seen), last_seen = GREATEST(authors.last_seen, d.last_seen) "
+        "FROM (SELECT author_id, COUNT(*) AS posts, SUM(attachments) AS attachments, "
+        "MIN(indexed_at) AS first_seen, MAX(indexed_at) AS last_seen "
+        "FROM unnest(%s::int[], %s::int[], %s::timestamptz[]) AS t(author_id, attachments, indexed_at) "
+        "GROUP BY author_id) AS d WHERE authors.id = d.author_id",
+        ([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows]))
+
+
+# Per author, the posts indexed in [start, end) and the attachments of those posts
+RANGE_COUNTS = ("SELECT p.author_id, COUNT(*) AS posts, COALESCE(SUM(a.attachments), 0) AS attachments "
+                "FROM posts p LEFT JOIN (SELECT post_id, indexed_at, COUNT(*) AS attachments FROM attachments "
+                "WHERE indexed_at >= %(start)s AND indexed_at < %(end)s GROUP BY post_id, indexed_at) a "
+                "ON a.post_id = p.id AND a.indexed_at = p.indexed_at "
+                "WHERE p.indexed_at >= %(start)s AND p.indexed_at < %(end)s GROUP BY p.author_id")
+
+
+def forget_range(cursor, start, end):
+    """Takes the posts indexed in [start, end), and their attachments, off their authors' counts. Called by
+    retention before it removes the partitions of that range."""
+    cursor.execute("SELECT 1 FROM authors WHERE id IN (SELECT DISTINCT author_id FROM posts "
+                   "WHERE indexed_at >= %(start)s AND indexed_at < %(end)s) ORDER BY id FOR NO KEY UPDATE",
+                   {"start": start, "end": end})
+    cursor.execute("UPDATE authors SET post_count = GREATEST(post_count - d.posts, 0), "
+                   "attachment_count = GREATEST(attachment_count - d.attachments, 0) "
+                   "FROM (%s) AS d WHERE authors.id = d.author_id" % RANGE_COUNTS, {"start": start, "end": end})
+    return cursor.rowcount
+
+
+def backfill(connection):
+    """Recomputes the aggregates of every author from posts and attachments, e.g. after adding the columns."""
+    cursor = connection.cursor()
+    cursor.execute("UPDATE authors SET post_count = COALESCE(d.posts, 0), attachment_count = COALESCE(d.attachments, 0), "
+                   "first_seen = LEAST(authors.first_seen, d.first_seen), last_seen = GREATEST(authors.last_seen, d.last_seen) "
+                   "FROM authors a LEFT JOIN (SELECT p.author_id, COUNT(*) AS posts, SUM(n.attachments) AS attachments, "
+                   "MIN(p.indexed_at) AS first_seen, MAX(p.indexed_at) AS last_seen FROM posts p "
+                   "LEFT JOIN (SELECT post_id, indexed_at, COUNT(*) AS attachments FROM attachments GROUP BY post_id, indexed_at) n "
+                   "ON n.post_id = p.id AND n.indexed_at = p.indexed_at GROUP BY p.author_id) d ON d.author_id = a.id "
+                   "WHERE authors.id = a.id")
+    logging.info("Authors: recomputed the aggregates of %d authors" % cursor.rowcount)
+    connection.commit()
+
+
+async def get_author(cursor, author_id):
+    """The author's row with its aggregates, or None."""
+    await cursor.execute("SELECT username, url, post_count, attachment_count, first_seen, last_seen FROM authors "
+                         "WHERE id = %s", (author_id,))
+    row = await cursor.fetchone()
+    if row is None:
+        return None
+    username, url, post_count, attachment_count, first_seen, last_seen = row
+    # Milliseconds, like the posts' indexed_at
+    return {"id": author_id, "username": username, "url": url, "total_posts": post_count,
+            "total_attachments": attachment_count,
+            "first_seen": int(first_seen.timestamp()) * 1000 if first_seen else None,
+            "last_seen": int(last_seen.timestamp()) * 1000 if last_seen else None}
+
+
+async def author_posts(cursor, author_id, after=None, offset=0, limit=PAGE_SIZE):
+    """One page of the author's posts, newest first, read off the (author_id, indexed_at, id) index. after is a
+    decoded cursor; offset is only for old clients."""
+    if after is not None:
+        page = ("SELECT id, indexed_at FROM posts WHERE author_id = %s AND (indexed_at, id) < (%s, %s) "
+                "ORDER BY indexed_at DESC, id DESC LIMIT %s")
+        params = (author_id, after[0], after[1], limit)
+    else:
+        page = "SELECT id, indexed_at FROM posts WHERE author_id = %s ORDER BY indexed_at DESC, id DESC LIMIT %s OFFSET %s"
+        params = (author_id, limit, offset)
+    await cursor.execute("WITH page AS (%s) " % page + hydrate.select_posts(
+        "JOIN page ON page.id = posts.id AND page.indexed_at = posts.indexed_at "
+        "ORDER BY posts.indexed_at DESC, posts.id DESC"), params)
+    posts = await cursor.fetchall()
+
+    next_cursor = None
+    if len(posts) == limit:
+        next_cursor = encode_cursor(posts[-1][4], posts[-1][0])
+    return [hydrate.format_post(post) for post in posts], next_cursor
+
+
+class AuthorPageCache(SearchCache):
+    REDIS_PREFIX = "fedibgs:author:"
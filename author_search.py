@@ -0,0 +1,41 @@
+from post_search import SearchCache, normalize_query
+
+# pg_trgm can only use its index for patterns with at least one full trigram
+TRIGRAM_MIN_LENGTH = 3
+
+
+def like_escape(q):
+    return q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+async def search_authors(cursor, q, limit=50):
+    """Authors whose username or URL contains q, exact and prefix username matches first.
+
+    Queries shorter than a trigram only match username prefixes, through the lower(username) pattern index,
+    instead of scanning every author."""
+    q = normalize_query(q)
+    if not q:
+        return []
+    prefix = like_escape(q) + "%"
+    if len(q) < TRIGRAM_MIN_LENGTH:
+        await cursor.execute(
+            "SELECT id, username, url FROM authors WHERE lower(username) LIKE %(prefix)s "
+            "ORDER BY lower(username) = %(q)s DESC, length(username), id LIMIT %(limit)s",
+            {"q": q, "prefix": prefix, "limit": limit})
+    else:
+        await cursor.execute(
+            "SELECT id, username, url FROM authors WHERE username ILIKE %(pattern)s OR url ILIKE %(pattern)s "
+            "ORDER BY lower(username) = %(q)s DESC, username ILIKE %(prefix)s DESC, similarity(username, %(q)s) DESC, id "
+            "LIMIT %(limit)s",
+            {"q": q, "pattern": "%" + like_escape(q) + "%", "prefix": prefix, "limit": limit})
+    return [{"id": author[0], "username": author[1], "url": author[2]} for author in await cursor.fetchall()]
+
+
+class AuthorSearchCache(SearchCache):
+    REDIS_PREFIX = "fedibgs:author_search:"
+
+    async def get_results(self, q, limit):
+        return await self._get(self._key("results", q, limit))
+
+    async def put_results(self, q, limit, results):
+        await self._set(self._key("results", q, limit), results, self.ttl)
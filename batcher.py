@@ -0,0 +1,232 @@
+import logging
+import os
+import pickle
+import queue
+import threading
+import time
+
+from prometheus_client import Counter, Gauge, Histogram
+
+import instrumentation
+
+batch_size_histogram = Histogram('ingest_batch_size', 'Posts per batch handed to the broker',
+                                 buckets=(1, 8, 16, 32, 64, 128, 256, 512, 1024))
+batch_target_size = Gauge('ingest_batch_target_size', 'Current adaptive batch size')
+batches_spilled = Counter('ingest_batches_spilled', 'Batches written to disk because the broker was slow or down')
+
+
+class AdaptiveBatcher:
+    """Buffers posts and hands them to send() in batches.
+
+    A batch is flushed once it reaches the current target size or its oldest post is max_latency
+    seconds old, whichever comes first. The target size follows the observed post rate so that a
+    busy stream produces roughly one batch per target_interval seconds.
+
+    send() runs on its own thread. When more than max_pending batches are waiting for it, new
+    batches are spilled to spill_dir (or, without a spill_dir, add() blocks). Spilled batches are
+    replayed once the broker catches up, including after a restart.
+    """
+
+    def __init__(self, send, min_size=16, max_size=512, max_latency=2.0, target_interval=1.0, max_pending=8,
+                 spill_dir=None):
+        self.send = send
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_latency = max_latency
+        self.target_interval = target_interval
+        self.spill_dir = spill_dir
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
+
+        self.items = []
+        self.size = min_size
+        self.rate = 0.0
+        self.added = 0
+        self.closed = False
+        self.lock = threading.Lock()
+        self.pending = queue.Queue(maxsize=max_pending)
+        batch_target_size.set(self.size)
+
+        self.flusher = threading.Thread(target=self._flush_loop, daemon=True, name="batcher-flush")
+        self.sender = threading.Thread(target=self._send_loop, daemon=True, name="batcher-send")
+        self.flusher.start()
+        self.sender.start()
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        with self.lock:
+            if self.closed:
+                late = True
+            else:
+                late = False
+                self.items.append((time.monotonic(), item))
+            self.added += 1
+            batch = self._take() if not late and len(self.items) >= self.size else None
+        if late:
+            # Nothing flushes the buffer after close() and the sender is gone
+            self._send_late([item])
+        elif batch:
+            self._dispatch(batch)
+
+    def flush(self, timeout=None):
+        with self.lock:
+            batch = self._take()
+        if batch:
+            self._dispatch(batch, timeout)
+
+    def close(self, timeout=10):
+        """Flushes the buffer and waits for the sender; whatever the broker did not take is spilled. Posts added
+        after this are spilled, or without a spill_dir sent right away."""
+        with self.lock:
+            self.closed = True
+        self.flush(timeout)
+        try:
+            self.pending.put(None, timeout=timeout)
+        except queue.Full:
+            pass
+        self.sender.join(timeout)
+
+        leftover = []
+        while True:
+            try:
+                batch = self.pending.get_nowait()
+            except queue.Empty:
+                break
+            if batch:
+                leftover.append(batch)
+        for batch in leftover:
+            self._spill(batch)
+        if leftover and not self.spill_dir:
+            logging.error("Broker did not accept %d batches before shutdown, dropping them" % len(leftover))
+
+    def _take(self):
+        if not self.items:
+            return None
+        now = time.monotonic()
+        for added_at, _ in self.items:
+            instrumentation.buffer_dwell_seconds.observe(now - added_at)
+        batch = [item for _, item in self.items]
+        self.items = []
+        batch_size_histogram.observe(len(batch))
+        return batch
+
+    def _dispatch(self, batch, timeout=None):
+        if not self.spill_dir:
+            # No spill directory: back pressure onto whoever is adding posts
+            try:
+                self.pending.put(batch, timeout=timeout)
+            except queue.Full:
+                logging.error("Broker did not accept batch of %d posts in time, dropping it" % len(batch))
+            return
+        try:
+            self.pending.put_nowait(batch)
+        except queue.Full:
+            self._spill(batch)
+
+    def _send_late(self, batch):
+        if self.spill_dir:
+            self._spill(batch)
+            return
+        try:
+            self.send(batch)
+        except Exception as e:
+            logging.error("Dropping batch of %d posts added after shutdown: %s" % (len(batch), e))
+
+    def _spill(self, batch):
+        if not self.spill_dir:
+            return
+        path = os.path.join(self.spill_dir, "%d.batch" % time.time_ns())
+        # Written under a temporary name and renamed once complete, so replay never picks up half a batch
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(batch, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + ".tmp", path)
+        batches_spilled.inc()
+        logging.warning("Broker is behind, spilled %d posts to %s" % (len(batch), path))
+
+    def _spilled(self):
+        if not self.spill_dir:
+            return []
+        return sorted(name for name in os.listdir(self.spill_dir) if name.endswith(".batch"))
+
+    def _flush_loop(self):
+        last_added = 0
+        last_tick = time.monotonic()
+        while not self.closed:
+            time.sleep(min(0.1, self.max_latency / 4))
+            now = time.monotonic()
+
+            # Exponentially weighted post rate, in posts/sec
+            added = self.added
+            self.rate = 0.9 * self.rate + 0.1 * (added - last_added) / (now - last_tick)
+            last_added, last_tick = added, now
+            self.size = int(min(self.max_size, max(self.min_size, self.rate * self.target_interval)))
+            batch_target_size.set(self.size)
+
+            with self.lock:
+                batch = self._take() if self.items and now - self.items[0][0] >= self.max_latency else None
+            if batch:
+                self._dispatch(batch)
+
+    def _send_loop(self):
+        failures = 0
+        while True:
+            try:
+                batch = self.pending.get(timeout=1)
+            except queue.Empty:
+                batch = self._replay_spilled()
+                if batch is False:
+                    failures += 1
+                    time.sleep(min(30, 2 ** failures))
+                elif batch:
+                    failures = 0
+                continue
+            if batch is None:
+                return
+
+            while True:
+                try:
+                    self.send(batch)
+                    failures = 0
+                    break
+                except Exception as e:
+                    logging.error("Failed to enqueue batch of %d posts: %s" % (len(batch), e))
+                    failures += 1
+                    if self.spill_dir:
+                        self._spill(batch)
+                        break
+                    if self.closed:
+                        logging.error("Dropping batch of %d posts on shutdown" % len(batch))
+                        break
+                    time.sleep(min(30, 2 ** failures))
+
+    def _replay_spilled(self):
+        """Sends the oldest spilled batch. Returns True if one was sent (or was unreadable and moved aside), False
+        on failure, None if there was none."""
+        names = self._spilled()
+        if not names:
+            return None
+        path = os.path.join(self.spill_dir, names[0])
+        try:
+            with open(path, "rb") as f:
+                batch = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            # Moved aside, or every batch spilled after it would be stuck behind it
+            logging.error("Spilled batch %s is unreadable, moving it to %s.bad: %s" % (path, path, e))
+            try:
+                os.replace(path, path + ".bad")
+            except OSError as e:
+                logging.error("Failed to move %s aside: %s" % (path, e))
+                return False
+            return True
+        try:
+            self.send(batch)
+        except Exception as e:
+            logging.error("Failed to replay spilled batch %s: %s" % (path, e))
+            return False
+        os.remove(path)
+        logging.info("Replayed spilled batch %s - %d posts" % (path, len(batch)))
+        return True
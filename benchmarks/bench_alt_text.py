@@ -0,0 +1,139 @@
+"""p50/p99 latency of /api/search on post content only, as it was, against content plus attachment alt-text,
+for common, middling and rare words, at the first page and ten pages deep, on posts seeded with Zipf-like text.
+
+    BENCH_DSN="dbname=fedibgs_bench ..." python benchmarks/bench_alt_text.py --posts 2000000
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+from common import Timer, async_connect, connect, percentile, reset_schema
+
+import hydrate
+import partitions
+import post_search
+
+# Word n of the vocabulary is drawn with probability falling off like a power law, so w0 is in about a quarter
+# of the posts and w20000 in a few hundred
+VOCABULARY = 50000
+WORD = "'w' || floor(power(random(), 2.5) * %d)::int" % VOCABULARY
+QUERIES = {"common": "w0", "middling": "w100", "rare": "w20000", "two words": "w3 w40"}
+
+# What post_search.search_posts ran before alt-text was searched too
+CONTENT_ONLY = hydrate.select_posts("WHERE posts.content_ts @@ websearch_to_tsquery('english', %s::text) "
+                                    "{after}ORDER BY posts.indexed_at DESC, posts.id DESC LIMIT 50")
+
+
+def seed(connection, n, days):
+    reset_schema(connection)
+    now = datetime.now(timezone.utc)
+    partitions.ensure_partitions(connection, first=now - timedelta(days=days), now=now, premake=1)
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO authors (url, username) SELECT 'https://example.social/@user' || i, 'user' || i "
+                   "FROM generate_series(1, 10000) AS i")
+    cursor.execute(
+        "INSERT INTO posts (id, content, post_url, tags, author_id, indexed_at) "
+        "SELECT md5(i::text)::uuid, (SELECT string_agg({word}, ' ') FROM generate_series(1, 5 + i %% 30)), "
+        "'https://example.social/@u/' || i, '[]', 1 + i %% 10000, now() - make_interval(secs => i::float8 / %s * %s * 86400) "
+        "FROM generate_series(1, %s) AS i".format(word=WORD), (n, days, n))
+    # A third of the posts have one to four attachments, most of them with a description
+    cursor.execute(
+        "INSERT INTO attachments (post_id, description, url, indexed_at) "
+        "SELECT posts.id, CASE WHEN random() < 0.7 THEN (SELECT string_agg({word}, ' ') FROM generate_series(1, 1 + (n + a) % 20)) END, "
+        "'https://media.example.social/' || posts.id || '/' || a, posts.indexed_at "
+        "FROM posts, generate_series(1, 4) AS a, LATERAL (SELECT get_byte(uuid_send(posts.id), 0) AS n) AS b "
+        "WHERE n % 3 = 0 AND a <= 1 + n % 4".format(word=WORD))
+    connection.commit()
+    connection.autocommit = True
+    cursor.execute("VACUUM ANALYZE")
+    connection.autocommit = False
+
+
+async def measure(run, repeat):
+    samples = []
+    for _ in range(repeat):
+        with Timer() as t:
+            await run()
+        samples.append(t.elapsed * 1000)
+    return percentile(samples, 50), percentile(samples, 99)
+
+
+async def deep_cursor(cursor, q, pages, **kwargs):
+    after = None
+    for _ in range(pages):
+        _, next_cursor = await post_search.search_posts(cursor, q, after=after, **kwargs)
+        if next_cursor is None:
+            return None
+        after = post_search.decode_cursor(next_cursor)
+    return after
+
+
+async def run(args):
+    connection = await async_connect(autocommit=True)
+    cursor = connection.cursor()
+
+    print("%-10s %-26s %16s %16s" % ("query", "path", "page 1 p50/p99", "page 11 p50/p99"))
+    for label, q in QUERIES.items():
+        # The old path paged over content matches only
+        await cursor.execute("SELECT posts.indexed_at, posts.id FROM posts WHERE posts.content_ts @@ websearch_to_tsquery('english', %s::text) "
+                             "ORDER BY posts.indexed_at DESC, posts.id DESC OFFSET 499 LIMIT 1", (q,))
+        old_after = await cursor.fetchone()
+
+        async def old_first():
+            await cursor.execute(CONTENT_ONLY.format(after=""), (q,))
+            await cursor.fetchall()
+
+        async def old_deep():
+            await cursor.execute(CONTENT_ONLY.format(after="AND (posts.indexed_at, posts.id) < (%s, %s) "), (q, *old_after))
+            await cursor.fetchall()
+
+        rows = [("content only", await measure(old_first, args.repeat), await measure(old_deep, args.repeat) if old_after else None)]
+        for path, kwargs in (("content + alt-text", {}), ("  images only", {"images": True}),
+                             ("  by relevance", {"order": "relevance"})):
+            after = await deep_cursor(cursor, q, 10, **kwargs)
+
+            async def first():
+                await post_search.search_posts(cursor, q, **kwargs)
+
+            async def deep():
+                await post_search.search_posts(cursor, q, after=after, **kwargs)
+
+            rows.append((path, await measure(first, args.repeat), await measure(deep, args.repeat) if after else None))
+
+        async def old_count():
+            await cursor.execute("SELECT COUNT(*) FROM (SELECT 1 FROM posts WHERE content_ts @@ websearch_to_tsquery('english', %s::text) "
+                                 "LIMIT %s) AS matches", (q, args.count_cap + 1))
+
+        async def count():
+            await post_search.count_matches(cursor, q, args.count_cap)
+
+        rows.append(("count, content only", await measure(old_count, args.repeat), None))
+        rows.append(("count, + alt-text", await measure(count, args.repeat), None))
+        for path, first, deep in rows:
+            print("%-10s %-26s %7.2f/%-8.2f %16s" % (label, path, *first, "%7.2f/%-8.2f" % deep if deep else "-"))
+    await connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=2000000)
+    parser.add_argument("--days", type=int, default=28)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--count-cap", type=int, default=1000)
+    parser.add_argument("--no-seed", action="store_true", help="reuse the posts of a previous run")
+    args = parser.parse_args()
+
+    if not args.no_seed:
+        connection = connect()
+        with Timer() as t:
+            seed(connection, args.posts, args.days)
+        cursor = connection.cursor()
+        cursor.execute("SELECT (SELECT COUNT(*) FROM posts), (SELECT COUNT(*) FROM attachments), "
+                       "(SELECT COUNT(*) FROM attachments WHERE description IS NOT NULL)")
+        print("seeded %d posts, %d attachments (%d described) in %.1fs" % (*cursor.fetchone(), t.elapsed))
+        connection.close()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
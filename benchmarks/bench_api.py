@@ -0,0 +1,92 @@
+"""Requests/sec and tail latency of a running API under mixed search and /stream load.
+
+Run it once against the server as of the commit before the async pool and once against the current one,
+both pointed at the same seeded database (DB_CONNINFO, e.g. seeded by bench_search.py) and with
+SEARCH_CACHE_TTL=0 so every search reaches Postgres:
+
+    DB_CONNINFO="dbname=fedibgs_bench ..." SEARCH_CACHE_TTL=0 uvicorn main:app --port 8000
+    python benchmarks/bench_api.py --url http://localhost:8000 --search-clients 16 --stream-clients 32
+
+/stream pushes roughly once a second; a blocked event loop shows up as longer gaps between its messages.
+"""
+import argparse
+import random
+import threading
+import time
+
+import requests
+from websockets.sync.client import connect as ws_connect
+
+from common import WORDS, percentile
+
+
+def search_client(url, pages, stop, latencies, errors, seed):
+    rng = random.Random(seed)
+    session = requests.Session()
+    while not stop.is_set():
+        params = {"q": "%s %s" % (rng.choice(WORDS), rng.choice(WORDS))}
+        for _ in range(pages):
+            start = time.perf_counter()
+            try:
+                response = session.get(url + "/api/search", params=params, timeout=60)
+                response.raise_for_status()
+                body = response.json()
+            except (requests.RequestException, ValueError):
+                errors.append(1)
+                break
+            latencies.append((time.perf_counter() - start) * 1000)
+            if len(body.get("posts", [])) < 50 or stop.is_set():
+                break
+            if "next_cursor" in body:
+                params["cursor"] = body["next_cursor"]
+            else:
+                # Servers from before keyset pagination
+                params["offset"] = params.get("offset", 0) + 50
+
+
+def stream_client(url, stop, gaps, messages):
+    with ws_connect(url.replace("http", "ws", 1) + "/stream", open_timeout=30) as websocket:
+        last = time.perf_counter()
+        while not stop.is_set():
+            try:
+                websocket.recv(timeout=1)
+            except TimeoutError:
+                continue
+            now = time.perf_counter()
+            gaps.append((now - last) * 1000)
+            messages.append(1)
+            last = now
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--search-clients", type=int, default=16)
+    parser.add_argument("--stream-clients", type=int, default=32)
+    parser.add_argument("--pages", type=int, default=5, help="pages each search client follows per query")
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+    url = args.url.rstrip("/")
+
+    stop = threading.Event()
+    latencies, errors, gaps, messages = [], [], [], []
+    threads = [threading.Thread(target=stream_client, args=(url, stop, gaps, messages), daemon=True)
+               for _ in range(args.stream_clients)]
+    threads += [threading.Thread(target=search_client, args=(url, args.pages, stop, latencies, errors, seed), daemon=True)
+                for seed in range(args.search_clients)]
+    for thread in threads:
+        thread.start()
+    time.sleep(args.duration)
+    stop.set()
+    for thread in threads:
+        thread.join(timeout=60)
+
+    print("search  %8.1f req/sec  p50 %8.1f ms  p99 %8.1f ms  max %8.1f ms  (%d requests, %d errors)"
+          % (len(latencies) / args.duration, percentile(latencies, 50), percentile(latencies, 99),
+             max(latencies, default=0), len(latencies), len(errors)))
+    print("stream  %8.1f msg/sec  gap p50 %6.0f ms  p99 %6.0f ms  max %6.0f ms"
+          % (len(messages) / args.duration, percentile(gaps, 50), percentile(gaps, 99), max(gaps, default=0)))
+
+
+if __name__ == "__main__":
+    main()
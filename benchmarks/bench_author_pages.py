@@ -0,0 +1,150 @@
+"""Author page latency by author size and page depth on seeded posts with a skewed author distribution:
+COUNT(*) plus LIMIT/OFFSET, what /api/author/{author_id} ran before, against the aggregates on the authors
+row plus keyset pages of author_pages.py.
+
+    BENCH_DSN="dbname=fedibgs_bench ..." python benchmarks/bench_author_pages.py --posts 2000000 --bot-posts 300000
+
+Authors are drawn Zipf-like, so a few accounts have a large share of the posts and most have a handful, and
+one bot account gets --bot-posts on top. Both approaches run against the same schema, the composite
+(author_id, indexed_at, id) index included. Also reported is what counting one batch of posts on their
+authors adds to ingest.
+"""
+import argparse
+import asyncio
+import random
+from datetime import datetime, timedelta, timezone
+
+from common import Timer, async_connect, connect, percentile, reset_schema
+
+import author_pages
+import hydrate
+import partitions
+from post_search import PAGE_SIZE, decode_cursor, encode_cursor
+
+DEPTHS = (0, 10, 100, 1000)
+
+
+def seed(connection, n, n_authors, bot_posts, days):
+    reset_schema(connection)
+    now = datetime.now(timezone.utc)
+    partitions.ensure_partitions(connection, first=now - timedelta(days=days), now=now, premake=1)
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO authors (url, username) SELECT 'https://example.social/@user' || i, 'user' || i "
+                   "FROM generate_series(1, %s) AS i", (n_authors,))
+    # Author 1 is the bot; the rest are drawn so that author k has about 1/k of the top author's posts
+    cursor.execute(
+        "INSERT INTO posts (id, content, post_url, tags, author_id, indexed_at) "
+        "SELECT md5(i::text)::uuid, 'post ' || i, 'https://example.social/@u/' || i, '[]', "
+        "CASE WHEN i <= %s THEN 1 ELSE 1 + floor(exp(random() * ln(%s - 1)))::int END, "
+        "now() - make_interval(secs => random() * %s * 86400) "
+        "FROM generate_series(1, %s) AS i", (bot_posts, n_authors, days, n + bot_posts))
+    cursor.execute("INSERT INTO attachments (url, description, post_id, indexed_at) "
+                   "SELECT 'https://media.example.social/' || id || '.jpg', NULL, id, indexed_at FROM posts "
+                   "WHERE random() < 0.3")
+    connection.commit()
+
+
+async def ameasure(run, repeat):
+    samples = []
+    for _ in range(repeat):
+        with Timer() as t:
+            await run()
+        samples.append(t.elapsed * 1000)
+    return percentile(samples, 50), percentile(samples, 99)
+
+
+async def author_pages_latency(sample_authors, repeat):
+    connection = await async_connect(autocommit=True)
+    cursor = connection.cursor()
+    results = []
+    for label, author_id, post_count in sample_authors:
+        for depth in DEPTHS:
+            offset = depth * PAGE_SIZE
+            if offset >= post_count:
+                continue
+            after = None
+            if offset:
+                # The cursor a reader paging this far would hold: the last post of the previous page
+                await cursor.execute("SELECT indexed_at, id FROM posts WHERE author_id = %s "
+                                     "ORDER BY indexed_at DESC, id DESC OFFSET %s LIMIT 1", (author_id, offset - 1))
+                after = decode_cursor(encode_cursor(*await cursor.fetchone()))
+
+            async def count_offset():
+                await cursor.execute("SELECT username, url FROM authors WHERE id = %s", (author_id,))
+                await cursor.fetchone()
+                await cursor.execute("SELECT COUNT(*) FROM posts WHERE author_id = %s", (author_id,))
+                await cursor.fetchone()
+                await cursor.execute(hydrate.select_posts("WHERE posts.author_id = %s ORDER BY posts.indexed_at DESC "
+                                                          "LIMIT 50 OFFSET %s"), (author_id, offset))
+                await cursor.fetchall()
+
+            async def aggregates_keyset():
+                await author_pages.get_author(cursor, author_id)
+                await author_pages.author_posts(cursor, author_id, after=after)
+
+            results.append(("%s (%d posts)" % (label, post_count), depth,
+                            await ameasure(count_offset, repeat), await ameasure(aggregates_keyset, repeat)))
+    await connection.close()
+    return results
+
+
+def aggregate_update(connection, n_authors, batch, repeat):
+    """p50/p99 ms of counting one batch of posts, drawn like the seeded ones, on their authors."""
+    rng = random.Random(7)
+    now = datetime.now(timezone.utc)
+    cursor = connection.cursor()
+    samples = []
+    for _ in range(repeat):
+        rows = [(1 if rng.random() < 0.1 else 1 + int((n_authors - 1) ** rng.random()), rng.randrange(3), now)
+                for _ in range(batch)]
+        with Timer() as t:
+            author_pages.update_aggregates(cursor, rows)
+            connection.commit()
+        samples.append(t.elapsed * 1000)
+    return percentile(samples, 50), percentile(samples, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=2000000)
+    parser.add_argument("--authors", type=int, default=50000)
+    parser.add_argument("--bot-posts", type=int, default=300000, help="posts of the one bot account")
+    parser.add_argument("--days", type=int, default=28)
+    parser.add_argument("--batch", type=int, default=500, help="posts per ingest batch for the aggregate update")
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    connection = connect()
+    with Timer() as t:
+        seed(connection, args.posts, args.authors, args.bot_posts, args.days)
+    print("seeded %d posts by %d authors in %.1fs" % (args.posts + args.bot_posts, args.authors, t.elapsed))
+    with Timer() as t:
+        author_pages.backfill(connection)
+    print("backfilled the author aggregates in %.1fs" % t.elapsed)
+
+    connection.autocommit = True
+    connection.execute("VACUUM ANALYZE")
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(*) FROM (SELECT author_id, COUNT(*) FROM posts GROUP BY author_id) c "
+                   "JOIN authors ON authors.id = c.author_id WHERE authors.post_count <> c.count")
+    mismatched = cursor.fetchone()[0]
+    if mismatched:
+        raise SystemExit("%d authors have a post_count that does not match their posts" % mismatched)
+
+    cursor.execute("SELECT id, post_count FROM authors WHERE post_count > 0 ORDER BY post_count DESC")
+    ranked = cursor.fetchall()
+    sample_authors = [("bot", *ranked[0]), ("top", *ranked[1]), ("p99", *ranked[len(ranked) // 100]),
+                      ("median", *ranked[len(ranked) // 2]), ("small", *ranked[-1])]
+
+    print("%-22s %6s %18s %18s" % ("author page p50/p99 ms", "page", "COUNT + OFFSET", "aggregates+keyset"))
+    for label, depth, old, new in asyncio.run(author_pages_latency(sample_authors, args.repeat)):
+        print("%-22s %6d %8.2f/%-9.2f %8.2f/%-9.2f" % (label, depth, *old, *new))
+
+    connection.autocommit = False
+    print("counting a %d-post batch on its authors: p50 %.2f ms  p99 %.2f ms"
+          % (args.batch, *aggregate_update(connection, args.authors, args.batch, args.repeat)))
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,109 @@
+"""p50/p99 latency of author search on a seeded authors table: the old unindexed ILIKE scan against the
+trigram/prefix-indexed author_search path, with and without the result cache.
+
+    BENCH_DSN="dbname=fedibgs_bench ..." python benchmarks/bench_authors.py --authors 3000000
+"""
+import argparse
+import asyncio
+import os
+import random
+
+import redis.asyncio
+
+from common import BENCH_REDIS_URL, ROOT, WORDS, Timer, async_connect, connect, percentile, reset_schema
+
+import author_search
+import responses
+
+INDEXES = ("authors_username_trgm_idx", "authors_url_trgm_idx", "authors_username_prefix_idx")
+
+
+def seed(connection, n):
+    reset_schema(connection)
+    cursor = connection.cursor()
+    words = "(ARRAY[%s])" % ", ".join("'%s'" % word for word in WORDS)
+    # username like "sunset_coffee4711", spread over 5000 instances
+    cursor.execute(
+        "INSERT INTO authors (url, username) SELECT 'https://' || instance || '/@' || username, username FROM ("
+        "SELECT i, 'example' || (i %% 5000) || '.social' AS instance, "
+        "{words}[1 + i %% 20] || '_' || {words}[1 + (i / 20) %% 20] || (i / 400) AS username "
+        "FROM generate_series(1, %s) AS i) AS generated".format(words=words), (n,))
+    cursor.execute("ANALYZE authors")
+    connection.commit()
+
+
+def make_queries(rng, n):
+    queries = []
+    for i in range(n):
+        word = rng.choice(WORDS)
+        queries.append((word, "%s_%s" % (word, rng.choice(WORDS)), word[:2], "example%d.social" % rng.randrange(5000),
+                        "%s_%s%d" % (word, rng.choice(WORDS), rng.randrange(1000)))[i % 5])
+    return queries
+
+
+async def old_search(cursor, q):
+    """What /api/author/search ran before the trigram indexes."""
+    q = "%" + q.strip().replace("%", "") + "%"
+    await cursor.execute("SELECT id, username, url FROM authors WHERE username ILIKE %s OR url ILIKE %s LIMIT 50", (q, q))
+    await cursor.fetchall()
+
+
+async def cached_search(cache, cursor, q):
+    if await cache.get_results(q, 50) is None:
+        await cache.put_results(q, 50, responses.encode(await author_search.search_authors(cursor, q)))
+
+
+async def measure(run, queries, repeat):
+    samples = []
+    for _ in range(repeat):
+        for q in queries:
+            with Timer() as t:
+                await run(q)
+            samples.append(t.elapsed * 1000)
+    return percentile(samples, 50), percentile(samples, 99)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--authors", type=int, default=3000000)
+    parser.add_argument("--queries", type=int, default=25)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-seed", action="store_true", help="reuse the authors of a previous run")
+    args = parser.parse_args()
+
+    connection = connect()
+    if not args.no_seed:
+        with Timer() as t:
+            seed(connection, args.authors)
+        print("seeded %d authors in %.1fs" % (args.authors, t.elapsed))
+
+    queries = make_queries(random.Random(4), args.queries)
+    async_connection = await async_connect(autocommit=True)
+    cursor = async_connection.cursor()
+
+    # The old query against the table as it was, without the new indexes
+    connection.autocommit = True
+    for index in INDEXES:
+        connection.execute("DROP INDEX IF EXISTS %s" % index)
+    old = await measure(lambda q: old_search(cursor, q), queries, 1)
+
+    with Timer() as t:
+        with open(os.path.join(ROOT, "init.sql")) as f:
+            statements = [s.strip() for s in f.read().split(";\n") if "authors_" in s and "INDEX" in s]
+        for statement in statements:
+            connection.execute(statement)
+    print("built author indexes in %.1fs" % t.elapsed)
+
+    new = await measure(lambda q: author_search.search_authors(cursor, q), queries, args.repeat)
+    cache = author_search.AuthorSearchCache(redis.asyncio.Redis.from_url(BENCH_REDIS_URL))
+    cached = await measure(lambda q: cached_search(cache, cursor, q), queries, args.repeat)
+
+    print("%-8s %10s %10s" % ("path", "p50 ms", "p99 ms"))
+    for name, (p50, p99) in (("ilike", old), ("trigram", new), ("cached", cached)):
+        print("%-8s %10.2f %10.2f" % (name, p50, p99))
+    await async_connection.close()
+    connection.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,70 @@
+"""Throughput and memory of the scraper's post dedup filter against a plain set of UUIDs.
+
+    python benchmarks/bench_dedup.py --posts 1000000 --duplicates 0.4 --capacity 1000000
+"""
+import argparse
+import random
+import tracemalloc
+import uuid
+
+from common import Timer
+
+from dedup import RotatingBloomFilter
+
+
+def make_stream(n, duplicate_ratio, rng):
+    stream = []
+    for _ in range(n):
+        if stream and rng.random() < duplicate_ratio:
+            # Relays resend recent posts, so duplicates come from the recent past
+            stream.append(stream[-rng.randint(1, min(len(stream), 5000))])
+        else:
+            stream.append(uuid.UUID(int=rng.getrandbits(128)))
+    return stream
+
+
+def run(name, make, add, stream, unique):
+    seen = make()
+    with Timer() as t:
+        duplicates = sum(1 for post_uuid in stream if add(seen, post_uuid))
+
+    # Memory in a second pass, tracemalloc slows everything down
+    tracemalloc.start()
+    seen = make()
+    for post_uuid in stream:
+        add(seen, post_uuid)
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    false_positives = duplicates - (len(stream) - unique)
+    print("%-6s %9.0f checks/sec  %8.1f MiB  %d duplicates (%d false positives)"
+          % (name, len(stream) / t.elapsed, memory / 2 ** 20, duplicates, false_positives))
+
+
+def add_to_set(seen, post_uuid):
+    key = post_uuid.bytes
+    if key in seen:
+        return True
+    seen.add(key)
+    return False
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=500000)
+    parser.add_argument("--duplicates", type=float, default=0.4)
+    parser.add_argument("--capacity", type=int, default=1000000)
+    parser.add_argument("--error-rate", type=float, default=0.001)
+    args = parser.parse_args()
+
+    stream = make_stream(args.posts, args.duplicates, random.Random(1))
+    unique = len(set(stream))
+    print("%d posts, %d unique" % (len(stream), unique))
+
+    run("set", set, add_to_set, stream, unique)
+    run("bloom", lambda: RotatingBloomFilter(args.capacity, args.error_rate),
+        lambda seen, post_uuid: seen.add(post_uuid), stream, unique)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Rows/s of the embedding pipeline against embedding one row at a time, with an encoder that costs what a
+CLIP server roughly does (a fixed round trip per request plus a per-item cost), and again with a warm cache.
+
+    python benchmarks/bench_embeddings.py --posts 20000 --duplicates 0.3 --request-ms 20 --item-ms 2
+
+Without the pgvecto.rs extension the embedding columns are created as real[], which takes the same UPDATE.
+"""
+import argparse
+import os
+import random
+import time
+
+from redis import Redis
+
+from common import BENCH_REDIS_URL, ROOT, Timer, connect, make_datasets, reset_schema
+
+import embeddings
+import tasks
+from author_cache import AuthorCache
+
+
+class SlowEncoder(embeddings.HashEncoder):
+    name = "bench"
+
+    def __init__(self, request_ms, item_ms):
+        super().__init__()
+        self.request_ms = request_ms
+        self.item_ms = item_ms
+        self.items = 0
+
+    def encode(self, kind, contents):
+        time.sleep((self.request_ms + self.item_ms * len(contents)) / 1000)
+        self.items += len(contents)
+        return super().encode(kind, contents)
+
+
+def seed(connection, n, duplicates, rng):
+    tasks.author_cache.clear(shared=True)
+    reset_schema(connection)
+    connection.autocommit = True
+    for table, column in (("posts", "text_embedding"), ("attachments", "vector")):
+        connection.execute("ALTER TABLE %s ADD COLUMN IF NOT EXISTS %s real[]" % (table, column))
+    with open(os.path.join(ROOT, "init.sql")) as f:
+        for statement in f.read().split(";\n"):
+            if "_unembedded_idx" in statement:
+                connection.execute(statement.strip())
+    connection.autocommit = False
+    datasets = make_datasets(n, attachment_ratio=0.3)
+    # Boosts and re-posted pictures: the same text or image under another post
+    for dataset in datasets:
+        if rng.random() < duplicates:
+            original = rng.choice(datasets)
+            dataset["content"] = original["content"]
+            for attachment, other in zip(dataset["attachments"], original["attachments"]):
+                attachment["url"] = other["url"]
+    for i in range(0, n, 1000):
+        tasks.ingest_rows_bulk(connection, datasets[i:i + 1000])
+
+
+def reset_embeddings(connection):
+    connection.execute("UPDATE posts SET text_embedding = NULL")
+    connection.execute("UPDATE attachments SET vector = NULL")
+    connection.commit()
+
+
+def one_by_one(connection, encoder):
+    """Each row on its own: one encoder request and one UPDATE per row."""
+    cursor = connection.cursor()
+    for table, (kind, source, column, condition) in embeddings.TARGETS.items():
+        cursor.execute("SELECT id, indexed_at, %s FROM %s WHERE %s IS NULL AND %s" % (source, table, column, condition))
+        for row_id, indexed_at, content in cursor.fetchall():
+            vector = encoder.encode(kind, [content])[0]
+            cursor.execute("UPDATE %s SET %s = %%s::real[] WHERE id = %%s AND indexed_at = %%s" % (table, column),
+                           (vector, row_id, indexed_at))
+            connection.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--duplicates", type=float, default=0.3, help="share of posts repeating another post's content")
+    parser.add_argument("--request-ms", type=float, default=20)
+    parser.add_argument("--item-ms", type=float, default=2)
+    args = parser.parse_args()
+
+    tasks.author_cache = AuthorCache(Redis.from_url(BENCH_REDIS_URL))
+    connection = connect()
+    seed(connection, args.posts, args.duplicates, random.Random(7))
+    cursor = connection.cursor()
+    cursor.execute("SELECT (SELECT COUNT(*) FROM posts WHERE content <> '') + (SELECT COUNT(*) FROM attachments)")
+    rows = cursor.fetchone()[0]
+    connection.commit()
+
+    redis = Redis.from_url(BENCH_REDIS_URL)
+    for key in redis.scan_iter(embeddings.EmbeddingCache.REDIS_PREFIX + "bench:*"):
+        redis.delete(key)
+
+    results = []
+    encoder = SlowEncoder(args.request_ms, args.item_ms)
+    with Timer() as t:
+        one_by_one(connection, encoder)
+    results.append(("one by one", t.elapsed, encoder.items))
+
+    for name in ("pipeline, cold cache", "pipeline, warm cache"):
+        reset_embeddings(connection)
+        encoder = SlowEncoder(args.request_ms, args.item_ms)
+        with Timer() as t:
+            embeddings.embed_pending(connection, encoder, embeddings.EmbeddingCache(redis, encoder.name))
+        results.append((name, t.elapsed, encoder.items))
+
+    print("%d rows to embed" % rows)
+    print("%-22s %9s %9s %10s" % ("", "seconds", "rows/s", "encoded"))
+    for name, elapsed, items in results:
+        print("%-22s %9.1f %9.0f %10d" % (name, elapsed, rows / elapsed, items))
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
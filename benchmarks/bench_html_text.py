@@ -0,0 +1,102 @@
+"""Checks html_text.strip_tags against the HTMLParser stripper on a corpus of Mastodon-style post
+HTML, in both modes, then reports strips/sec of each.
+
+    python benchmarks/bench_html_text.py --posts 20000 --sample recorded_posts.jsonl
+
+--sample adds the "content" of each JSON line (scraper buffer or status shape) to the corpus.
+Exits non-zero if any document strips differently.
+"""
+import argparse
+import json
+import random
+import sys
+
+from common import Timer, WORDS
+
+from html_text import parse_strip_tags, strip_tags
+
+EDGE_CASES = [
+    "", "plain text", "plain text\n\n", "plain &amp; text", "ends with &am", "a < b > c", "<p>x &am</p>",
+    "<p>unclosed", "<p>a</p><!-- comment --><p>b</p>", "<script>alert('<p>')</script>",
+    "<p>a<br>b<br/>c<br />d</p>", "</br>", "<P CLASS=\"x\">upper</P>", "<p/>", "<p>&lt;p&gt; &#39;quoted&#x27; &nbsp;</p>",
+    "<a href=unquoted>x</a>", "<a href=\"x>y\">z</a>", "<p>emoji 🐘 ünïcödé</p>", "<img src=\"x.png\">after",
+    "<p>&notanentity; &amp</p>", "<pre><code>x &lt; y</code></pre>", "<ul><li>a</li><li>b</li></ul>",
+]
+
+
+def mention(rng):
+    user = "user%d" % rng.randrange(1000)
+    return ("<span class=\"h-card\" translate=\"no\"><a href=\"https://example.social/@%s\" class=\"u-url mention\">"
+            "@<span>%s</span></a></span>" % (user, user))
+
+
+def hashtag(rng):
+    tag = rng.choice(WORDS)
+    return ("<a href=\"https://example.social/tags/%s\" class=\"mention hashtag\" rel=\"tag\">#<span>%s</span></a>"
+            % (tag, tag))
+
+
+def link(rng):
+    path = "/".join(rng.choice(WORDS) for _ in range(3))
+    return ("<a href=\"https://example.org/%s\" target=\"_blank\" rel=\"nofollow noopener noreferrer\" translate=\"no\">"
+            "<span class=\"invisible\">https://</span><span class=\"ellipsis\">example.org/%s</span>"
+            "<span class=\"invisible\"></span></a>" % (path, path[:20]))
+
+
+def make_post(rng):
+    paragraphs = []
+    for _ in range(rng.randint(1, 4)):
+        pieces = []
+        for _ in range(rng.randint(1, 25)):
+            roll = rng.random()
+            if roll < 0.05:
+                pieces.append(mention(rng))
+            elif roll < 0.1:
+                pieces.append(hashtag(rng))
+            elif roll < 0.13:
+                pieces.append(link(rng))
+            elif roll < 0.16:
+                pieces.append(rng.choice(("&amp;", "&lt;3", "&quot;quoted&quot;", "it&#39;s", "&gt;")))
+            elif roll < 0.18:
+                pieces.append("<br />")
+            else:
+                pieces.append(rng.choice(WORDS))
+        paragraphs.append("<p>%s</p>" % " ".join(pieces))
+    return "".join(paragraphs)
+
+
+def load_sample(path):
+    with open(path) as f:
+        return [json.loads(line)["content"] for line in f if line.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--sample")
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    corpus = EDGE_CASES + [make_post(rng) for _ in range(args.posts)]
+    if args.sample:
+        corpus += load_sample(args.sample)
+
+    mismatches = 0
+    for breaks in (False, True):
+        for html in corpus:
+            if strip_tags(html, breaks) != parse_strip_tags(html, breaks):
+                mismatches += 1
+                print("MISMATCH (breaks=%s): %r" % (breaks, html))
+    print("golden corpus: %d documents, %d mismatches" % (len(corpus), mismatches))
+
+    for name, strip in (("htmlparser", parse_strip_tags), ("fast", strip_tags)):
+        with Timer() as t:
+            for html in corpus:
+                strip(html, True)
+        print("%-10s %9.0f strips/sec" % (name, len(corpus) / t.elapsed))
+
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,87 @@
+"""Formatting cost of a page of posts: the old nested posts x attachments loop against hydrate.format_post
+on rows whose attachments Postgres already grouped (the json_agg column is parsed here, as psycopg would).
+
+    python benchmarks/bench_hydrate.py --posts 50,500 --attachments 4
+"""
+import argparse
+import json
+import random
+import uuid
+from datetime import datetime
+
+from common import Timer
+
+import hydrate
+
+
+def old_format(posts, attachments):
+    """What /api/search did with its separate posts and attachments result sets."""
+    formatted_posts = []
+    for post in posts:
+        attachments_for_post = []
+        for attachment in attachments:
+            if attachment[0] == post[0]:
+                attachments_for_post.append({
+                    "id": str(attachment[0]),
+                    "description": attachment[1],
+                    "url": attachment[2]
+                })
+
+        formatted_posts.append({
+            "id": str(post[0]),
+            "content": post[1],
+            "username": post[2],
+            "post_url": post[3],
+            "indexed_at": int(post[4].timestamp())*1000,
+            "attachments": attachments_for_post,
+            "author_id": post[5]
+        })
+    return formatted_posts
+
+
+def new_format(rows):
+    return [hydrate.format_post(row[:6] + (json.loads(row[6]),)) for row in rows]
+
+
+def normalized(formatted_posts):
+    # The old loop kept the attachments in whatever order the second query returned them
+    return [dict(post, attachments=sorted(post["attachments"], key=lambda a: a["url"])) for post in formatted_posts]
+
+
+def make_rows(n, attachments_per_post, rng):
+    posts, attachments, rows = [], [], []
+    for i in range(n):
+        post_id = uuid.UUID(int=rng.getrandbits(128))
+        post = (post_id, "post %d " % i * 10, "user%d" % (i % 100), "https://example.social/@u/%d" % i, datetime.now(), i % 100)
+        post_attachments = [(post_id, "description %d" % a, "https://media.example.social/%d_%d.jpg" % (i, a))
+                            for a in range(rng.randint(0, 2 * attachments_per_post))]
+        posts.append(post)
+        attachments.extend(post_attachments)
+        rows.append(post + (json.dumps([{"id": str(a[0]), "description": a[1], "url": a[2]} for a in post_attachments]),))
+    rng.shuffle(attachments)
+    return posts, attachments, rows
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", default="50,500", help="comma-separated page sizes")
+    parser.add_argument("--attachments", type=int, default=4, help="mean attachments per post")
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(1)
+    for n in (int(n) for n in args.posts.split(",")):
+        posts, attachments, rows = make_rows(n, args.attachments, rng)
+        assert normalized(old_format(posts, attachments)) == normalized(new_format(rows))
+        results = {}
+        for name, run in (("nested", lambda: old_format(posts, attachments)), ("hydrate", lambda: new_format(rows))):
+            with Timer() as t:
+                for _ in range(args.repeat):
+                    run()
+            results[name] = t.elapsed / args.repeat * 1000
+        print("%4d posts, %5d attachments  nested %8.3f ms  hydrate %8.3f ms  speedup %.1fx"
+              % (n, len(attachments), results["nested"], results["hydrate"], results["nested"] / results["hydrate"]))
+
+
+if __name__ == "__main__":
+    main()
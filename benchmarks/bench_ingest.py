@@ -0,0 +1,51 @@
+"""Posts/sec of tasks.ingest_rows (per-row) against tasks.ingest_rows_bulk on a local Postgres.
+
+    BENCH_DSN="dbname=fedibgs_bench ..." python benchmarks/bench_ingest.py --posts 20000 --duplicates 0.2
+"""
+import argparse
+
+from redis import Redis
+
+from common import BENCH_REDIS_URL, Timer, batched, connect, make_datasets, reset_schema
+
+import tasks
+from author_cache import AuthorCache
+
+
+def run(ingest, datasets, batch_size):
+    connection = connect()
+    reset_schema(connection)
+    tasks.author_cache.clear(shared=True)
+    with Timer() as t:
+        for batch in batched(datasets, batch_size):
+            ingest(connection, batch)
+    cursor = connection.cursor()
+    cursor.execute("SELECT (SELECT COUNT(*) FROM posts), (SELECT COUNT(*) FROM attachments)")
+    posts, attachments = cursor.fetchone()
+    connection.close()
+    return t.elapsed, posts, attachments
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--duplicates", type=float, default=0.1)
+    parser.add_argument("--authors", type=int, default=2000)
+    args = parser.parse_args()
+
+    datasets = make_datasets(args.posts, duplicate_ratio=args.duplicates, n_authors=args.authors)
+    tasks.logger.disabled = True
+    tasks.author_cache = AuthorCache(Redis.from_url(BENCH_REDIS_URL))
+
+    results = {}
+    for name, ingest in (("row", tasks.ingest_rows), ("bulk", tasks.ingest_rows_bulk)):
+        elapsed, posts, attachments = run(ingest, datasets, args.batch_size)
+        results[name] = args.posts / elapsed
+        print("%-5s %8.0f posts/sec  (%.2fs, %d posts, %d attachments stored)"
+              % (name, results[name], elapsed, posts, attachments))
+    print("speedup %.1fx" % (results["bulk"] / results["row"]))
+
+
+if __name__ == "__main__":
+    main()
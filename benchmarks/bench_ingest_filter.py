@@ -0,0 +1,83 @@
+"""Postgres round trips per 10k posts of ingest with and without the Redis ingest filter, at several
+duplicate ratios, counted at the connection, with the time each run took. With the filter on, each batch
+also makes pipelined Redis round trips: a check and a mark in row mode, only the mark in bulk mode.
+
+    BENCH_DSN="dbname=fedibgs_bench ..." python benchmarks/bench_ingest_filter.py --posts 10000 --ratios 0,0.1,0.3,0.5
+"""
+import argparse
+import contextlib
+import io
+
+import psycopg
+from redis import Redis
+
+from common import BENCH_DSN, BENCH_REDIS_URL, Timer, batched, connect, make_datasets, reset_schema
+
+import dedup
+import tasks
+from author_cache import AuthorCache
+
+
+class CountingCursor(psycopg.Cursor):
+    def execute(self, *args, **kwargs):
+        self.connection.round_trips += 1
+        return super().execute(*args, **kwargs)
+
+
+class CountingConnection(psycopg.Connection):
+    round_trips = 0
+
+    def commit(self):
+        self.round_trips += 1
+        return super().commit()
+
+
+def run(ingest, datasets, batch_size, ingest_filter):
+    connection = connect()
+    reset_schema(connection)
+    connection.close()
+    tasks.author_cache.clear(shared=True)
+    tasks.ingest_filter = ingest_filter
+    if ingest_filter:
+        for key in ingest_filter.redis.scan_iter(ingest_filter.REDIS_PREFIX + "*"):
+            ingest_filter.redis.delete(key)
+    false_positives = dedup.ingest_filter_false_positives._value.get()
+
+    connection = CountingConnection.connect(BENCH_DSN, cursor_factory=CountingCursor)
+    with Timer() as t, contextlib.redirect_stdout(io.StringIO()):
+        for batch in batched(datasets, batch_size):
+            ingest(connection, batch)
+    round_trips = connection.round_trips
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(*) FROM posts")
+    stored = cursor.fetchone()[0]
+    connection.close()
+    return round_trips, t.elapsed, stored, dedup.ingest_filter_false_positives._value.get() - false_positives
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=10000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    parser.add_argument("--ratios", default="0,0.1,0.3,0.5", help="comma-separated duplicate ratios")
+    parser.add_argument("--authors", type=int, default=2000)
+    args = parser.parse_args()
+
+    tasks.logger.disabled = True
+    tasks.author_cache = AuthorCache(Redis.from_url(BENCH_REDIS_URL))
+    ingest_filter = dedup.IngestFilter(Redis.from_url(BENCH_REDIS_URL))
+
+    print("%-6s %-5s %-10s %12s %14s %9s %8s %6s" % ("dups", "mode", "filter", "round trips", "per 10k posts", "seconds",
+                                                   "stored", "fp"))
+    for ratio in (float(ratio) for ratio in args.ratios.split(",")):
+        datasets = make_datasets(args.posts, duplicate_ratio=ratio, n_authors=args.authors)
+        for mode, ingest in (("row", tasks.ingest_rows), ("bulk", tasks.ingest_rows_bulk)):
+            for name, use_filter in (("off", None), ("on", ingest_filter)):
+                round_trips, elapsed, stored, false_positives = run(ingest, datasets, args.batch_size, use_filter)
+                print("%-6.2f %-5s %-10s %12d %14.0f %9.2f %8d %6d" % (ratio, mode, name, round_trips,
+                                                                       round_trips * 10000 / args.posts, elapsed,
+                                                                       stored, false_positives))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""Serialization time and bytes of a typical 50-post page: FastAPI's jsonable_encoder + JSONResponse against
+responses.encode, plus a /stream tick serialized per client (websocket.send_json) against once per tick.
+
+    python benchmarks/bench_json.py --posts 50 --clients 300
+"""
+import argparse
+import json
+import uuid
+from datetime import datetime
+
+from fastapi.encoders import jsonable_encoder
+from starlette.responses import JSONResponse
+
+from common import Timer, make_datasets
+
+import hydrate
+import responses
+from html_text import strip_tags
+
+
+def make_page(n):
+    """A search page as hydrate.format_post builds it."""
+    posts = []
+    for i, dataset in enumerate(make_datasets(n, attachment_ratio=0.5)):
+        post = hydrate.format_post((uuid.UUID(dataset["id"]), strip_tags(dataset["content"]), dataset["author"]["username"],
+                                    dataset["postURL"], datetime.now(), i,
+                                    [{"id": dataset["id"], "description": a["description"], "url": a["url"]}
+                                     for a in dataset["attachments"]]))
+        posts.append(post)
+    return {"posts": posts, "next_cursor": "MjAyNC0wOC0wMVQxMjowMDowMHwxMjM0", "total_result_count": 1000,
+            "total_result_count_capped": True}
+
+
+def timed(run, repeat):
+    with Timer() as t:
+        for _ in range(repeat):
+            result = run()
+    return t.elapsed / repeat * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=50)
+    parser.add_argument("--clients", type=int, default=300, help="stream subscribers for the per-tick comparison")
+    parser.add_argument("--repeat", type=int, default=500)
+    args = parser.parse_args()
+
+    page = make_page(args.posts)
+    paths = (
+        ("jsonable_encoder+JSONResponse", lambda: JSONResponse(jsonable_encoder(page)).body),
+        ("responses.encode", lambda: responses.encode(page)),
+    )
+    baseline = None
+    for name, run in paths:
+        ms, body = timed(run, args.repeat)
+        baseline = baseline or ms
+        print("%-30s %8.3f ms  %7d bytes  %5.1fx" % (name, ms, len(body), baseline / ms))
+
+    # Before: every subscriber's loop serialized its own copy. Now: one encode per tick, shared by all
+    per_client, _ = timed(lambda: [json.dumps(page, separators=(",", ":"), ensure_ascii=False) for _ in range(args.clients)],
+                          max(1, args.repeat // 50))
+    once, _ = timed(lambda: responses.encode(page).decode("utf-8"), args.repeat)
+    print("stream tick, %d clients: per client %8.3f ms  once %8.3f ms" % (args.clients, per_client, once))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""The hot queries on an unpartitioned posts/attachments table against the same rows after partitions.migrate,
+plus the cost of removing the oldest days: DELETE on the old tables, dropping partitions on the new ones.
+
+    BENCH_DSN="dbname=fedibgs_bench ..." python benchmarks/bench_partitions.py --posts 2000000 --days 60
+"""
+import argparse
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import psycopg
+
+from common import WORDS, Timer, async_connect, connect, percentile, reset_schema
+
+import hydrate
+import partitions
+import post_search
+
+# posts and attachments as they were before partitioning
+LEGACY_TABLES = """
+CREATE TABLE posts (
+       id UUID PRIMARY KEY,
+       content TEXT NOT NULL,
+       post_url TEXT NOT NULL,
+       tags JSONB NOT NULL,
+       author_id INT NOT NULL,
+       indexed_at TIMESTAMPTZ DEFAULT NOW(),
+       content_ts tsvector GENERATED ALWAYS AS (to_tsvector('english', content)) STORED,
+       FOREIGN KEY (author_id) REFERENCES authors(id)
+);
+CREATE TABLE attachments (
+     id SERIAL PRIMARY KEY,
+     post_id UUID NOT NULL,
+     description TEXT,
+     description_ts tsvector GENERATED ALWAYS AS (to_tsvector('english', description)) STORED,
+     url TEXT NOT NULL,
+     indexed_at TIMESTAMPTZ DEFAULT NOW(),
+     FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+);
+CREATE INDEX posts_author_id_idx ON posts(author_id);
+CREATE INDEX post_created_at_idx ON posts(indexed_at);
+CREATE INDEX posts_text_idx ON posts USING GIN(content_ts);
+CREATE INDEX posts_indexed_at_id_idx ON posts(indexed_at DESC, id DESC);
+CREATE INDEX attachments_post_id_idx ON attachments(post_id)
+"""
+
+
+def seed(connection, n, days):
+    reset_schema(connection)
+    connection.autocommit = True
+    connection.execute("DROP TABLE posts, attachments CASCADE")
+    for statement in LEGACY_TABLES.split(";\n"):
+        connection.execute(statement)
+    words = "(ARRAY[%s])" % ", ".join("'%s'" % word for word in WORDS)
+    connection.execute("INSERT INTO authors (url, username) SELECT 'https://example.social/@user' || i, 'user' || i "
+                       "FROM generate_series(1, 10000) AS i")
+    # Evenly spread over the last `days` days, newest first in generation order like a live firehose
+    connection.execute(
+        "INSERT INTO posts (id, content, post_url, tags, author_id, indexed_at) "
+        "SELECT md5(i::text)::uuid, {words}[1 + i %% 20] || ' ' || {words}[1 + (i / 20) %% 20] || ' ' || {words}[1 + (i / 7) %% 20], "
+        "'https://example.social/@u/' || i, '[]', 1 + i %% 10000, "
+        "now() - make_interval(secs => i::float8 / %s * %s * 86400) "
+        "FROM generate_series(1, %s) AS i".format(words=words), (n, days, n))
+    connection.execute("INSERT INTO attachments (post_id, description, url, indexed_at) "
+                       "SELECT id, 'a photo', post_url || '.jpg', indexed_at FROM posts WHERE abs(hashtext(post_url)) % 10 < 3")
+    connection.execute("VACUUM ANALYZE")
+    connection.autocommit = False
+
+
+async def queries(cursor):
+    """name -> coroutine factory for each query being compared."""
+    await cursor.execute("SELECT indexed_at, id FROM posts ORDER BY indexed_at DESC, id DESC OFFSET 20000 LIMIT 1")
+    deep = await cursor.fetchone()
+    await cursor.execute("SELECT array_agg(id) FROM (SELECT id FROM posts ORDER BY indexed_at DESC LIMIT 50) AS recent")
+    recent_ids = (await cursor.fetchone())[0]
+
+    async def search_first():
+        await post_search.search_posts(cursor, "coffee")
+
+    async def search_deep():
+        await post_search.search_posts(cursor, "coffee", after=deep)
+
+    async def author_page():
+        await cursor.execute(hydrate.select_posts("WHERE posts.author_id = %s ORDER BY posts.indexed_at DESC LIMIT 50"), (42,))
+        await cursor.fetchall()
+
+    async def stream_fetch():
+        await cursor.execute(hydrate.select_posts("WHERE posts.id = ANY(%s::uuid[]) AND posts.indexed_at > now() - interval '1 day' "
+                                                  "ORDER BY posts.indexed_at DESC LIMIT 50"), (recent_ids,))
+        await cursor.fetchall()
+
+    async def week_count():
+        await cursor.execute("SELECT COUNT(*) FROM posts WHERE indexed_at > now() - interval '7 days'")
+        await cursor.fetchone()
+
+    return {"search": search_first, "search deep": search_deep, "author page": author_page,
+            "stream fetch": stream_fetch, "7 day count": week_count}
+
+
+async def measure(repeat):
+    connection = await async_connect(autocommit=True)
+    results = {}
+    for name, run in (await queries(connection.cursor())).items():
+        samples = []
+        for _ in range(repeat):
+            with Timer() as t:
+                await run()
+            samples.append(t.elapsed * 1000)
+        results[name] = (percentile(samples, 50), percentile(samples, 99))
+    await connection.close()
+    return results
+
+
+def time_removal(connection, remove):
+    """Seconds remove() takes inside a transaction that is rolled back, so the rows stay for what follows."""
+    try:
+        with connection.transaction():
+            with Timer() as t:
+                remove()
+            raise psycopg.Rollback()
+    finally:
+        connection.rollback()
+    return t.elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=2000000)
+    parser.add_argument("--days", type=int, default=60)
+    parser.add_argument("--retention-days", type=int, default=30)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    connection = connect()
+    with Timer() as t:
+        seed(connection, args.posts, args.days)
+    print("seeded %d posts over %d days in %.1fs" % (args.posts, args.days, t.elapsed))
+
+    before = asyncio.run(measure(args.repeat))
+    cutoff = datetime.now(timezone.utc) - timedelta(days=args.retention_days)
+    delete = time_removal(connection, lambda: connection.execute("DELETE FROM posts WHERE indexed_at < %s", (cutoff,)))
+
+    with Timer() as t:
+        partitions.migrate(connection)
+    print("migrated in %.1fs" % t.elapsed)
+    connection.autocommit = True
+    connection.execute("VACUUM ANALYZE")
+    connection.autocommit = False
+
+    after = asyncio.run(measure(args.repeat))
+    drop = time_removal(connection, lambda: partitions.apply_retention(connection, args.retention_days, drop=True))
+
+    print("%-14s %14s %14s" % ("query", "before p50/p99", "after p50/p99"))
+    for name in before:
+        print("%-14s %6.2f/%-7.2f %6.2f/%-7.2f" % (name, *before[name], *after[name]))
+    print("remove rows older than %d days: DELETE %.2fs, drop partitions %.2fs" % (args.retention_days, delete, drop))
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,190 @@
+"""End-to-end posts/sec, ingest lag and CPU time per stage of scraper -> Redis -> tasks.ingest_batch -> Postgres,
+replaying a recording (see firehose.py) through the scraper against local Redis and Postgres.
+
+    BENCH_DSN="dbname=fedibgs_bench ..." BENCH_REDIS_URL=redis://localhost:6379/15 \\
+        python benchmarks/bench_pipeline.py --file public.sse.gz --speed 0 --workers 4
+
+The scraper runs in this process on the code of scrape.py, the ingest runs in a Celery worker started with
+--workers threads. Lag runs from the stand-in sending an event to the worker announcing the committed post
+on the new posts channel. CPU time is taken per scraper thread (stream reader, attachment resolver,
+batcher), for the worker process and for the Postgres backends of the benchmark database, which assumes
+Postgres runs on this machine. Without --file a synthetic recording of --events events is used.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from redis import Redis
+
+from common import BENCH_DSN, BENCH_REDIS_URL, ROOT, connect, percentile, post_uuid, reset_schema
+
+import firehose
+from broadcast import NEW_POSTS_CHANNEL
+
+# Scraper threads by name prefix, see scrape.py, attachment_resolver.py and batcher.py
+SCRAPER_STAGES = (("stream-", "stream"), ("resolver", "resolve"), ("batcher-", "batch+enqueue"))
+
+
+def process_cpu(pid):
+    """User + system CPU seconds of a process on this machine, from /proc."""
+    try:
+        with open("/proc/%d/stat" % pid) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+    except OSError:
+        return None
+    return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+
+
+def thread_cpu():
+    """{stage: CPU seconds} of the scraper threads that are alive."""
+    stages = {}
+    for thread in threading.enumerate():
+        for prefix, stage in SCRAPER_STAGES:
+            if thread.name.startswith(prefix):
+                try:
+                    seconds = time.clock_gettime(time.pthread_getcpuclockid(thread.ident))
+                except OSError:
+                    continue
+                stages[stage] = stages.get(stage, 0.0) + seconds
+    return stages
+
+
+def postgres_cpu(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT pid FROM pg_stat_activity WHERE datname = current_database() AND pid <> pg_backend_pid()")
+    seconds = [process_cpu(pid) for pid, in cursor.fetchall()]
+    if not seconds or None in seconds:
+        return None
+    return sum(seconds)
+
+
+def start_worker(workers, env, log):
+    worker = subprocess.Popen([sys.executable, "-m", "celery", "-A", "tasks", "worker", "--pool", "threads",
+                               "--concurrency", str(workers), "--loglevel", "info", "--without-gossip",
+                               "--without-mingle", "--without-heartbeat"],
+                              cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+    deadline = time.monotonic() + 120
+    while time.monotonic() < deadline:
+        with open(log.name) as f:
+            if " ready." in f.read():
+                return worker
+        if worker.poll() is not None:
+            break
+        time.sleep(0.2)
+    worker.kill()
+    raise SystemExit("Celery worker did not start, see %s" % log.name)
+
+
+def listen(redis, published, stop):
+    """Appends (time, post ID) of every post the workers announce."""
+    pubsub = redis.pubsub(ignore_subscribe_messages=True)
+    pubsub.subscribe(NEW_POSTS_CHANNEL)
+    while not stop.is_set():
+        message = pubsub.get_message(timeout=0.1)
+        if message:
+            now = time.monotonic()
+            published.extend((now, post_id) for post_id in json.loads(message["data"]))
+    pubsub.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", help="recording to replay, see firehose.py")
+    parser.add_argument("--events", type=int, default=20000, help="events of the synthetic recording without --file")
+    parser.add_argument("--speed", type=float, default=0, help="times the recorded pace, 0 for as fast as possible")
+    parser.add_argument("--workers", type=int, default=4, help="threads of the Celery worker")
+    parser.add_argument("--attachments", type=float, default=0.3, help="share of updates to add an image to")
+    parser.add_argument("--duplicates", type=float, default=0.1, help="share of updates to send twice")
+    parser.add_argument("--media-latency", type=int, default=20, help="ms the media stand-in takes per HEAD")
+    parser.add_argument("--drain", type=float, default=10, help="seconds without new posts that end the run, once nothing is left to ingest")
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix="bench_pipeline")
+    path = args.file
+    if not path:
+        path = os.path.join(scratch, "synthetic.sse.gz")
+        firehose.synthesize(path, args.events)
+
+    connection = connect()
+    reset_schema(connection)
+    connection.autocommit = True
+    redis = Redis.from_url(BENCH_REDIS_URL)
+    # Broker queue, author cache, ingest filter and counters of earlier runs
+    redis.flushdb()
+
+    # The scraper (here) and the worker share the benchmark database and Redis
+    env = dict(os.environ, DB_CONNINFO=BENCH_DSN, REDIS_URL=BENCH_REDIS_URL, BATCH_SPILL_DIR=os.path.join(scratch, "spill"))
+    os.environ.update(env)
+    log = open(os.path.join(scratch, "worker.log"), "w")
+    worker = start_worker(args.workers, env, log)
+
+    server, first_index, media = firehose.replay(path, args.speed, media_latency=args.media_latency,
+                                                 attachment_ratio=args.attachments, duplicate_ratio=args.duplicates)
+    # scrape.py takes its endpoints from the command line and sets everything up on import
+    sys.argv = ["scrape.py", server.base_url]
+    import scrape
+
+    published = []
+    stop = threading.Event()
+    listener = threading.Thread(target=listen, args=(redis, published, stop), daemon=True)
+    listener.start()
+
+    cpu_before = thread_cpu()
+    worker_before = process_cpu(worker.pid)
+    started = time.monotonic()
+    stream = threading.Thread(target=scrape.follow_stream, args=(server.base_url,), daemon=True,
+                              name="stream-" + server.base_url)
+    stream.start()
+
+    server.finished.wait()
+    spill_dir = env["BATCH_SPILL_DIR"]
+    last_count = 0
+    quiet_since = time.monotonic()
+    while time.monotonic() - quiet_since < args.drain:
+        time.sleep(0.5)
+        # Posts still buffered, spilled or queued for the worker will turn up
+        busy = len(scrape.batcher) or not scrape.batcher.pending.empty() or os.listdir(spill_dir) or redis.llen("celery")
+        if busy or len(published) != last_count:
+            last_count = len(published)
+            quiet_since = time.monotonic()
+
+    stages = {stage: seconds - cpu_before.get(stage, 0.0) for stage, seconds in thread_cpu().items()}
+    stages["ingest worker"] = process_cpu(worker.pid) - worker_before
+    stages["postgres"] = postgres_cpu(connection)
+
+    scrape.stop_streams.set()
+    stop.set()
+    server.stopped = True
+    worker.terminate()
+    worker.wait(30)
+    server.shutdown()
+    media.shutdown()
+
+    sent_at = {post_uuid(url): server.sent_at[index] for url, index in first_index.items() if url}
+    lags = [(at - sent_at[post_id]) * 1000 for at, post_id in published if post_id in sent_at]
+    cursor = connection.cursor()
+    cursor.execute("SELECT (SELECT COUNT(*) FROM posts), (SELECT COUNT(*) FROM attachments)")
+    posts, attachments = cursor.fetchone()
+    connection.close()
+
+    elapsed = max(at for at, _ in published) - started if published else 0.0
+    print("%d events replayed, %d posts and %d attachments stored in %.1fs"
+          % (len(server.events), posts, attachments, elapsed))
+    print("%.0f posts/sec end to end" % (posts / elapsed if elapsed else 0))
+    print("ingest lag p50 %.0f ms  p90 %.0f ms  p99 %.0f ms  max %.0f ms"
+          % (percentile(lags, 50), percentile(lags, 90), percentile(lags, 99), max(lags or [0])))
+    print("%-16s %10s %12s" % ("CPU", "seconds", "ms per post"))
+    for stage, seconds in stages.items():
+        if seconds is None:
+            print("%-16s %10s %12s" % (stage, "-", "-"))
+        else:
+            print("%-16s %10.2f %12.3f" % (stage, seconds, seconds * 1000 / max(1, posts)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""Recovery time of streaming.stream_timeline against a local SSE stand-in that drops connections,
+stalls without heartbeats and answers with 5xx.
+
+    python benchmarks/bench_reconnect.py --idle-timeout 3 --cycles 5
+"""
+import argparse
+import json
+import logging
+import threading
+import time
+
+from common import percentile
+from tests.standins import serve_sse
+
+from streaming import Backoff, SupervisedListener, stream_timeline
+
+
+def make_event(n, connection):
+    return "update", json.dumps({"id": "%d:%d" % (connection, n), "url": "https://example.social/@a/%d" % n, "content": "<p>%d</p>" % n,
+                                 "in_reply_to_id": None, "reblog": None, "media_attachments": [], "tags": [],
+                                 "account": {"url": "https://example.social/@a", "username": "a"}})
+
+
+class TimingListener(SupervisedListener):
+    def __init__(self, received):
+        super().__init__()
+        self.received = received
+
+    def on_update(self, status):
+        self.received.append((time.monotonic(), int(status.id.split(":")[0])))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cycles", type=int, default=3)
+    parser.add_argument("--events", type=int, default=20)
+    parser.add_argument("--idle-timeout", type=int, default=3)
+    args = parser.parse_args()
+    logging.disable(logging.ERROR)
+
+    plan = []
+    for _ in range(args.cycles):
+        plan += [{"events": args.events, "then": "drop"},
+                 {"status": 503}, {"status": 502},
+                 {"events": args.events, "then": "stall"},
+                 {"events": args.events, "then": "drop"},
+                 {"status": 500}]
+    plan.append({"events": args.events, "then": "hold"})
+
+    server = serve_sse(make_event, plan, interval=0.002, heartbeat=0.5)
+    received = []
+    stop = threading.Event()
+    thread = threading.Thread(target=stream_timeline, daemon=True, kwargs=dict(
+        name="standin", endpoint=server.base_url + "/api/v1/streaming/public",
+        make_listener=lambda: TimingListener(received), idle_timeout=args.idle_timeout, stop=stop,
+        backoff=Backoff(initial=0.2, maximum=5)))
+    started = time.monotonic()
+    thread.start()
+
+    expected = args.events * (2 * args.cycles + args.cycles + 1)
+    while len(received) < expected and time.monotonic() - started < 600:
+        time.sleep(0.1)
+    stop.set()
+    server.stopped = True
+
+    recoveries = []
+    for failed_at, connection in server.failures:
+        # First event from a later connection; events already in flight on the failed one don't count
+        after = [t for t, c in received if c > connection]
+        if after:
+            recoveries.append(min(after) - failed_at)
+    print("%d/%d events in %.1fs, %d failures injected" % (len(received), expected, time.monotonic() - started,
+                                                           len(server.failures)))
+    print("recovery p50 %.2fs  p99 %.2fs  max %.2fs  (idle timeout %ds)"
+          % (percentile(recoveries, 50), percentile(recoveries, 99), max(recoveries or [0]), args.idle_timeout))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
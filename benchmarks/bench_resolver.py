@@ -0,0 +1,96 @@
+"""Posts/sec of attachment resolution: serial requests.head on the stream thread (the old on_update)
+against AttachmentResolver, with local media hosts that are fast, redirecting, missing or slow.
+
+    python benchmarks/bench_resolver.py --posts 2000 --slow-ratio 0.05 --slow-ms 1500
+"""
+import argparse
+import logging
+import random
+import threading
+
+import requests
+
+from common import Timer
+from tests.standins import MediaHandler, serve
+
+from attachment_resolver import AttachmentResolver, head_attachment
+
+
+def make_posts(n, hosts, rng, slow_ratio, slow_ms):
+    posts = []
+    for i in range(n):
+        candidates = []
+        for a in range(rng.choice((0, 0, 1, 1, 2, 4))):
+            host = rng.choice(hosts)
+            roll = rng.random()
+            if roll < slow_ratio:
+                path = "slow/%d/%d_%d.jpg" % (slow_ms, i, a)
+            elif roll < 0.5:
+                path = "ok/%d_%d.jpg" % (i, a)
+            elif roll < 0.9:
+                path = "redirect/%d_%d.jpg" % (i, a)
+            else:
+                path = "missing/%d_%d.jpg" % (i, a)
+            candidates.append(("attachment %d" % a, "%s/%s" % (host, path)))
+        posts.append(({"id": i}, candidates))
+    return posts
+
+
+def run_serial(posts, timeout):
+    resolved = 0
+    with Timer() as t:
+        for post, candidates in posts:
+            for description, url in candidates:
+                if head_attachment(requests, url, timeout=timeout):
+                    resolved += 1
+    return t.elapsed, t.elapsed, resolved
+
+
+def run_resolver(posts, timeout, per_host):
+    resolver = AttachmentResolver(per_host=per_host, timeout=timeout)
+    finished = threading.Event()
+    lock = threading.Lock()
+    state = {"posts": 0, "attachments": 0}
+
+    def callback(post, attachments):
+        with lock:
+            state["posts"] += 1
+            state["attachments"] += len(attachments)
+            if state["posts"] == len(posts):
+                finished.set()
+
+    with Timer() as t:
+        with Timer() as reader:
+            for post, candidates in posts:
+                resolver.resolve_post(post, candidates, callback)
+        finished.wait()
+    resolver.shutdown()
+    return t.elapsed, reader.elapsed, state["attachments"]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=1000)
+    parser.add_argument("--hosts", type=int, default=4)
+    parser.add_argument("--slow-ratio", type=float, default=0.02)
+    parser.add_argument("--slow-ms", type=int, default=1500)
+    parser.add_argument("--timeout", type=float, default=2)
+    parser.add_argument("--per-host", type=int, default=4)
+    args = parser.parse_args()
+    logging.disable(logging.WARNING)
+
+    servers = [serve(MediaHandler) for _ in range(args.hosts)]
+    posts = make_posts(args.posts, [s.base_url for s in servers], random.Random(1), args.slow_ratio, args.slow_ms)
+
+    for name, run in (("serial", lambda: run_serial(posts, args.timeout)),
+                      ("resolver", lambda: run_resolver(posts, args.timeout, args.per_host))):
+        elapsed, reader, resolved = run()
+        print("%-8s %8.0f posts/sec  stream thread busy %.2fs of %.2fs  %d attachments resolved"
+              % (name, len(posts) / elapsed, reader, elapsed, resolved))
+
+    for server in servers:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
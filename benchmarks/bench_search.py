@@ -0,0 +1,122 @@
+"""p50/p99 latency of /api/search's old COUNT + OFFSET query against the keyset path, at the first page
+and at deep pages, on a local Postgres seeded with synthetic posts.
+
+    BENCH_DSN="dbname=fedibgs_bench ..." python benchmarks/bench_search.py --posts 200000 --depths 0,20,200
+"""
+import argparse
+import asyncio
+import random
+from datetime import timedelta
+
+import redis.asyncio
+from redis import Redis
+
+from common import BENCH_REDIS_URL, WORDS, Timer, async_connect, batched, connect, make_datasets, percentile, reset_schema
+
+import post_search
+import responses
+import tasks
+from author_cache import AuthorCache
+
+
+def seed(connection, n, batch_size=500):
+    reset_schema(connection)
+    tasks.author_cache.clear(shared=True)
+    for batch in batched(make_datasets(n, spread=timedelta(days=30)), batch_size):
+        tasks.ingest_rows_bulk(connection, batch)
+    connection.cursor().execute("ANALYZE")
+    connection.commit()
+
+
+async def old_search(cursor, q, page):
+    """The query pair /api/search ran before keyset pagination."""
+    await cursor.execute("SELECT COUNT(*) FROM posts WHERE posts.content_ts @@ websearch_to_tsquery('english', %s::text)", (q,))
+    await cursor.fetchone()
+    await cursor.execute(
+        "SELECT \"posts\".id AS id, content, a.username, post_url, date_part('epoch', indexed_at) AS indexed_at, a.id FROM (SELECT * FROM posts WHERE posts.content_ts @@ websearch_to_tsquery('english', %s::text)) AS posts "
+        "JOIN authors a on posts.author_id = a.id "
+        "ORDER BY indexed_at DESC LIMIT 50 OFFSET %s",
+        (q, page * post_search.PAGE_SIZE))
+    posts = await cursor.fetchall()
+    await cursor.execute("SELECT post_id, description, url FROM attachments WHERE post_id = ANY(%s)", ([post[0] for post in posts],))
+    await cursor.fetchall()
+
+
+async def page_cursors(cursor, q, depth):
+    """The cursor a client holds after paging through depth pages of q, None if q has fewer results."""
+    after = None
+    for _ in range(depth):
+        _, next_cursor = await post_search.search_posts(cursor, q, after=after)
+        if next_cursor is None:
+            return None
+        after = post_search.decode_cursor(next_cursor)
+    return after
+
+
+async def keyset_search(cursor, q, after, cap):
+    await post_search.count_matches(cursor, q, cap)
+    await post_search.search_posts(cursor, q, after=after)
+
+
+async def cached_search(cache, q):
+    await cache.get_page(q, None, 0)
+
+
+async def measure(run, queries, repeat):
+    samples = []
+    for _ in range(repeat):
+        for q in queries:
+            with Timer() as t:
+                await run(q)
+            samples.append(t.elapsed * 1000)
+    return percentile(samples, 50), percentile(samples, 99)
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=100000)
+    parser.add_argument("--depths", default="0,10,100", help="comma-separated page numbers to measure")
+    parser.add_argument("--queries", type=int, default=10)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--count-cap", type=int, default=1000)
+    parser.add_argument("--no-seed", action="store_true", help="reuse the posts of a previous run")
+    args = parser.parse_args()
+
+    tasks.logger.disabled = True
+    tasks.author_cache = AuthorCache(Redis.from_url(BENCH_REDIS_URL))
+    connection = connect()
+    if not args.no_seed:
+        with Timer() as t:
+            seed(connection, args.posts)
+        print("seeded %d posts in %.1fs" % (args.posts, t.elapsed))
+    connection.close()
+    connection = await async_connect()
+    cursor = connection.cursor()
+
+    rng = random.Random(2)
+    # Single common words match a large share of posts, pairs are more selective
+    queries = [rng.choice(WORDS) if i % 2 else "%s %s" % (rng.choice(WORDS), rng.choice(WORDS))
+               for i in range(args.queries)]
+
+    print("%-7s %-8s %10s %10s" % ("page", "path", "p50 ms", "p99 ms"))
+    for depth in (int(depth) for depth in args.depths.split(",")):
+        cursors = {q: await page_cursors(cursor, q, depth) for q in queries}
+        reachable = [q for q in queries if depth == 0 or cursors[q] is not None]
+        if not reachable:
+            print("%-7d no query has that many pages" % depth)
+            continue
+        old = await measure(lambda q: old_search(cursor, q, depth), reachable, args.repeat)
+        new = await measure(lambda q: keyset_search(cursor, q, cursors[q], args.count_cap), reachable, args.repeat)
+        print("%-7d %-8s %10.2f %10.2f" % (depth, "offset", old[0], old[1]))
+        print("%-7d %-8s %10.2f %10.2f" % (depth, "keyset", new[0], new[1]))
+
+    cache = post_search.SearchCache(redis.asyncio.Redis.from_url(BENCH_REDIS_URL))
+    for q in queries:
+        await cache.put_page(q, None, 0, responses.encode({"posts": (await post_search.search_posts(cursor, q))[0]}))
+    cached = await measure(lambda q: cached_search(cache, q), queries, args.repeat)
+    print("%-7d %-8s %10.2f %10.2f" % (0, "cached", cached[0], cached[1]))
+    await connection.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
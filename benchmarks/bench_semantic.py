@@ -0,0 +1,147 @@
+"""Recall@k against latency of the HNSW-backed semantic_search.search_posts, for a range of ef_search values,
+compared with the exact scan search.py did, on clustered synthetic embeddings in weekly partitions.
+
+    BENCH_DSN="dbname=fedibgs_bench ..." python benchmarks/bench_semantic.py --posts 200000 --dim 1024
+
+Runs on pgvecto.rs (the docker-compose image) with the index from init.sql. Where only pgvector is
+available the equivalent pgvector HNSW index and ef_search setting are used instead.
+"""
+import argparse
+import asyncio
+import math
+import random
+from datetime import datetime, timedelta, timezone
+
+from common import ROOT, WORDS, Timer, async_connect, connect, percentile, reset_schema
+
+import partitions
+import semantic_search
+
+PGVECTOR_INDEX = "CREATE INDEX posts_text_embedding_idx ON posts USING hnsw (text_embedding vector_cosine_ops) " \
+                 "WITH (m = 16, ef_construction = 100)"
+
+
+def unit(vector):
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+def make_vector(centers, rng, spread):
+    center = rng.choice(centers)
+    return unit([c + rng.gauss(0, spread) for c in center])
+
+
+def seed(connection, n, dim, clusters, spread, rng):
+    reset_schema(connection)
+    connection.autocommit = True
+    cursor = connection.cursor()
+    cursor.execute("SELECT extname FROM pg_extension WHERE extname IN ('vectors', 'vector')")
+    flavor = cursor.fetchone()
+    if flavor is None:
+        cursor.execute("CREATE EXTENSION vector")
+        flavor = "vector"
+    else:
+        flavor = flavor[0]
+    cursor.execute("ALTER TABLE posts DROP COLUMN IF EXISTS text_embedding")
+    cursor.execute("ALTER TABLE posts ADD COLUMN text_embedding vector(%d)" % dim)
+    connection.autocommit = False
+
+    now = datetime.now(timezone.utc)
+    partitions.ensure_partitions(connection, first=now - timedelta(days=28), now=now, premake=1)
+    words = "(ARRAY[%s])" % ", ".join("'%s'" % word for word in WORDS)
+    cursor.execute("INSERT INTO authors (url, username) VALUES ('https://example.social/@bench', 'bench')")
+    cursor.execute(
+        "INSERT INTO posts (id, content, post_url, tags, author_id, indexed_at) "
+        "SELECT md5(i::text)::uuid, {words}[1 + i %% 20] || ' ' || {words}[1 + (i / 20) %% 20], "
+        "'https://example.social/@bench/' || i, '[]', (SELECT min(id) FROM authors), "
+        "now() - make_interval(secs => i::float8 / %s * 28 * 86400) FROM generate_series(1, %s) AS i"
+        .format(words=words), (n, n))
+
+    centers = [unit([rng.gauss(0, 1) for _ in range(dim)]) for _ in range(clusters)]
+    cursor.execute("CREATE TEMP TABLE bench_vectors (i int, embedding real[])")
+    with cursor.copy("COPY bench_vectors FROM STDIN (FORMAT BINARY)") as copy:
+        copy.set_types(["int4", "float4[]"])
+        for i in range(1, n + 1):
+            copy.write_row((i, make_vector(centers, rng, spread / math.sqrt(dim))))
+    cursor.execute("UPDATE posts SET text_embedding = v.embedding FROM bench_vectors AS v WHERE posts.id = md5(v.i::text)::uuid")
+    connection.commit()
+
+    with Timer() as t:
+        connection.autocommit = True
+        if flavor == "vectors":
+            with open(ROOT + "/init.sql") as f:
+                cursor.execute(next(s for s in f.read().split(";\n") if "posts_text_embedding_idx" in s))
+        else:
+            cursor.execute("SET maintenance_work_mem = '1GB'")
+            cursor.execute(PGVECTOR_INDEX)
+            semantic_search.EF_SEARCH_SETTING = "hnsw.ef_search"
+        cursor.execute("VACUUM ANALYZE posts")
+    print("built the %s HNSW index in %.1fs" % ("pgvecto.rs" if flavor == "vectors" else "pgvector", t.elapsed))
+    return centers
+
+
+async def exact(connection, vector, k):
+    """What search.py ran: no index, every embedding compared."""
+    async with connection.transaction():
+        cursor = connection.cursor()
+        await cursor.execute("SET LOCAL enable_indexscan = off")
+        await cursor.execute("SELECT id FROM posts ORDER BY text_embedding <=> %s::real[]::vector LIMIT %s", (vector, k))
+        return [str(row[0]) for row in await cursor.fetchall()]
+
+
+async def timed(run, queries):
+    samples, results = [], []
+    for vector in queries:
+        with Timer() as t:
+            results.append(await run(vector))
+        samples.append(t.elapsed * 1000)
+    return percentile(samples, 50), percentile(samples, 99), results
+
+
+async def run(args, centers, rng):
+    queries = [make_vector(centers, rng, args.spread / math.sqrt(args.dim)) for _ in range(args.queries)]
+    connection = await async_connect(autocommit=True)
+
+    p50, p99, truth = await timed(lambda vector: exact(connection, vector, args.k), queries)
+    print("%-16s %8s %8s %8s" % ("", "recall", "p50 ms", "p99 ms"))
+    print("%-16s %8.3f %8.2f %8.2f" % ("exact scan", 1.0, p50, p99))
+
+    for ef in args.ef.split(","):
+        async def ann(vector):
+            posts = await semantic_search.search_posts(connection, "", vector, limit=args.k, hybrid=False, ef_search=int(ef))
+            return [post["id"] for post in posts]
+
+        p50, p99, found = await timed(ann, queries)
+        recall = sum(len(set(a) & set(b)) for a, b in zip(found, truth)) / (args.k * len(queries))
+        print("%-16s %8.3f %8.2f %8.2f" % ("hnsw ef=" + ef, recall, p50, p99))
+
+    async def hybrid(vector):
+        return await semantic_search.search_posts(connection, rng.choice(WORDS), vector, limit=args.k)
+
+    p50, p99, _ = await timed(hybrid, queries)
+    print("%-16s %8s %8.2f %8.2f" % ("hybrid", "-", p50, p99))
+    await connection.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=200000)
+    parser.add_argument("--dim", type=int, default=1024)
+    parser.add_argument("--clusters", type=int, default=100)
+    parser.add_argument("--spread", type=float, default=1.0, help="noise around each cluster center, relative to it")
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("-k", type=int, default=10)
+    parser.add_argument("--ef", default="10,20,40,80,160,320")
+    args = parser.parse_args()
+
+    rng = random.Random(3)
+    connection = connect()
+    with Timer() as t:
+        centers = seed(connection, args.posts, args.dim, args.clusters, args.spread, rng)
+    print("seeded %d posts in %.1fs" % (args.posts, t.elapsed))
+    connection.close()
+    asyncio.run(run(args, centers, rng))
+
+
+if __name__ == "__main__":
+    main()
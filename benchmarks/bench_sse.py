@@ -0,0 +1,145 @@
+"""Events/sec and memory per update of streaming.EventStreamListener against Mastodon.py's StreamListener,
+replaying a recorded streaming response from a file.
+
+    python benchmarks/bench_sse.py --record https://fedi.buzz/api/v1/streaming/public --seconds 60 --file public.sse
+    python benchmarks/bench_sse.py --file public.sse
+
+Without --record and with no file yet, a synthetic stream of --events events is written first: federated
+statuses in the shape Mastodon sends them, with deletes and edits mixed in the way relays deliver them.
+"""
+import argparse
+import json
+import os
+import random
+import time
+import tracemalloc
+
+import requests
+from mastodon import StreamListener
+
+from common import Timer, make_status
+
+from streaming import EventStreamListener
+
+# Bytes handed over per read, about what a socket read returns from a busy stream
+NETWORK_CHUNK = 16384
+
+
+def synthesize(path, n, delete_ratio, edit_ratio, rng):
+    with open(path, "wb") as f:
+        f.write(b":)\n")
+        for i in range(n):
+            roll = rng.random()
+            if roll < delete_ratio:
+                f.write(b"event: delete\ndata: %d\n\n" % rng.getrandbits(60))
+                continue
+            event = "status.update" if roll < delete_ratio + edit_ratio else "update"
+            f.write(("event: %s\ndata: %s\n\n" % (event, json.dumps(make_status(i, rng)))).encode("utf-8"))
+            if i % 100 == 0:
+                f.write(b":thump\n")
+
+
+def record(url, path, seconds):
+    deadline = time.monotonic() + seconds
+    with requests.get(url, headers={"Accept": "text/event-stream"}, stream=True, timeout=(10, 60)) as response, \
+            open(path, "wb") as f:
+        while time.monotonic() < deadline:
+            chunk = response.raw.read1(NETWORK_CHUNK, decode_content=True)
+            if not chunk:
+                break
+            f.write(chunk)
+
+
+class ReplayRaw:
+    def __init__(self, data):
+        self.data = data
+        self.position = 0
+
+    def read1(self, amt, decode_content=None):
+        chunk = self.data[self.position:self.position + min(amt, NETWORK_CHUNK)]
+        self.position += len(chunk)
+        return chunk
+
+
+class ReplayResponse:
+    """What both listeners read from a requests response: raw.read1() and iter_content()."""
+
+    def __init__(self, data):
+        self.data = data
+        self.raw = ReplayRaw(data)
+
+    def iter_content(self, chunk_size=1):
+        # Mastodon.py asks for one byte at a time
+        for position in range(0, len(self.data), chunk_size):
+            yield self.data[position:position + chunk_size]
+
+
+class MastodonSink(StreamListener):
+    def __init__(self, keep):
+        self.keep = keep
+        self.updates = []
+
+    def on_update(self, status):
+        if self.keep:
+            self.updates.append(status)
+        else:
+            self.updates.append(None)
+
+    def on_unknown_event(self, name, unknown_event=None):
+        pass
+
+
+class SlimSink(EventStreamListener):
+    def __init__(self, keep):
+        self.keep = keep
+        self.updates = []
+
+    def on_update(self, status):
+        self.updates.append(status if self.keep else None)
+
+
+def replay(make_listener, data, sample):
+    listener = make_listener(False)
+    with Timer() as t:
+        listener.handle_stream(ReplayResponse(data))
+    updates = len(listener.updates)
+
+    # What every decoded update occupies while it is being handled, in a second pass over the first events
+    # that keeps them; tracing slows Mastodon.py down several times over
+    tracemalloc.start()
+    listener = make_listener(True)
+    listener.handle_stream(ReplayResponse(sample))
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return t.elapsed, updates, memory / max(1, len(listener.updates))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--file", default="stream.sse")
+    parser.add_argument("--record", help="streaming endpoint to record into --file first")
+    parser.add_argument("--seconds", type=float, default=60)
+    parser.add_argument("--events", type=int, default=2000, help="events of a synthetic stream")
+    parser.add_argument("--delete-ratio", type=float, default=0.4)
+    parser.add_argument("--edit-ratio", type=float, default=0.05)
+    parser.add_argument("--memory-sample", type=int, default=1 << 20, help="bytes of the stream to measure memory on")
+    args = parser.parse_args()
+
+    if args.record:
+        record(args.record, args.file, args.seconds)
+    elif not os.path.exists(args.file):
+        synthesize(args.file, args.events, args.delete_ratio, args.edit_ratio, random.Random(5))
+    with open(args.file, "rb") as f:
+        data = f.read()
+    sample = data[:data.rfind(b"\n\n", 0, args.memory_sample) + 2]
+    events = data.count(b"\nevent:") + data.startswith(b"event:")
+    print("%d events, %.1f MiB" % (events, len(data) / 2 ** 20))
+
+    for name, make_listener in (("Mastodon.py", MastodonSink), ("slim", SlimSink)):
+        elapsed, updates, per_update = replay(make_listener, data, sample)
+        print("%-12s %9.0f events/sec  %7.0f updates/sec  %6.1f KiB per update  (%d updates)"
+              % (name, events / elapsed, updates / elapsed, per_update / 1024, updates))
+
+
+if __name__ == "__main__":
+    main()
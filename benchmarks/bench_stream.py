@@ -0,0 +1,118 @@
+"""Database queries/sec and delivery latency of a running API's /stream with hundreds of websocket clients.
+
+Posts are ingested into the benchmark database and announced the way ingest_batch does it, so the server
+and this script have to share the database and Redis:
+
+    DB_CONNINFO="dbname=fedibgs_bench ..." REDIS_URL=redis://localhost:6379/15 uvicorn main:app --port 8000
+    BENCH_DSN="dbname=fedibgs_bench ..." REDIS_URL=redis://localhost:6379/15 \\
+        python benchmarks/bench_stream.py --url http://localhost:8000 --clients 500 --rate 50
+
+Delivery latency runs from the ingest commit to the client receiving the post. Transactions are read from
+pg_stat_database, less the ones this script commits itself.
+"""
+import argparse
+import asyncio
+import json
+import random
+import threading
+import time
+
+import websockets
+from redis import Redis
+
+from common import BENCH_REDIS_URL, connect, make_dataset, percentile
+
+import tasks
+from author_cache import AuthorCache
+
+
+def committed_transactions(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT pg_stat_clear_snapshot()")
+    cursor.execute("SELECT xact_commit FROM pg_stat_database WHERE datname = current_database()")
+    return cursor.fetchone()[0]
+
+
+def ingest(rate, stop, committed_at, own_transactions):
+    """rate posts/sec, in one batch per 100ms like a busy scraper."""
+    connection = connect()
+    rng = random.Random(3)
+    i = 0
+    while not stop.is_set():
+        start = time.monotonic()
+        batch = [make_dataset(i + n, rng) for n in range(max(1, rate // 10))]
+        i += len(batch)
+        inserted = tasks.ingest_rows_bulk(connection, batch)
+        now = time.perf_counter()
+        for post_id in inserted:
+            committed_at[post_id] = now
+        own_transactions.append(1)
+        tasks.publish_new_posts(inserted)
+        time.sleep(max(0.0, 0.1 - (time.monotonic() - start)))
+    connection.close()
+
+
+async def client(url, slow, stop, latencies, dropped, committed_at):
+    try:
+        async with websockets.connect(url.replace("http", "ws", 1) + "/stream", open_timeout=60,
+                                      max_size=None) as websocket:
+            if slow:
+                # Never reads, the server should give up on it
+                await websocket.wait_closed()
+                dropped.append(1)
+                return
+            while not stop.is_set():
+                try:
+                    message = await asyncio.wait_for(websocket.recv(), timeout=1)
+                except asyncio.TimeoutError:
+                    continue
+                now = time.perf_counter()
+                for post in json.loads(message)["posts"]:
+                    if post["id"] in committed_at:
+                        latencies.append((now - committed_at[post["id"]]) * 1000)
+    except websockets.ConnectionClosed:
+        dropped.append(1)
+
+
+async def run(args, stop, latencies, dropped, committed_at):
+    clients = [asyncio.create_task(client(args.url.rstrip("/"), n < args.slow_clients, stop, latencies, dropped, committed_at))
+               for n in range(args.clients)]
+    await asyncio.sleep(args.duration)
+    stop.set()
+    await asyncio.wait(clients, timeout=5)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--clients", type=int, default=300)
+    parser.add_argument("--slow-clients", type=int, default=0, help="clients among --clients that never read")
+    parser.add_argument("--rate", type=int, default=50, help="posts/sec ingested during the run")
+    parser.add_argument("--duration", type=float, default=30)
+    args = parser.parse_args()
+
+    tasks.logger.disabled = True
+    tasks.author_cache = AuthorCache(Redis.from_url(BENCH_REDIS_URL))
+    stats = connect(autocommit=True)
+    before = committed_transactions(stats)
+
+    stop = threading.Event()
+    latencies, dropped, own_transactions = [], [], []
+    committed_at = {}
+    ingester = threading.Thread(target=ingest, args=(args.rate, stop, committed_at, own_transactions), daemon=True)
+    ingester.start()
+    asyncio.run(run(args, stop, latencies, dropped, committed_at))
+    ingester.join()
+
+    # Statistics reach pg_stat_database up to a second late
+    time.sleep(1.5)
+    transactions = committed_transactions(stats) - before - len(own_transactions)
+    print("%d clients (%d slow), %d posts ingested" % (args.clients, args.slow_clients, len(committed_at)))
+    print("db      %8.1f transactions/sec" % (transactions / args.duration))
+    print("deliver p50 %8.1f ms  p99 %8.1f ms  max %8.1f ms  (%d deliveries)"
+          % (percentile(latencies, 50), percentile(latencies, 99), max(latencies, default=0), len(latencies)))
+    print("dropped %d clients" % len(dropped))
+
+
+if __name__ == "__main__":
+    main()
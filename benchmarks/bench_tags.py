@@ -0,0 +1,151 @@
+"""Tag page and trending tag latency on seeded posts: a GIN jsonb_path_ops index on posts.tags and an
+aggregate over the last day, against post_tags and the hourly Redis counters of tags.py.
+
+    BENCH_DSN="dbname=fedibgs_bench ..." python benchmarks/bench_tags.py --posts 2000000 --tags 20000
+"""
+import argparse
+import asyncio
+import json
+from datetime import datetime, timedelta, timezone
+
+import redis.asyncio
+from redis import Redis
+
+from common import BENCH_REDIS_URL, Timer, async_connect, connect, percentile, reset_schema
+
+import hydrate
+import partitions
+import tags
+from post_search import decode_cursor
+
+GIN_INDEX = "CREATE INDEX posts_tags_gin_idx ON posts USING GIN (tags jsonb_path_ops)"
+
+SQL_TRENDING = ("SELECT tag, COUNT(*) FROM posts, jsonb_array_elements_text(tags) AS tag "
+                "WHERE indexed_at > now() - interval '24 hours' GROUP BY tag ORDER BY COUNT(*) DESC LIMIT 20")
+
+
+def seed(connection, n, n_tags, days):
+    reset_schema(connection)
+    now = datetime.now(timezone.utc)
+    partitions.ensure_partitions(connection, first=now - timedelta(days=days), now=now, premake=1)
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO authors (url, username) SELECT 'https://example.social/@user' || i, 'user' || i "
+                   "FROM generate_series(1, 10000) AS i")
+    # 0-3 tags per post, skewed so a few tags are on a large share of the posts and most are rare
+    cursor.execute(
+        "INSERT INTO posts (id, content, post_url, tags, author_id, indexed_at) "
+        "SELECT md5(i::text)::uuid, 'post ' || i, 'https://example.social/@u/' || i, "
+        "(SELECT COALESCE(jsonb_agg('tag' || floor(power(random(), 3) * %s)::int), '[]') "
+        " FROM generate_series(1, (i %% 4)) AS t WHERE i > 0), "
+        "1 + i %% 10000, now() - make_interval(secs => i::float8 / %s * %s * 86400) "
+        "FROM generate_series(1, %s) AS i", (n_tags, n, days, n))
+    connection.commit()
+
+
+def measure(run, repeat):
+    samples = []
+    for _ in range(repeat):
+        with Timer() as t:
+            run()
+        samples.append(t.elapsed * 1000)
+    return percentile(samples, 50), percentile(samples, 99)
+
+
+async def ameasure(run, repeat):
+    samples = []
+    for _ in range(repeat):
+        with Timer() as t:
+            await run()
+        samples.append(t.elapsed * 1000)
+    return percentile(samples, 50), percentile(samples, 99)
+
+
+async def tag_pages(sample_tags, repeat):
+    connection = await async_connect(autocommit=True)
+    cursor = connection.cursor()
+    results = []
+    for label, tag in sample_tags:
+        async def gin():
+            await cursor.execute(hydrate.select_posts("WHERE posts.tags @> %s::jsonb ORDER BY posts.indexed_at DESC, posts.id DESC LIMIT 50"),
+                                 (json.dumps([tag]),))
+            await cursor.fetchall()
+
+        _, next_cursor = await tags.tag_posts(cursor, tag)
+        after = None
+        for _ in range(5):
+            if next_cursor is None:
+                break
+            after = decode_cursor(next_cursor)
+            _, next_cursor = await tags.tag_posts(cursor, tag, after=after)
+
+        async def post_tags_page():
+            await tags.tag_posts(cursor, tag)
+
+        async def post_tags_deep():
+            await tags.tag_posts(cursor, tag, after=after)
+
+        results.append(("%s (%s)" % (label, tag), await ameasure(gin, repeat), await ameasure(post_tags_page, repeat),
+                        await ameasure(post_tags_deep, repeat) if after else None))
+    await connection.close()
+    return results
+
+
+async def trending(repeat):
+    client = redis.asyncio.Redis.from_url(BENCH_REDIS_URL)
+
+    async def cold():
+        await client.delete("%strending:24" % tags.PREFIX)
+        await tags.trending(client)
+
+    async def warm():
+        await tags.trending(client)
+
+    results = (await ameasure(cold, repeat), await ameasure(warm, repeat))
+    await client.aclose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--posts", type=int, default=2000000)
+    parser.add_argument("--tags", type=int, default=20000, help="distinct tags")
+    parser.add_argument("--days", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    connection = connect()
+    with Timer() as t:
+        seed(connection, args.posts, args.tags, args.days)
+    print("seeded %d posts in %.1fs" % (args.posts, t.elapsed))
+
+    sync_redis = Redis.from_url(BENCH_REDIS_URL)
+    for key in sync_redis.scan_iter(tags.PREFIX + "*"):
+        sync_redis.delete(key)
+    with Timer() as t:
+        tags.backfill(sync_redis, connection)
+    print("backfilled post_tags and counters in %.1fs" % t.elapsed)
+
+    connection.commit()
+    connection.autocommit = True
+    with Timer() as t:
+        connection.execute(GIN_INDEX)
+    print("built the GIN index in %.1fs" % t.elapsed)
+    connection.execute("VACUUM ANALYZE")
+
+    cursor = connection.cursor()
+    cursor.execute("SELECT tag, COUNT(*) FROM post_tags GROUP BY tag ORDER BY COUNT(*) DESC")
+    ranked = cursor.fetchall()
+    sample_tags = [("top", ranked[0][0]), ("median", ranked[len(ranked) // 2][0]), ("rare", ranked[-1][0])]
+
+    print("%-22s %16s %16s %16s" % ("tag page p50/p99 ms", "GIN @>", "post_tags", "post_tags p6"))
+    for label, gin, page, deep in asyncio.run(tag_pages(sample_tags, args.repeat)):
+        print("%-22s %7.2f/%-8.2f %7.2f/%-8.2f %16s" % (label, *gin, *page, "%7.2f/%-8.2f" % deep if deep else "-"))
+
+    sql = measure(lambda: cursor.execute(SQL_TRENDING).fetchall(), max(1, args.repeat // 4))
+    cold, warm = asyncio.run(trending(args.repeat))
+    print("trending 24h p50/p99 ms: aggregate %.2f/%.2f  counters %.2f/%.2f  cached %.2f/%.2f" % (*sql, *cold, *warm))
+    connection.close()
+
+
+if __name__ == "__main__":
+    main()
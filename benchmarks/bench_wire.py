@@ -0,0 +1,74 @@
+"""Encoded bytes per post and encode/decode time of ingest batches: Celery's default json
+serializer with raw HTML against the fedibgs wire format.
+
+    python benchmarks/bench_wire.py --sample recorded_posts.jsonl --batch-size 64
+
+--sample takes JSON lines in the shape BGSListener buffers; without it synthetic posts are used.
+"""
+import argparse
+import json
+from datetime import datetime
+
+from kombu.serialization import dumps, loads
+
+from common import Timer, batched, make_datasets
+
+import wire
+from html_text import strip_tags
+
+
+def load_sample(path):
+    datasets = []
+    with open(path) as f:
+        for line in f:
+            dataset = json.loads(line)
+            if isinstance(dataset.get("indexedAt"), str):
+                dataset["indexedAt"] = datetime.fromisoformat(dataset["indexedAt"])
+            datasets.append(dataset)
+    return datasets
+
+
+def run_json(batches):
+    encoded = []
+    with Timer() as encode:
+        for batch in batches:
+            encoded.append(dumps(((batch,), {}, {}), serializer="json"))
+    with Timer() as decode:
+        for content_type, content_encoding, body in encoded:
+            (batch,), _, _ = loads(body, content_type, content_encoding)
+            # The worker then strips the HTML itself
+            for dataset in batch:
+                strip_tags(dataset["content"], breaks=True)
+    return encode.elapsed, decode.elapsed, sum(len(body) for _, _, body in encoded)
+
+
+def run_wire(batches):
+    encoded = []
+    with Timer() as encode:
+        for batch in batches:
+            encoded.append(dumps(((wire.pack_batch(batch),), {}, {}), serializer=wire.SERIALIZER))
+    with Timer() as decode:
+        for content_type, content_encoding, body in encoded:
+            (batch,), _, _ = loads(body, content_type, content_encoding)
+            wire.unpack_batch(batch)
+    return encode.elapsed, decode.elapsed, sum(len(body) for _, _, body in encoded)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sample")
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    datasets = load_sample(args.sample) if args.sample else make_datasets(args.posts)
+    batches = list(batched(datasets, args.batch_size))
+
+    for name, run in (("json", run_json), ("fedibgs", run_wire)):
+        encode, decode, size = run(batches)
+        print("%-8s %7.1f bytes/post  encode %6.1f us/post  decode %6.1f us/post"
+              % (name, size / len(datasets), encode / len(datasets) * 1e6, decode / len(datasets) * 1e6))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,166 @@
+import hashlib
+import os
+import random
+import sys
+import time
+import uuid
+from datetime import datetime, timedelta
+
+import psycopg
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+# Scratch database, wiped by reset_schema(). Never point this at the live database.
+BENCH_DSN = os.getenv("BENCH_DSN", "dbname=fedibgs_bench user=postgres password=postgres host=localhost port=5432")
+BENCH_REDIS_URL = os.getenv("BENCH_REDIS_URL", "redis://localhost:6379/15")
+
+WORDS = ("fediverse", "mastodon", "cat", "photo", "sunset", "coffee", "rust", "python", "linux", "music",
+         "art", "garden", "train", "rain", "morning", "release", "bug", "server", "federation", "birds")
+
+
+def connect(**kwargs):
+    connection = psycopg.connect(BENCH_DSN, **kwargs)
+    if connection.info.dbname == "fedibgs":
+        raise SystemExit("Refusing to run benchmarks against the live fedibgs database, set BENCH_DSN")
+    return connection
+
+
+async def async_connect(**kwargs):
+    connection = await psycopg.AsyncConnection.connect(BENCH_DSN, **kwargs)
+    if connection.info.dbname == "fedibgs":
+        raise SystemExit("Refusing to run benchmarks against the live fedibgs database, set BENCH_DSN")
+    return connection
+
+
+def reset_schema(connection):
+    """Drop everything in the scratch database and re-apply init.sql."""
+    connection.autocommit = True
+    cursor = connection.cursor()
+    cursor.execute("DROP SCHEMA public CASCADE")
+    cursor.execute("CREATE SCHEMA public")
+    with open(os.path.join(ROOT, "init.sql")) as f:
+        statements = []
+        for chunk in f.read().split(";\n"):
+            # Semicolons inside a $$-quoted body (DO blocks) do not end the statement
+            if statements and statements[-1].count("$$") % 2:
+                statements[-1] += ";\n" + chunk
+            else:
+                statements.append(chunk)
+        statements = [s.strip() for s in statements if s.strip()]
+    for statement in statements:
+        try:
+            cursor.execute(statement)
+        except psycopg.Error as e:
+            # Same behaviour as psql -f: report and keep going
+            print("init.sql: %s" % str(e).splitlines()[0])
+    connection.autocommit = False
+
+
+def post_uuid(url):
+    return str(uuid.UUID(hashlib.md5(url.encode("utf-8")).hexdigest()))
+
+
+def make_dataset(i, rng, n_authors=1000, attachment_ratio=0.3, max_attachments=4, indexed_at=None):
+    """A post in the shape BGSListener.on_update hands to tasks.ingest_batch."""
+    author = rng.randrange(n_authors)
+    url = "https://example%d.social/@user%d/%d" % (author % 50, author, i)
+    attachments = []
+    if rng.random() < attachment_ratio:
+        for n in range(rng.randint(1, max_attachments)):
+            attachments.append({
+                "description": " ".join(rng.choice(WORDS) for _ in range(rng.randint(0, 8))) or None,
+                "url": "https://media.example%d.social/%d_%d.jpg" % (author % 50, i, n),
+            })
+    words = [rng.choice(WORDS) for _ in range(rng.randint(3, 40))]
+    return {
+        "id": post_uuid(url),
+        "content": "<p>%s</p><p>%s <a href=\"https://example.social/tags/%s\" class=\"mention hashtag\" rel=\"tag\">#<span>%s</span></a></p>"
+                   % (" ".join(words[:len(words) // 2]), " ".join(words[len(words) // 2:]), words[0], words[0]),
+        "attachments": attachments,
+        "postURL": url,
+        "tags": [words[0]],
+        "author": {
+            "url": "https://example%d.social/@user%d" % (author % 50, author),
+            "username": "user%d" % author,
+        },
+        "indexedAt": indexed_at or datetime.now(),
+    }
+
+
+def make_status(i, rng):
+    """A status in the shape the streaming API sends it, about as large as a federated one."""
+    instance = "example%d.social" % rng.randrange(200)
+    user = "user%d" % rng.randrange(100000)
+    created = "2024-08-%02dT%02d:%02d:%02d.000Z" % (rng.randint(1, 28), rng.randrange(24), rng.randrange(60), rng.randrange(60))
+    account = {
+        "id": str(rng.getrandbits(60)), "username": user, "acct": "%s@%s" % (user, instance), "display_name": user.title(),
+        "locked": False, "bot": False, "discoverable": True, "group": False, "created_at": created,
+        "note": "<p>%s</p>" % " ".join(rng.choice(WORDS) for _ in range(20)),
+        "url": "https://%s/@%s" % (instance, user), "uri": "https://%s/users/%s" % (instance, user),
+        "avatar": "https://%s/avatars/%s.png" % (instance, user), "avatar_static": "https://%s/avatars/%s.png" % (instance, user),
+        "header": "https://%s/headers/%s.png" % (instance, user), "header_static": "https://%s/headers/%s.png" % (instance, user),
+        "followers_count": rng.randrange(5000), "following_count": rng.randrange(1000), "statuses_count": rng.randrange(50000),
+        "last_status_at": created[:10], "emojis": [],
+        "fields": [{"name": "Website", "value": "<a href=\"https://%s\">%s</a>" % (instance, instance), "verified_at": None}],
+    }
+    media = []
+    for n in range(rng.choice((0, 0, 0, 1, 1, 2, 4))):
+        media.append({
+            "id": str(rng.getrandbits(60)), "type": rng.choice(("image", "image", "image", "video", "gifv")),
+            "url": "https://media.%s/%d_%d.jpg" % (instance, i, n), "preview_url": "https://media.%s/%d_%d_small.jpg" % (instance, i, n),
+            "remote_url": "https://media.%s/original/%d_%d.jpg" % (instance, i, n), "preview_remote_url": None, "text_url": None,
+            "meta": {"original": {"width": 1600, "height": 1200, "size": "1600x1200", "aspect": 1.333},
+                     "small": {"width": 480, "height": 360, "size": "480x360", "aspect": 1.333}},
+            "description": " ".join(rng.choice(WORDS) for _ in range(rng.randrange(12))) or None,
+            "blurhash": "UBL_:rOpGG-oBUNG,qRj2so|=eE1w^n4S5NH",
+        })
+    words = [rng.choice(WORDS) for _ in range(rng.randint(5, 60))]
+    url = "https://%s/@%s/%d" % (instance, user, i)
+    return {
+        "id": str(rng.getrandbits(60)), "created_at": created, "in_reply_to_id": str(i) if rng.random() < 0.3 else None,
+        "in_reply_to_account_id": None, "sensitive": False, "spoiler_text": "", "visibility": "public", "language": "en",
+        "uri": url.replace("/@", "/users/").replace("/%d" % i, "/statuses/%d" % i), "url": url,
+        "replies_count": 0, "reblogs_count": 0, "favourites_count": 0, "edited_at": None,
+        "content": "<p>%s <a href=\"https://%s/tags/%s\" class=\"mention hashtag\" rel=\"tag\">#<span>%s</span></a></p>"
+                   % (" ".join(words), instance, words[0], words[0]),
+        "reblog": None, "application": None, "account": account, "media_attachments": media, "mentions": [],
+        "tags": [{"name": words[0], "url": "https://%s/tags/%s" % (instance, words[0])}], "emojis": [],
+        "card": None, "poll": None,
+    }
+
+
+def make_datasets(n, seed=1, duplicate_ratio=0.0, spread=None, **kwargs):
+    """n posts; duplicate_ratio of them repeat an earlier post, spread spaces indexedAt over a timedelta."""
+    rng = random.Random(seed)
+    now = datetime.now()
+    datasets = []
+    for i in range(n):
+        if datasets and rng.random() < duplicate_ratio:
+            datasets.append(rng.choice(datasets))
+            continue
+        indexed_at = now - timedelta(seconds=rng.random() * spread.total_seconds()) if spread else None
+        datasets.append(make_dataset(i, rng, indexed_at=indexed_at, **kwargs))
+    return datasets
+
+
+def batched(items, size):
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def percentile(samples, p):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+
+class Timer:
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self.start
@@ -0,0 +1,184 @@
+"""Records a streaming endpoint to a compressed file and replays recordings through a local stand-in, so the
+scraper can be load-tested offline and the same traffic replayed against every change.
+
+    python benchmarks/firehose.py record https://fedi.buzz/api/v1/streaming/public --seconds 600 --out public.sse.gz
+    python benchmarks/firehose.py synthesize --events 50000 --rate 200 --out synthetic.sse.gz
+    python benchmarks/firehose.py replay public.sse.gz --speed 10 --port 8080
+    python scrape.py http://127.0.0.1:8080
+
+A recording is gzipped SSE with every event preceded by a ":t <seconds>" comment holding its arrival time
+relative to the start of the recording. Stream readers see those as heartbeats, and replays keep the
+original pacing from them. Replays point attachment URLs at the local media stand-in, so resolving them
+never leaves the machine.
+"""
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import time
+
+import requests
+
+from common import make_status
+from tests.standins import MediaHandler, serve, serve_replay
+
+from streaming import READ_SIZE
+
+
+def record(url, path, seconds, headers=None):
+    """Writes seconds worth of the stream at url to path. Returns the number of events recorded."""
+    headers = dict(headers or {}, Accept="text/event-stream")
+    start = time.monotonic()
+    count = 0
+    buffer = b""
+    lines = []
+    with requests.get(url, headers=headers, stream=True, timeout=(10, 60)) as response, gzip.open(path, "wb") as f:
+        response.raise_for_status()
+        while time.monotonic() - start < seconds:
+            chunk = response.raw.read1(READ_SIZE, decode_content=True)
+            if not chunk:
+                break
+            *complete, buffer = (buffer + chunk).split(b"\n")
+            for line in complete:
+                if line:
+                    # Heartbeats are not kept, the replay sends its own
+                    if not line.startswith(b":"):
+                        lines.append(line)
+                elif lines:
+                    f.write(b":t %.3f\n%s\n\n" % (time.monotonic() - start, b"\n".join(lines)))
+                    count += 1
+                    lines = []
+    return count
+
+
+def synthesize(path, events, rate=100.0, delete_ratio=0.4, seed=5):
+    """Writes a recording of events synthetic events arriving at rate per second on average."""
+    rng = random.Random(seed)
+    offset = 0.0
+    with gzip.open(path, "wb") as f:
+        for i in range(events):
+            offset += rng.expovariate(rate)
+            if rng.random() < delete_ratio:
+                f.write(b":t %.3f\nevent: delete\ndata: %d\n\n" % (offset, rng.getrandbits(60)))
+            else:
+                f.write(b":t %.3f\nevent: update\ndata: %s\n\n" % (offset, json.dumps(make_status(i, rng)).encode("utf-8")))
+
+
+def load(path):
+    """[(offset, event, data)] of a recording, with event and data as bytes."""
+    events = []
+    offset = 0.0
+    with gzip.open(path, "rb") as f:
+        blocks = f.read().split(b"\n\n")
+    for block in blocks:
+        event, data = b"message", []
+        for line in block.split(b"\n"):
+            if line.startswith(b":t "):
+                offset = float(line[3:])
+            elif line.startswith(b"event:"):
+                event = line[6:].strip()
+            elif line.startswith(b"data:"):
+                data.append(line[6:] if line.startswith(b"data: ") else line[5:])
+        if data:
+            events.append((offset, event, b"\n".join(data)))
+    return events
+
+
+def prepare(events, media_url=None, attachment_ratio=0.0, duplicate_ratio=0.0, seed=1):
+    """Readies recorded events for a replay:
+
+    - attachment URLs point at media_url, the local media stand-in, instead of their real hosts
+    - attachment_ratio of the updates that have no attachment get an image
+    - duplicate_ratio of the updates are followed by a repeat of an earlier update, like overlapping relays
+
+    Returns (events, {post URL: index of the first event carrying it}).
+    """
+    rng = random.Random(seed)
+    prepared = []
+    first_index = {}
+    updates = []
+    for offset, event, data in events:
+        if event != b"update":
+            prepared.append((offset, event, data))
+            continue
+        status = json.loads(data)
+        if attachment_ratio and not status.get("media_attachments") and rng.random() < attachment_ratio:
+            status["media_attachments"] = [{"type": "image", "url": "https://media.example.social/%s.jpg" % status["id"],
+                                            "remote_url": None, "description": None}]
+        if media_url:
+            for attachment in status.get("media_attachments") or []:
+                original = attachment.get("remote_url") or attachment.get("url") or ""
+                attachment["url"] = "%s/%s.jpg" % (media_url, hashlib.md5(original.encode("utf-8")).hexdigest())
+                attachment["remote_url"] = None
+        data = json.dumps(status).encode("utf-8")
+        first_index.setdefault(status.get("url"), len(prepared))
+        prepared.append((offset, event, data))
+        updates.append(data)
+        if rng.random() < duplicate_ratio:
+            prepared.append((offset, event, rng.choice(updates)))
+    return prepared, first_index
+
+
+def replay(path, speed=1.0, port=0, media_latency=0, attachment_ratio=0.0, duplicate_ratio=0.0, live_media=False):
+    """Serves the recording at path on port, with a media stand-in for its attachments unless live_media.
+    Returns (stream server, {post URL: event index}, media server or None)."""
+    media = None
+    media_url = None
+    if not live_media:
+        media = serve(MediaHandler)
+        media_url = media.base_url + ("/slow/%d" % media_latency if media_latency else "/ok")
+    events, first_index = prepare(load(path), media_url, attachment_ratio, duplicate_ratio)
+    return serve_replay(events, speed=speed, port=port), first_index, media
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    record_parser = commands.add_parser("record", help="record a streaming endpoint")
+    record_parser.add_argument("url")
+    record_parser.add_argument("--out", required=True)
+    record_parser.add_argument("--seconds", type=float, default=600)
+    record_parser.add_argument("--token", help="access token, for instances that require one")
+
+    synthesize_parser = commands.add_parser("synthesize", help="write a synthetic recording")
+    synthesize_parser.add_argument("--out", required=True)
+    synthesize_parser.add_argument("--events", type=int, default=50000)
+    synthesize_parser.add_argument("--rate", type=float, default=100, help="average events per second")
+    synthesize_parser.add_argument("--delete-ratio", type=float, default=0.4)
+
+    replay_parser = commands.add_parser("replay", help="serve a recording as a streaming endpoint")
+    replay_parser.add_argument("file")
+    replay_parser.add_argument("--port", type=int, default=8080)
+    replay_parser.add_argument("--speed", type=float, default=1, help="times the recorded pace, 0 for as fast as possible")
+    replay_parser.add_argument("--attachments", type=float, default=0, help="share of updates to add an image to")
+    replay_parser.add_argument("--duplicates", type=float, default=0, help="share of updates to send twice")
+    replay_parser.add_argument("--media-latency", type=int, default=0, help="ms the media stand-in takes per request")
+    replay_parser.add_argument("--live-media", action="store_true", help="keep the recorded attachment URLs")
+    args = parser.parse_args()
+
+    if args.command == "record":
+        headers = {"Authorization": "Bearer " + args.token} if args.token else None
+        print("recorded %d events" % record(args.url, args.out, args.seconds, headers))
+    elif args.command == "synthesize":
+        synthesize(args.out, args.events, args.rate, args.delete_ratio)
+    else:
+        server, _, media = replay(args.file, args.speed, args.port, args.media_latency, args.attachments,
+                                  args.duplicates, args.live_media)
+        print("replaying %d events on %s" % (len(server.events), server.base_url))
+        try:
+            while not server.finished.wait(10):
+                print("%d/%d events sent" % (min(server.position, len(server.events)), len(server.events)))
+            print("replay finished, only heartbeats from here on")
+            while True:
+                time.sleep(60)
+        except KeyboardInterrupt:
+            server.stopped = True
+            server.shutdown()
+            if media:
+                media.shutdown()
+
+
+if __name__ == "__main__":
+    main()
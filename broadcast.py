@@ -0,0 +1,106 @@
+import asyncio
+import json
+import logging
+
+from prometheus_client import Counter, Gauge
+from redis import RedisError
+
+import responses
+
+# ingest_batch publishes the IDs of the posts it committed here, as a JSON list
+NEW_POSTS_CHANNEL = "fedibgs:new_posts"
+
+stream_subscribers = Gauge('stream_subscribers', 'Websocket clients subscribed to /stream')
+stream_dropped_subscribers = Counter('stream_dropped_subscribers', 'Websocket clients dropped for not keeping up with /stream')
+stream_broadcasts = Counter('stream_broadcasts', 'Updates fanned out to /stream subscribers')
+
+
+class Subscriber:
+    """One websocket's bounded queue of pre-encoded updates. next() returns None once the subscriber was dropped."""
+
+    def __init__(self, queue_size):
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.dropped = False
+
+    def offer(self, payload):
+        try:
+            self.queue.put_nowait(payload)
+            return True
+        except asyncio.QueueFull:
+            self.dropped = True
+            # Make room for the sentinel, the backlog is never going to be sent anyway
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(None)
+            return False
+
+    async def next(self):
+        return await self.queue.get()
+
+
+class Broadcaster:
+    """Single producer behind /stream: collects new post IDs from NEW_POSTS_CHANNEL, fetches them with one
+    fetch(post_ids) call per interval, encodes the update once and offers it to every subscriber.
+
+    An update goes out every interval even when nothing arrived, so clients keep seeing a heartbeat.
+    """
+
+    def __init__(self, redis, fetch, interval=1.0, queue_size=32):
+        self.redis = redis
+        self.fetch = fetch
+        self.interval = interval
+        self.queue_size = queue_size
+        self.subscribers = set()
+        self.pending = []
+        self.tasks = []
+
+    def subscribe(self):
+        subscriber = Subscriber(self.queue_size)
+        self.subscribers.add(subscriber)
+        stream_subscribers.set(len(self.subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        stream_subscribers.set(len(self.subscribers))
+
+    def start(self):
+        self.tasks = [asyncio.create_task(self._listen()), asyncio.create_task(self._produce())]
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+    async def _listen(self):
+        while True:
+            try:
+                async with self.redis.pubsub() as pubsub:
+                    await pubsub.subscribe(NEW_POSTS_CHANNEL)
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self.pending.extend(json.loads(message["data"]))
+            except (RedisError, OSError) as e:
+                logging.warning("Stream broadcaster: lost %s subscription, retrying: %s" % (NEW_POSTS_CHANNEL, e))
+                await asyncio.sleep(self.interval)
+
+    async def _produce(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            post_ids, self.pending = self.pending, []
+            if not self.subscribers:
+                continue
+            try:
+                posts = await self.fetch(post_ids) if post_ids else []
+            except Exception as e:
+                logging.warning("Stream broadcaster: fetching %d new posts failed: %s" % (len(post_ids), e))
+                continue
+            # Encoded once for every subscriber. Frames stay text, the frontend parses event.data as a string
+            self.publish(responses.encode({"posts": posts}).decode("utf-8"))
+
+    def publish(self, payload):
+        stream_broadcasts.inc()
+        for subscriber in list(self.subscribers):
+            if not subscriber.offer(payload):
+                self.unsubscribe(subscriber)
+                stream_dropped_subscribers.inc()
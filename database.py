@@ -1,27 +1,99 @@
 import hashlib
 import json
+import os
+import time
+from contextlib import asynccontextmanager, contextmanager
 
 import psycopg
 import psycopg_pool
 
 from redis import Redis
 
+import instrumentation
+
+__db_conninfo = os.getenv("DB_CONNINFO", "dbname=fedibgs user=postgres password=postgres host=10.10.10.12 port=5432")
+
 __db_pool = psycopg_pool.ConnectionPool(
-    conninfo="dbname=fedibgs user=postgres password=postgres host=10.10.10.12 port=5432",
+    conninfo=__db_conninfo,
     open=True,
 )
 
+# The API's pool, opened and closed by the app lifespan (open_async_db_pool/close_async_db_pool)
+__async_db_pool = None
+
+# Waits longer than this for a worker connection are logged
+DB_POOL_SLOW_WAIT = float(os.getenv("DB_POOL_SLOW_WAIT", 0.1))
+pool_log = instrumentation.RateLimitedLog()
 
-__redis_url = "redis://10.10.10.12:6379"
 
-__redis_connection = Redis(host="10.10.10.12", port=6379)
+__redis_url = os.getenv("REDIS_URL", "redis://10.10.10.12:6379")
 
+__redis_connection = Redis.from_url(__redis_url)
+
+@contextmanager
 def get_db_connection():
-    print("Getting connection")
-    return __db_pool.connection()
+    start = time.monotonic()
+    with __db_pool.connection() as connection:
+        waited = time.monotonic() - start
+        stats = __db_pool.get_stats()
+        instrumentation.db_pool_wait.labels("worker").observe(waited)
+        instrumentation.db_pool_size.labels("worker").set(stats.get("pool_size", 0))
+        instrumentation.db_pool_max_size.labels("worker").set(__db_pool.max_size)
+        instrumentation.db_pool_waiting.labels("worker").set(stats.get("requests_waiting", 0))
+        if waited > DB_POOL_SLOW_WAIT:
+            pool_log.warning("Slow database connection", pool="worker", wait_ms=round(waited * 1000),
+                             pool_size=stats.get("pool_size", 0), waiting=stats.get("requests_waiting", 0))
+        instrumentation.db_pool_in_use.labels("worker").inc()
+        try:
+            yield connection
+        finally:
+            instrumentation.db_pool_in_use.labels("worker").dec()
+
+async def open_async_db_pool():
+    global __async_db_pool
+    __async_db_pool = psycopg_pool.AsyncConnectionPool(
+        conninfo=__db_conninfo,
+        min_size=int(os.getenv("DB_POOL_MIN_SIZE", 4)),
+        max_size=int(os.getenv("DB_POOL_MAX_SIZE", 16)),
+        # Seconds a request waits for a free connection before failing with PoolTimeout
+        timeout=float(os.getenv("DB_POOL_TIMEOUT", 10)),
+        max_idle=float(os.getenv("DB_POOL_MAX_IDLE", 600)),
+        # Query time per endpoint, see instrumentation.QueryTimeMiddleware
+        kwargs={"cursor_factory": instrumentation.TimedAsyncCursor},
+        open=False,
+    )
+    await __async_db_pool.open()
+    instrumentation.db_pool_max_size.labels("api").set(__async_db_pool.max_size)
+    instrumentation.db_pool_size.labels("api").set_function(lambda: __async_db_pool.get_stats().get("pool_size", 0))
+    instrumentation.db_pool_waiting.labels("api").set_function(lambda: __async_db_pool.get_stats().get("requests_waiting", 0))
+
+async def close_async_db_pool():
+    if __async_db_pool is not None:
+        await __async_db_pool.close()
+
+@asynccontextmanager
+async def get_async_db_connection():
+    start = time.monotonic()
+    async with __async_db_pool.connection() as connection:
+        waited = time.monotonic() - start
+        instrumentation.db_pool_wait.labels("api").observe(waited)
+        if waited > DB_POOL_SLOW_WAIT:
+            pool_log.warning("Slow database connection", pool="api", wait_ms=round(waited * 1000))
+        instrumentation.db_pool_in_use.labels("api").inc()
+        try:
+            yield connection
+        finally:
+            instrumentation.db_pool_in_use.labels("api").dec()
 
 def get_redis_connection():
     return __redis_connection
 
 def get_redis_url():
     return __redis_url
+
+def embed_or_cache(text):
+    """Embedding of a search query, shared with the embedding pipeline's cache."""
+    import embeddings
+
+    encoder = embeddings.get_encoder()
+    return embeddings.embed("text", [text], encoder, embeddings.EmbeddingCache(__redis_connection, encoder.name))[text]
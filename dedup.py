@@ -0,0 +1,224 @@
+import logging
+import math
+import threading
+import time
+import uuid
+
+from prometheus_client import Counter, Gauge
+from redis import RedisError
+
+ingest_filter_checks = Counter('ingest_filter_checks', 'Posts checked against the ingest filter by result', ['result'])
+ingest_filter_false_positives = Counter('ingest_filter_false_positives', 'Posts the ingest filter flagged that Postgres did not have')
+ingest_filter_false_positive_rate = Gauge('ingest_filter_false_positive_rate',
+                                          'False positive rate of the ingest filter, estimated from how full its bitmaps are')
+
+
+def _key_int(key):
+    if isinstance(key, uuid.UUID):
+        return key.int
+    if isinstance(key, str):
+        # Cheaper than parsing a UUID, and the same number for the canonical form
+        return int(key.replace("-", ""), 16)
+    return int.from_bytes(key, "big")
+
+
+def bloom_geometry(capacity, error_rate):
+    """(bits, hashes) of a Bloom filter holding capacity keys at error_rate false positives."""
+    size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+    return size, max(1, round(size / capacity * math.log(2)))
+
+
+def bloom_indexes(key, size, hashes):
+    # The UUIDs are MD5 digests already, so their two halves serve as the base hashes for double hashing
+    key = _key_int(key)
+    h1 = key >> 64
+    h2 = (key & 0xFFFFFFFFFFFFFFFF) | 1
+    return [(h1 + i * h2) % size for i in range(hashes)]
+
+
+class BloomFilter:
+    """Bloom filter over post UUIDs."""
+
+    def __init__(self, capacity, error_rate=0.001):
+        self.capacity = capacity
+        self.size, self.hashes = bloom_geometry(capacity, error_rate)
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _indexes(self, key):
+        return bloom_indexes(key, self.size, self.hashes)
+
+    def __contains__(self, key):
+        return self._contains(self._indexes(key))
+
+    def _contains(self, indexes):
+        bits = self.bits
+        for index in indexes:
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+    def add(self, key):
+        """Adds key, returns True if it was (probably) present already."""
+        return self._add(self._indexes(key))
+
+    def _add(self, indexes):
+        bits = self.bits
+        present = True
+        for index in indexes:
+            mask = 1 << (index & 7)
+            if not bits[index >> 3] & mask:
+                bits[index >> 3] |= mask
+                present = False
+        if not present:
+            self.count += 1
+        return present
+
+    @property
+    def memory_bytes(self):
+        return len(self.bits)
+
+
+class RotatingBloomFilter:
+    """Two Bloom filter generations: once the current one holds capacity keys it becomes the previous
+    one and a fresh filter takes over. Memory stays fixed and the false positive rate never exceeds
+    what the filter was sized for, at the cost of forgetting keys older than two generations."""
+
+    def __init__(self, capacity=1000000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = BloomFilter(capacity, error_rate)
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        # Both generations have the same geometry, so the bit positions are shared
+        indexes = self.current._indexes(key)
+        return self.current._contains(indexes) or self.previous._contains(indexes)
+
+    def add(self, key):
+        indexes = self.current._indexes(key)
+        with self.lock:
+            if self.previous._contains(indexes):
+                return True
+            present = self.current._add(indexes)
+            if self.current.count >= self.capacity:
+                self.previous = self.current
+                self.current = BloomFilter(self.capacity, self.error_rate)
+            return present
+
+    @property
+    def memory_bytes(self):
+        return self.current.memory_bytes + self.previous.memory_bytes
+
+
+class SeenPosts:
+    """Post UUIDs this scraper, or with a Redis connection any scraper, has already enqueued recently."""
+
+    REDIS_PREFIX = "fedibgs:seen:"
+
+    def __init__(self, capacity=1000000, error_rate=0.001, redis=None, ttl=3600):
+        self.local = RotatingBloomFilter(capacity, error_rate)
+        self.redis = redis
+        self.ttl = ttl
+
+    def seen(self, post_uuid):
+        """Marks post_uuid as seen, returns True if it was seen before."""
+        if self.local.add(post_uuid):
+            return True
+        if self.redis is None:
+            return False
+        try:
+            # SET NX: only the first scraper to see the post gets to enqueue it
+            return not self.redis.set(self.REDIS_PREFIX + str(post_uuid), 1, nx=True, ex=self.ttl)
+        except RedisError as e:
+            logging.warning("Shared dedup unavailable: %s" % e)
+            return False
+
+
+class IngestFilter:
+    """Post UUIDs recently handed to ingest_batch, as a Bloom filter in Redis bitmaps shared by all workers.
+
+    Every window seconds a new generation bitmap starts and the current and previous ones are checked, so a
+    post is remembered for one to two windows in a fixed amount of memory. A batch is checked with one
+    round trip and, once committed, marked with another. Posts it has never seen are certainly new; a post
+    it flags may be a false positive, so callers confirm those against Postgres.
+    """
+
+    REDIS_PREFIX = "fedibgs:ingested:"
+
+    def __init__(self, redis, capacity=2000000, error_rate=0.001, window=86400, estimate_interval=60):
+        self.redis = redis
+        self.size, self.hashes = bloom_geometry(capacity, error_rate)
+        self.window = window
+        self.estimate_interval = estimate_interval
+        self.estimated_at = 0
+
+    def _key(self, generation):
+        return "%s%d" % (self.REDIS_PREFIX, generation)
+
+    def _bits(self, post_ids, *operation):
+        arguments = []
+        for post_id in post_ids:
+            for index in bloom_indexes(post_id, self.size, self.hashes):
+                arguments += [*operation[:2], index, *operation[2:]]
+        return arguments
+
+    def check(self, post_ids):
+        """The post_ids that (probably) were marked before, or None if Redis is unavailable and every post
+        needs checking in Postgres."""
+        if not post_ids:
+            return set()
+        generation = int(time.time() // self.window)
+        get_bits = self._bits(post_ids, "GET", "u1")
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.execute_command("BITFIELD", self._key(generation), *get_bits)
+            pipeline.execute_command("BITFIELD", self._key(generation - 1), *get_bits)
+            current, previous = pipeline.execute()
+        except RedisError as e:
+            logging.warning("Ingest filter unavailable: %s" % e)
+            ingest_filter_checks.labels("unavailable").inc(len(post_ids))
+            return None
+
+        seen = set()
+        for i, post_id in enumerate(post_ids):
+            bits = slice(i * self.hashes, (i + 1) * self.hashes)
+            if all(current[bits]) or all(previous[bits]):
+                seen.add(post_id)
+        ingest_filter_checks.labels("seen").inc(len(seen))
+        ingest_filter_checks.labels("new").inc(len(post_ids) - len(seen))
+        return seen
+
+    def mark(self, post_ids):
+        """Remembers post_ids, which are in Postgres now. Best effort: a post missing from the filter only
+        costs the lookup it would have saved."""
+        if not post_ids:
+            return
+        generation = int(time.time() // self.window)
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.execute_command("BITFIELD", self._key(generation), *self._bits(post_ids, "SET", "u1", 1))
+            pipeline.expire(self._key(generation), 2 * self.window)
+            pipeline.execute()
+        except RedisError as e:
+            logging.warning("Ingest filter unavailable: %s" % e)
+            return
+        self._estimate(generation)
+
+    def _estimate(self, generation):
+        # BITCOUNT reads the whole bitmap, so the estimate is only refreshed now and then
+        now = time.monotonic()
+        if now - self.estimated_at < self.estimate_interval:
+            return
+        self.estimated_at = now
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            pipeline.bitcount(self._key(generation))
+            pipeline.bitcount(self._key(generation - 1))
+            current, previous = pipeline.execute()
+        except RedisError:
+            return
+        # A new post passes a generation if all its bits happen to be set, each one with probability ones / size
+        rates = [(ones / self.size) ** self.hashes for ones in (current, previous)]
+        ingest_filter_false_positive_rate.set(1 - (1 - rates[0]) * (1 - rates[1]))
@@ -0,0 +1,257 @@
+"""Fills posts.text_embedding and attachments.vector in the background.
+
+Rows without an embedding are read in keyset-ordered chunks, deduplicated by content, looked up in a Redis
+cache keyed by a hash of the content, and only what is left goes to the encoder. The vectors are written
+back with one UPDATE per chunk. The encoder is the CLIP server from clip.yml by default (EMBEDDING_ENCODER=clip)
+or a feature-hashing stand-in for tests and benchmarks (EMBEDDING_ENCODER=hash).
+"""
+import functools
+import hashlib
+import logging
+import math
+import os
+import re
+import threading
+import time
+from array import array
+from datetime import datetime, timezone
+
+from prometheus_client import Counter, Histogram
+from redis import RedisError
+
+embeddings_written = Counter('embeddings_written', 'Embeddings written back to Postgres', ['kind'])
+embeddings_encoded = Counter('embeddings_encoded', 'Contents sent to the encoder', ['kind'])
+embedding_cache_lookups = Counter('embedding_cache_lookups', 'Embedding cache lookups by result', ['result'])
+embedding_failures = Counter('embedding_failures', 'Contents the encoder could not embed', ['kind'])
+embedding_batch_seconds = Histogram('embedding_batch_seconds', 'Time the encoder took per batch',
+                                    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+CLIP_SERVER_URL = os.getenv("CLIP_SERVER_URL", "http://10.10.10.12:51000")
+EMBEDDING_ENCODER = os.getenv("EMBEDDING_ENCODER", "clip")
+# ViT-H-14 as configured in clip.yml
+EMBEDDING_DIMENSIONS = int(os.getenv("EMBEDDING_DIMENSIONS", 1024))
+# Contents per encoder request
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 64))
+# Rows read per keyset page
+EMBEDDING_CHUNK_SIZE = int(os.getenv("EMBEDDING_CHUNK_SIZE", 1000))
+# Contents per second sent to the encoder, 0 for no limit
+EMBEDDING_RATE_LIMIT = float(os.getenv("EMBEDDING_RATE_LIMIT", 0))
+EMBEDDING_CACHE_TTL = int(os.getenv("EMBEDDING_CACHE_TTL", 30 * 86400))
+# Contents the encoder rejected (e.g. images that are gone) are not retried for this long
+EMBEDDING_FAILURE_TTL = int(os.getenv("EMBEDDING_FAILURE_TTL", 86400))
+
+# table -> (kind, content column, embedding column, rows worth embedding); matches the partial indexes in init.sql
+TARGETS = {
+    "posts": ("text", "content", "text_embedding", "content <> ''"),
+    "attachments": ("image", "url", "vector", "TRUE"),
+}
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_NIL_UUID = "00000000-0000-0000-0000-000000000000"
+
+
+class ClipEncoder:
+    """clip_server (clip.yml) through clip_client. Texts are encoded as text, image URLs are fetched and
+    encoded as images by the client."""
+
+    def __init__(self, server=CLIP_SERVER_URL):
+        from clip_client import Client
+
+        self.client = Client(server)
+        self.name = "clip:" + server.rstrip("/").rsplit("/", 1)[-1]
+
+    def encode(self, kind, contents):
+        return [[float(x) for x in vector] for vector in self.client.encode(contents, batch_size=EMBEDDING_BATCH_SIZE)]
+
+
+class HashEncoder:
+    """Feature hashing of the words (or the URL) into a unit vector. No model and no network, so tests and
+    benchmarks can run the whole pipeline; similar texts do end up close, which is enough to exercise search."""
+
+    def __init__(self, dimensions=EMBEDDING_DIMENSIONS):
+        self.dimensions = dimensions
+        self.name = "hash%d" % dimensions
+
+    def encode(self, kind, contents):
+        vectors = []
+        for content in contents:
+            vector = [0.0] * self.dimensions
+            for token in re.findall(r"\w+", content.lower()):
+                digest = int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little")
+                vector[digest % self.dimensions] += 1.0 if digest >> 63 else -1.0
+            norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+            vectors.append([x / norm for x in vector])
+        return vectors
+
+
+ENCODERS = {"clip": ClipEncoder, "hash": HashEncoder}
+
+
+@functools.lru_cache(maxsize=None)
+def get_encoder(name=EMBEDDING_ENCODER):
+    return ENCODERS[name]()
+
+
+class EmbeddingCache:
+    """content hash -> float32 vector in Redis, per encoder, so a text or image seen before (a boost, a
+    re-shared picture) is never encoded twice. An empty value marks a content the encoder failed on."""
+
+    REDIS_PREFIX = "fedibgs:embedding:"
+
+    def __init__(self, redis, model, ttl=EMBEDDING_CACHE_TTL, failure_ttl=EMBEDDING_FAILURE_TTL):
+        self.redis = redis
+        self.model = model
+        self.ttl = ttl
+        self.failure_ttl = failure_ttl
+
+    def _key(self, kind, content):
+        digest = hashlib.sha1(content.encode("utf-8")).hexdigest()
+        return "%s%s:%s:%s" % (self.REDIS_PREFIX, self.model, kind, digest)
+
+    def get_many(self, kind, contents):
+        """{content: vector, or False if it failed before} for the cached contents."""
+        if not contents:
+            return {}
+        try:
+            values = self.redis.mget([self._key(kind, content) for content in contents])
+        except RedisError as e:
+            logging.warning("Embedding cache: Redis lookup failed: %s" % e)
+            return {}
+        found = {}
+        for content, value in zip(contents, values):
+            if value is not None:
+                found[content] = array("f", value).tolist() if value else False
+        embedding_cache_lookups.labels("hit").inc(len(found))
+        embedding_cache_lookups.labels("miss").inc(len(contents) - len(found))
+        return found
+
+    def put_many(self, kind, vectors):
+        """Stores {content: vector}; a vector of None records a failure."""
+        if not vectors:
+            return
+        try:
+            pipeline = self.redis.pipeline(transaction=False)
+            for content, vector in vectors.items():
+                if vector is None:
+                    pipeline.set(self._key(kind, content), b"", ex=self.failure_ttl)
+                else:
+                    pipeline.set(self._key(kind, content), array("f", vector).tobytes(), ex=self.ttl)
+            pipeline.execute()
+        except RedisError as e:
+            logging.warning("Embedding cache: Redis store failed: %s" % e)
+
+
+class RateLimiter:
+    """Token bucket of rate contents per second, with a burst of one second's worth."""
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self, n):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+def _encode_batch(encoder, kind, batch):
+    """{content: vector or None}. A rejected batch is retried one content at a time so a single dead image
+    URL does not fail the rest. If every content fails on its own too, the encoder itself is assumed to be
+    down and the error is raised instead of recording them all as failures."""
+    start = time.monotonic()
+    try:
+        vectors = dict(zip(batch, encoder.encode(kind, batch)))
+    except Exception as e:
+        if len(batch) == 1:
+            logging.warning("Embedding: encoder failed on %s %r: %s" % (kind, batch[0][:200], e))
+            embedding_failures.labels(kind).inc()
+            return {batch[0]: None}
+        logging.warning("Embedding: batch of %d %ss failed, retrying one by one: %s" % (len(batch), kind, e))
+        vectors = {}
+        for content in batch:
+            vectors.update(_encode_batch(encoder, kind, [content]))
+        if not any(vectors.values()):
+            raise
+        return vectors
+    embedding_batch_seconds.observe(time.monotonic() - start)
+    embeddings_encoded.labels(kind).inc(len(batch))
+    return vectors
+
+
+def embed(kind, contents, encoder, cache, limiter=None, batch_size=EMBEDDING_BATCH_SIZE):
+    """{content: vector, or None if it could not be embedded} for the distinct contents."""
+    contents = list(dict.fromkeys(contents))
+    vectors = {content: vector or None for content, vector in cache.get_many(kind, contents).items()}
+    missing = [content for content in contents if content not in vectors]
+    for i in range(0, len(missing), batch_size):
+        batch = missing[i:i + batch_size]
+        if limiter:
+            limiter.wait(len(batch))
+        encoded = _encode_batch(encoder, kind, batch)
+        cache.put_many(kind, encoded)
+        vectors.update(encoded)
+    return vectors
+
+
+def embed_chunk(connection, table, after, encoder, cache, limiter=None, limit=EMBEDDING_CHUNK_SIZE):
+    """Embeds up to limit rows of table that come after the (indexed_at, id) keyset position after.
+
+    Returns (rows read, rows written, position of the last row read or None at the end). Rows whose content
+    could not be embedded are left NULL and picked up again by a later run."""
+    kind, source, column, condition = TARGETS[table]
+    cursor = connection.cursor()
+    cursor.execute("SELECT id, indexed_at, %s FROM %s WHERE %s IS NULL AND %s AND (indexed_at, id) > (%%s, %%s) "
+                   "ORDER BY indexed_at, id LIMIT %%s" % (source, table, column, condition), (*after, limit))
+    rows = cursor.fetchall()
+    # Not holding a transaction open while the encoder works
+    connection.commit()
+    if not rows:
+        return 0, 0, None
+
+    vectors = embed(kind, [row[2] for row in rows], encoder, cache, limiter)
+    done = [(row[0], row[1], vectors[row[2]]) for row in rows if vectors[row[2]]]
+    if done:
+        # Binary COPY into a scratch table: formatting a thousand 1024-float vectors as text literals
+        # costs more than the UPDATE itself. pgvecto.rs casts real[] to vector on assignment.
+        id_type = "uuid" if table == "posts" else "int4"
+        cursor.execute("CREATE TEMP TABLE embedding_updates (id %s, indexed_at timestamptz, embedding real[]) "
+                       "ON COMMIT DROP" % id_type)
+        with cursor.copy("COPY embedding_updates FROM STDIN (FORMAT BINARY)") as copy:
+            copy.set_types([id_type, "timestamptz", "float4[]"])
+            for row in done:
+                copy.write_row(row)
+        cursor.execute("UPDATE %s SET %s = v.embedding FROM embedding_updates AS v "
+                       "WHERE %s.id = v.id AND %s.indexed_at = v.indexed_at AND %s.%s IS NULL"
+                       % (table, column, table, table, table, column))
+        embeddings_written.labels(kind).inc(cursor.rowcount)
+        connection.commit()
+    return len(rows), len(done), (rows[-1][1], rows[-1][0])
+
+
+def embed_pending(connection, encoder, cache, limiter=None, tables=tuple(TARGETS), max_seconds=None):
+    """Works through every row of tables that has no embedding yet, or until max_seconds have passed.
+
+    Returns {table: rows written}."""
+    start = time.monotonic()
+    written = {}
+    for table in tables:
+        written[table] = 0
+        after = (_EPOCH, _NIL_UUID if table == "posts" else 0)
+        while after is not None:
+            if max_seconds and time.monotonic() - start > max_seconds:
+                break
+            _, count, after = embed_chunk(connection, table, after, encoder, cache, limiter)
+            written[table] += count
+    elapsed = time.monotonic() - start
+    logging.info("Embedding: wrote %s in %.1fs (%.1f rows/s)"
+                 % (written, elapsed, sum(written.values()) / elapsed if elapsed else 0))
+    return written
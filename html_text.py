@@ -0,0 +1,100 @@
+import re
+from html import unescape
+from html.parser import HTMLParser
+from io import StringIO
+
+from prometheus_client import Counter
+
+html_strip_fallbacks = Counter('html_strip_fallbacks', 'Posts whose HTML needed the full parser instead of the fast path')
+
+# Tags Mastodon puts into post content. Anything else (comments, script/style, unquoted attributes,
+# stray '<' in text, ...) goes through HTMLParser.
+FAST_TAGS = frozenset(("p", "br", "a", "span", "b", "strong", "i", "em", "u", "s", "del", "code", "pre",
+                       "blockquote", "ul", "ol", "li"))
+
+_TAG = re.compile(r"(/?)([a-zA-Z][a-zA-Z0-9]*)"
+                  r"((?:\s+[a-zA-Z_:][-a-zA-Z0-9_:.]*(?:\s*=\s*(?:\"[^\"<>]*\"|'[^'<>]*'))?)*)"
+                  r"\s*(/?)>")
+
+
+class MLStripper(HTMLParser):
+    def __init__(self, breaks=False):
+        super().__init__()
+        self.reset()
+        self.strict = False
+        self.convert_charrefs = True
+        self.breaks = breaks
+        self.text = StringIO()
+
+    def handle_data(self, d):
+        self.text.write(d)
+
+    def handle_starttag(self, tag, attrs):
+        if self.breaks and tag == "br":
+            self.text.write("\n")
+
+    def handle_endtag(self, tag):
+        if self.breaks and tag == "p":
+            self.text.write("\n\n")
+
+    def get_data(self):
+        if self.breaks:
+            return self.text.getvalue().rstrip("\n")
+        return self.text.getvalue()
+
+
+def parse_strip_tags(html, breaks=False):
+    s = MLStripper(breaks)
+    s.feed(html)
+    return s.get_data()
+
+
+def _fast_strip_tags(html, breaks):
+    """Same output as parse_strip_tags for the HTML Mastodon emits, or None if the input is anything else."""
+    parts = html.split("<")
+    text = parts[0]
+    if "&" in text:
+        if len(parts) == 1:
+            # HTMLParser holds back a trailing, possibly incomplete character reference
+            return None
+        text = unescape(text)
+    out = [text]
+
+    last = len(parts) - 1
+    for n in range(1, len(parts)):
+        part = parts[n]
+        m = _TAG.match(part)
+        if m is None:
+            return None
+        closing, name, _, self_closing = m.groups()
+        name = name.lower()
+        if name not in FAST_TAGS or (closing and name == "br"):
+            return None
+
+        if breaks:
+            if not closing and name == "br":
+                out.append("\n")
+            elif name == "p" and (closing or self_closing):
+                out.append("\n\n")
+
+        text = part[m.end():]
+        if "&" in text:
+            if n == last:
+                return None
+            text = unescape(text)
+        out.append(text)
+
+    result = "".join(out)
+    return result.rstrip("\n") if breaks else result
+
+
+def strip_tags(html, breaks=False):
+    """Text content of post HTML with entities decoded. With breaks, <br> becomes a newline and
+    paragraphs are separated by a blank line."""
+    if "<" not in html and "&" not in html:
+        return html.rstrip("\n") if breaks else html
+    text = _fast_strip_tags(html, breaks)
+    if text is None:
+        html_strip_fallbacks.inc()
+        text = parse_strip_tags(html, breaks)
+    return text
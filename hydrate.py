@@ -0,0 +1,36 @@
+"""Posts as the API returns them: one query for posts, authors and attachments, one pass to format them."""
+
+# Attachments come back already grouped per post as a JSON array. A correlated subquery rather than a
+# LATERAL join, because Postgres postpones it until after ORDER BY ... LIMIT and only runs it for the page.
+# Attachments share their post's indexed_at, which lets it skip every attachments partition but one.
+POST_COLUMNS = (
+    "posts.id, posts.content, authors.username, posts.post_url, posts.indexed_at, authors.id, "
+    "(SELECT COALESCE(json_agg(json_build_object('id', attachments.post_id::text, 'description', attachments.description, "
+    "'url', attachments.url) ORDER BY attachments.id), '[]'::json) FROM attachments "
+    "WHERE attachments.post_id = posts.id AND attachments.indexed_at = posts.indexed_at)"
+)
+
+
+def select_posts(clauses, extra_columns=""):
+    """SELECT of hydrated posts; clauses is the WHERE/ORDER BY/LIMIT tail, with its own placeholders.
+    extra_columns come after the post's, for the caller to strip before format_post."""
+    columns = POST_COLUMNS + ", " + extra_columns if extra_columns else POST_COLUMNS
+    return "SELECT %s FROM posts JOIN authors ON posts.author_id = authors.id %s" % (columns, clauses)
+
+
+def format_post(row):
+    post_id, content, username, post_url, indexed_at, author_id, attachments = row
+    return {
+        "id": str(post_id),
+        "content": content,
+        "username": username,
+        "post_url": post_url,
+        "indexed_at": int(indexed_at.timestamp())*1000,
+        "attachments": attachments,
+        "author_id": author_id
+    }
+
+
+def post_row(cursor):
+    """psycopg row factory that builds each row of a select_posts() query straight into its response dict."""
+    return format_post
@@ -7,32 +7,122 @@ CREATE TABLE authors (
         username TEXT NOT NULL
 );
 
+-- posts and attachments are range-partitioned by indexed_at; partitions.py creates the dated partitions ahead
+-- of time and applies retention. An attachment carries its post's indexed_at, so both tables share bounds and
+-- retention drops matching partitions of both (hence no foreign key from attachments to posts).
 CREATE TABLE posts (
-       id UUID PRIMARY KEY,
+       id UUID NOT NULL,
        content TEXT NOT NULL,
        post_url TEXT NOT NULL,
        tags JSONB NOT NULL,
        author_id INT NOT NULL,
-       indexed_at TIMESTAMPTZ DEFAULT NOW(),
+       indexed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
        content_ts tsvector GENERATED ALWAYS AS (to_tsvector('english', content)) STORED,
+       PRIMARY KEY (id, indexed_at),
        FOREIGN KEY (author_id) REFERENCES authors(id)
-);
+) PARTITION BY RANGE (indexed_at);
 
 CREATE TABLE attachments (
-     id SERIAL PRIMARY KEY,
+     id SERIAL,
      post_id UUID NOT NULL,
      description TEXT,
      description_ts tsvector GENERATED ALWAYS AS (to_tsvector('english', description)) STORED,
      url TEXT NOT NULL,
-     indexed_at TIMESTAMPTZ DEFAULT NOW(),
-     FOREIGN KEY (post_id) REFERENCES posts(id) ON DELETE CASCADE
+     indexed_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+     PRIMARY KEY (id, indexed_at)
+) PARTITION BY RANGE (indexed_at);
+
+-- One row per (tag, post) with the post's indexed_at, so a tag page is a range scan of the primary key
+CREATE TABLE post_tags (
+     tag TEXT NOT NULL,
+     indexed_at TIMESTAMPTZ NOT NULL,
+     post_id UUID NOT NULL,
+     PRIMARY KEY (tag, indexed_at, post_id)
+) PARTITION BY RANGE (indexed_at);
+
+-- A partitioned table's unique constraints have to include the partition key, so posts cannot keep its IDs
+-- unique on its own; ingest claims every post's ID here, in the same transaction as the post. Retention
+-- removes the IDs of the posts it removes. `python partitions.py migrate` fills it on databases that predate it.
+CREATE TABLE IF NOT EXISTS post_ids (
+     id UUID PRIMARY KEY,
+     indexed_at TIMESTAMPTZ NOT NULL
 );
+CREATE INDEX IF NOT EXISTS post_ids_indexed_at_idx ON post_ids(indexed_at);
+
+-- Rows outside every dated partition land here until partitions.py moves them
+CREATE TABLE posts_default PARTITION OF posts DEFAULT;
+CREATE TABLE attachments_default PARTITION OF attachments DEFAULT;
+CREATE TABLE post_tags_default PARTITION OF post_tags DEFAULT;
+
+-- This week's partitions and the next PARTITION_PREMAKE (7) weeks', named and bounded like partitions.py makes
+-- them, so rows land in dated partitions from the start; from here on the maintain_partitions task keeps ahead
+DO $$
+DECLARE
+    week_start TIMESTAMP := date_trunc('week', now() AT TIME ZONE 'UTC');
+    parent TEXT;
+BEGIN
+    FOR i IN 0..7 LOOP
+        FOREACH parent IN ARRAY ARRAY['posts', 'attachments', 'post_tags'] LOOP
+            EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF %I FOR VALUES FROM (%L) TO (%L)',
+                           parent || '_p' || to_char(week_start + i * interval '1 week', 'YYYYMMDD'), parent,
+                           to_char(week_start + i * interval '1 week', 'YYYY-MM-DD') || ' 00:00:00+00',
+                           to_char(week_start + (i + 1) * interval '1 week', 'YYYY-MM-DD') || ' 00:00:00+00');
+        END LOOP;
+    END LOOP;
+END
+$$;
 
-CREATE INDEX posts_author_id_idx ON posts(author_id);
-CREATE INDEX post_created_at_idx ON posts(indexed_at);
-CREATE INDEX post_id_idx ON posts(post);
-CREATE INDEX posts_tags_idx ON posts USING GIN(description_ts);
 CREATE INDEX posts_text_idx ON posts USING GIN(content_ts);
 
 ALTER TABLE posts ADD COLUMN IF NOT EXISTS meilisearch_indexed BOOLEAN DEFAULT FALSE;
 
+
+-- Keyset pagination for search: ORDER BY indexed_at DESC, id DESC with (indexed_at, id) < cursor
+CREATE INDEX IF NOT EXISTS posts_indexed_at_id_idx ON posts(indexed_at DESC, id DESC);
+-- Covered by the index above, indexed_at ranges included
+DROP INDEX IF EXISTS post_created_at_idx;
+
+-- Author pages: keyset pagination over one author's posts, newest first
+CREATE INDEX IF NOT EXISTS posts_author_id_indexed_at_id_idx ON posts(author_id, indexed_at DESC, id DESC);
+DROP INDEX IF EXISTS posts_author_id_idx;
+
+-- Per-author aggregates kept by ingest and retention (author_pages.py), so author pages count nothing
+ALTER TABLE authors ADD COLUMN IF NOT EXISTS post_count INT NOT NULL DEFAULT 0;
+ALTER TABLE authors ADD COLUMN IF NOT EXISTS attachment_count INT NOT NULL DEFAULT 0;
+ALTER TABLE authors ADD COLUMN IF NOT EXISTS first_seen TIMESTAMPTZ;
+ALTER TABLE authors ADD COLUMN IF NOT EXISTS last_seen TIMESTAMPTZ;
+
+-- Attachments are looked up per post when posts are hydrated
+CREATE INDEX IF NOT EXISTS attachments_post_id_idx ON attachments(post_id);
+
+-- /api/search matches alt-text as well as post content
+CREATE INDEX IF NOT EXISTS attachments_description_idx ON attachments USING GIN(description_ts);
+CREATE INDEX IF NOT EXISTS attachments_indexed_at_post_id_idx ON attachments(indexed_at DESC, post_id DESC);
+
+-- Author search: substring matches through trigrams, short queries as username prefixes
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX IF NOT EXISTS authors_username_trgm_idx ON authors USING GIN(username gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS authors_url_trgm_idx ON authors USING GIN(url gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS authors_username_prefix_idx ON authors(lower(username) text_pattern_ops);
+
+-- Filled in the background by embeddings.py (ViT-H-14, see clip.yml); the partial indexes keep finding the
+-- rows still waiting cheap once most rows have their embedding
+ALTER TABLE posts ADD COLUMN IF NOT EXISTS text_embedding vector(1024);
+ALTER TABLE attachments ADD COLUMN IF NOT EXISTS vector vector(1024);
+CREATE INDEX IF NOT EXISTS posts_unembedded_idx ON posts(indexed_at, id) WHERE text_embedding IS NULL AND content <> '';
+CREATE INDEX IF NOT EXISTS attachments_unembedded_idx ON attachments(indexed_at, id) WHERE vector IS NULL;
+
+-- Semantic search (semantic_search.py): HNSW rather than IVF, since it needs no training pass over existing
+-- rows and keeps its recall as the embedding pipeline adds vectors; <=> is cosine distance
+CREATE INDEX IF NOT EXISTS posts_text_embedding_idx ON posts USING vectors (text_embedding vector_cos_ops)
+    WITH (options = $$
+[indexing.hnsw]
+m = 16
+ef_construction = 100
+$$);
+CREATE INDEX IF NOT EXISTS attachments_vector_idx ON attachments USING vectors (vector vector_cos_ops)
+    WITH (options = $$
+[indexing.hnsw]
+m = 16
+ef_construction = 100
+$$);
@@ -0,0 +1,235 @@
+"""Where the time goes between a post arriving on the stream and it being served: latency histograms shared
+by the scraper, the ingest workers and the API, the metrics exporter of the Celery workers, an opt-in
+sampling profiler and rate-limited logging for messages that would otherwise be logged on every call.
+
+Celery workers running the prefork pool need PROMETHEUS_MULTIPROC_DIR pointing at an empty directory
+before they start, so that every worker process writes its metrics where the exporter can collect them.
+"""
+import contextvars
+import logging
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import psycopg
+from prometheus_client import REGISTRY, CollectorRegistry, Gauge, Histogram, multiprocess, start_http_server
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# Scraper
+attachment_head_seconds = Histogram('attachment_head_seconds', 'Time attachment HEAD requests took, redirects included',
+                                    ['result'], buckets=LATENCY_BUCKETS)
+buffer_dwell_seconds = Histogram('buffer_dwell_seconds', 'Time a post spent in the buffer before its batch was flushed',
+                                 buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30))
+enqueue_seconds = Histogram('ingest_enqueue_seconds', 'Time packing a batch and handing it to the broker took',
+                            buckets=LATENCY_BUCKETS)
+
+# Ingest workers
+ingest_phase_seconds = Histogram('ingest_phase_seconds', 'Time ingest_batch spent on each phase of a batch', ['phase'],
+                                 buckets=LATENCY_BUCKETS)
+
+# API
+api_query_seconds = Histogram('api_query_seconds', 'Time a request spent in database queries, by endpoint', ['endpoint'],
+                              buckets=LATENCY_BUCKETS)
+
+# Connection pools, "api" (async, per request) or "worker" (ingest tasks)
+db_pool_wait = Histogram('db_pool_wait_seconds', 'Time spent waiting for a pooled connection', ['pool'],
+                         buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10))
+db_pool_in_use = Gauge('db_pool_in_use', 'Pool connections currently handed out', ['pool'], multiprocess_mode='livesum')
+db_pool_size = Gauge('db_pool_size', 'Connections currently held by the pool', ['pool'], multiprocess_mode='livesum')
+db_pool_max_size = Gauge('db_pool_max_size', 'Connections the pool may open', ['pool'], multiprocess_mode='livesum')
+db_pool_waiting = Gauge('db_pool_waiting', 'Callers queued for a connection because the pool is saturated', ['pool'],
+                        multiprocess_mode='livesum')
+
+
+class PhaseTimer:
+    """Adds up the time spent in each phase of one batch, then observes every phase once."""
+
+    def __init__(self, histogram=ingest_phase_seconds):
+        self.histogram = histogram
+        self.seconds = {}
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] = self.seconds.get(name, 0.0) + time.perf_counter() - start
+
+    def observe(self):
+        for name, seconds in self.seconds.items():
+            self.histogram.labels(name).observe(seconds)
+
+
+_query_seconds = contextvars.ContextVar("query_seconds", default=None)
+
+
+@contextmanager
+def query_time():
+    """Adds up the time TimedAsyncCursor queries take inside the block, in the one-element list it yields."""
+    total = [0.0]
+    token = _query_seconds.set(total)
+    try:
+        yield total
+    finally:
+        _query_seconds.reset(token)
+
+
+def add_query_time(seconds):
+    total = _query_seconds.get()
+    if total is not None:
+        total[0] += seconds
+
+
+class TimedAsyncCursor(psycopg.AsyncCursor):
+    """AsyncCursor adding the time every execute() takes to the surrounding query_time() block."""
+
+    async def execute(self, *args, **kwargs):
+        start = time.perf_counter()
+        try:
+            return await super().execute(*args, **kwargs)
+        finally:
+            add_query_time(time.perf_counter() - start)
+
+
+class QueryTimeMiddleware:
+    """ASGI middleware observing api_query_seconds for every HTTP request that reached an endpoint."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        with query_time() as total:
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                # Set by the router once it matched; mounts (static files) have no endpoint
+                route = scope.get("route")
+                if hasattr(route, "endpoint"):
+                    api_query_seconds.labels(route.path).observe(total[0])
+
+
+def start_metrics_server(port):
+    """Serves /metrics on port from a background thread. With PROMETHEUS_MULTIPROC_DIR set, the metrics of
+    every process writing there are served, not just this one's."""
+    registry = REGISTRY
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    start_http_server(port, registry=registry)
+
+
+def mark_process_dead(pid):
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        multiprocess.mark_process_dead(pid)
+
+
+class SamplingProfiler:
+    """Samples the stack of every thread each interval seconds and keeps a count per distinct stack. Every
+    flush_interval seconds the counts so far are written to path in the folded format flamegraph.pl and
+    speedscope read: one "thread;outermost;...;innermost count" line per stack."""
+
+    def __init__(self, path, interval=0.01, flush_interval=60):
+        self.path = path
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.counts = {}
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True, name="sampling-profiler")
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        self.flush()
+
+    def sample(self):
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        for ident, frame in sys._current_frames().items():
+            if ident == self.thread.ident:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            stack.append(names.get(ident, str(ident)))
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+
+    def flush(self):
+        with open(self.path + ".tmp", "w") as f:
+            for stack, count in self.counts.items():
+                f.write("%s %d\n" % (stack, count))
+        os.replace(self.path + ".tmp", self.path)
+
+    def _run(self):
+        last_flush = time.monotonic()
+        while not self.stopped.wait(self.interval):
+            self.sample()
+            if time.monotonic() - last_flush >= self.flush_interval:
+                self.flush()
+                last_flush = time.monotonic()
+
+
+def start_profiler(name):
+    """Starts a SamplingProfiler writing to PROFILE_DIR/<name>-<pid>.folded if PROFILE_DIR is set."""
+    directory = os.getenv("PROFILE_DIR")
+    if not directory:
+        return None
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, "%s-%d.folded" % (name, os.getpid()))
+    logging.info("Profiling %s into %s" % (name, path))
+    return SamplingProfiler(path, interval=float(os.getenv("PROFILE_INTERVAL", 0.01)),
+                            flush_interval=float(os.getenv("PROFILE_FLUSH_INTERVAL", 60))).start()
+
+
+class RateLimitedLog:
+    """Logs each message at most burst times per interval seconds. The fields are appended as key=value
+    pairs and passed on as the record's "fields" attribute; how many records of a message were held back
+    is reported with the next one that gets through."""
+
+    def __init__(self, logger=None, interval=60.0, burst=5):
+        self.logger = logger or logging.getLogger()
+        self.interval = interval
+        self.burst = burst
+        self.windows = {}
+        self.lock = threading.Lock()
+
+    def log(self, level, message, **fields):
+        if not self.logger.isEnabledFor(level):
+            return
+        now = time.monotonic()
+        with self.lock:
+            started, logged, suppressed = self.windows.get(message, (now, 0, 0))
+            if now - started >= self.interval:
+                started, logged = now, 0
+            if logged >= self.burst:
+                self.windows[message] = (started, logged, suppressed + 1)
+                return
+            self.windows[message] = (started, logged + 1, 0)
+        if suppressed:
+            fields["suppressed"] = suppressed
+        self.logger.log(level, "%s %s" % (message, " ".join("%s=%s" % item for item in fields.items())),
+                        extra={"fields": fields})
+
+    def debug(self, message, **fields):
+        self.log(logging.DEBUG, message, **fields)
+
+    def info(self, message, **fields):
+        self.log(logging.INFO, message, **fields)
+
+    def warning(self, message, **fields):
+        self.log(logging.WARNING, message, **fields)
+
+    def error(self, message, **fields):
+        self.log(logging.ERROR, message, **fields)
@@ -1,11 +1,27 @@
-import asyncio
-import time
+import logging
+import os
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, Request, WebSocket
+from prometheus_client import make_asgi_app
+from psycopg_pool import PoolTimeout
+import redis.asyncio
+from starlette.responses import JSONResponse
 from starlette.exceptions import HTTPException
 from starlette.staticfiles import StaticFiles
 
+import author_pages
+import author_search
 import database
+import hydrate
+import instrumentation
+import post_search
+import responses
+import semantic_search
+import stats
+import tags
+from broadcast import Broadcaster
+from responses import FastJSONResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.middleware.cors import CORSMiddleware
 from starlette.exceptions import HTTPException as StarletteHTTPException
@@ -14,7 +30,18 @@ origins = [
     "http://localhost:3000",
 ]
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app):
+    await database.open_async_db_pool()
+    broadcaster.start()
+    profiler = instrumentation.start_profiler("api")
+    yield
+    if profiler:
+        profiler.stop()
+    await broadcaster.stop()
+    await database.close_async_db_pool()
+
+app = FastAPI(lifespan=lifespan, default_response_class=FastJSONResponse)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins,
@@ -22,196 +49,197 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(instrumentation.QueryTimeMiddleware)
 
-cachedStats = {
-    "posts": 0,
-    "attachments": 0,
-    "last_updated": 0
-}
+app.mount("/metrics", make_asgi_app())
+
+@app.exception_handler(PoolTimeout)
+async def pool_timeout(request, exc):
+    # Every pooled connection stayed busy for DB_POOL_TIMEOUT seconds
+    return JSONResponse({"error": "Database busy, try again"}, status_code=503)
+
+# Result counts stop at this many matches, counting every match of a common word is a full index scan
+SEARCH_COUNT_CAP = int(os.getenv("SEARCH_COUNT_CAP", 1000))
+
+redis_client = redis.asyncio.Redis.from_url(database.get_redis_url())
+
+search_cache = post_search.SearchCache(redis_client, ttl=int(os.getenv("SEARCH_CACHE_TTL", 30)))
+
+stats_snapshot = stats.StatsSnapshot(redis_client, ttl=int(os.getenv("STATS_CACHE_TTL", 60)))
+
+author_search_cache = author_search.AuthorSearchCache(redis_client,
+                                                      ttl=int(os.getenv("AUTHOR_SEARCH_CACHE_TTL", 300)))
+AUTHOR_TYPEAHEAD_MIN_LENGTH = int(os.getenv("AUTHOR_TYPEAHEAD_MIN_LENGTH", 3))
+AUTHOR_TYPEAHEAD_LIMIT = int(os.getenv("AUTHOR_TYPEAHEAD_LIMIT", 10))
+
+# Short, so a busy author's newest posts and counts show up soon; mostly absorbs bursts on one page
+author_page_cache = author_pages.AuthorPageCache(redis_client,
+                                                 ttl=int(os.getenv("AUTHOR_PAGE_CACHE_TTL", 15)))
+
+tag_page_cache = tags.TagPageCache(redis_client, ttl=int(os.getenv("TAG_PAGE_CACHE_TTL", 30)))
+
+query_embeddings = semantic_search.QueryEmbeddingCache(database.get_redis_connection(),
+                                                       max_size=int(os.getenv("QUERY_EMBEDDING_CACHE_SIZE", 10000)))
 
 # Posts within last 7 days
 @app.get("/api/stats")
 async def counts():
-    # Cache the stats for 5 minutes
-    if cachedStats["last_updated"] + 300 < time.time():
-        cachedStats["last_updated"] = time.time()
-        with database.get_db_connection() as connection:
-            cursor = connection.cursor()
-            cursor.execute("SELECT COUNT(*) FROM posts WHERE indexed_at > now() - interval '7 days'")
-            post_count = cursor.fetchone()[0]
-            cursor.execute("SELECT COUNT(*) FROM attachments WHERE indexed_at > now() - interval '7 days'")
-            attachment_count = cursor.fetchone()[0]
-
-            cachedStats["posts"] = post_count
-            cachedStats["attachments"] = attachment_count
-
-    return {"posts": cachedStats["posts"], "attachments": cachedStats["attachments"]}
+    totals = await stats_snapshot.get()
+    return {"posts": totals["posts"], "attachments": totals["attachments"]}
 
 @app.get("/api/author/search")
-async def search_authors(q: str):
-    q = q.strip()
-    q = q.replace("%", "") # lmao
-    # Add wildcards to query
-    q = f"%{q}%"
-
-    with database.get_db_connection() as connection:
+async def search_authors(q: str, typeahead: bool = False):
+    q = post_search.normalize_query(q)
+    if typeahead:
+        # Keystroke-driven: nothing until the query is selective enough, and only a few suggestions
+        if len(q) < AUTHOR_TYPEAHEAD_MIN_LENGTH:
+            return FastJSONResponse([])
+        limit = AUTHOR_TYPEAHEAD_LIMIT
+    else:
+        limit = 50
+
+    results = await author_search_cache.get_results(q, limit)
+    if results is not None:
+        return FastJSONResponse(results)
+
+    async with database.get_async_db_connection() as connection:
         cursor = connection.cursor()
-        cursor.execute("SELECT id, username, url FROM authors WHERE username ILIKE %s OR url ILIKE %s LIMIT 50", (q, q))
-        authors = cursor.fetchall()
-        return [{"id": author[0], "username": author[1], "url": author[2]} for author in authors]
+        authors = await author_search.search_authors(cursor, q, limit)
+
+    results = responses.encode(authors)
+    await author_search_cache.put_results(q, limit, results)
+    return FastJSONResponse(results)
 
 @app.get("/api/author/{author_id}")
-async def author(author_id: int, offset: int = 0):
-    with database.get_db_connection() as connection:
-        cursor = connection.cursor()
-        cursor.execute("SELECT username, url FROM authors WHERE id = %s", (author_id,))
-        author = cursor.fetchone()
+async def author(author_id: int, cursor: str = None, offset: int = 0):
+    page = await author_page_cache.get_page(author_id, cursor, offset)
+    if page is not None:
+        return FastJSONResponse(page)
+
+    after = None
+    if cursor:
+        try:
+            after = post_search.decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    async with database.get_async_db_connection() as connection:
+        db_cursor = connection.cursor()
+        author = await author_pages.get_author(db_cursor, author_id)
         if not author:
             return {"error": "Author not found"}
+        posts, next_cursor = await author_pages.author_posts(db_cursor, author_id, after=after, offset=offset)
 
-        cursor.execute("SELECT COUNT(*) FROM posts WHERE author_id = %s", (author_id,))
-        total_posts = cursor.fetchone()[0]
-
-        cursor.execute("SELECT \"posts\".id AS id, content, post_url, date_part('epoch', indexed_at) AS indexed_at FROM posts WHERE author_id = %s ORDER BY posts.indexed_at DESC LIMIT 50 OFFSET %s", (author_id, offset))
-        posts = cursor.fetchall()
-
-        postIDs = []
-        for post in posts:
-            postIDs.append(post[0])
-
-        cursor.execute("SELECT post_id, description, url FROM attachments WHERE post_id = ANY(%s)", (postIDs,))
-        attachments = cursor.fetchall()
-
-        formatted_posts = []
-        for post in posts:
-            attachments_for_post = []
-            for attachment in attachments:
-                if attachment[0] == post[0]:
-                    attachments_for_post.append({
-                        "id": attachment[0],
-                        "description": attachment[1],
-                        "url": attachment[2]
-                    })
-
-            formatted_posts.append({
-                "id": post[0],
-                "content": post[1],
-                "post_url": post[2],
-                "indexed_at": int(post[3])*1000,
-                "attachments": attachments_for_post,
-                "author_id": author_id,
-                "username": author[0]
-            })
-        print(formatted_posts)
-
-        return {"id": author_id, "username": author[0], "url": author[1], "posts": formatted_posts, "total_posts": total_posts}
+    page = responses.encode({**author, "posts": posts, "next_cursor": next_cursor})
+    await author_page_cache.put_page(author_id, cursor, offset, page)
+    return FastJSONResponse(page)
 
 @app.get("/api/search")
-async def search(q: str, offset: int = 0):
-    with database.get_db_connection() as connection:
-        cursor = connection.cursor()
-
-        # Get potential result count
-        cursor.execute("SELECT COUNT(*) FROM posts WHERE posts.content_ts @@ websearch_to_tsquery('english', %s::text)", (q,))
-        total_result_count = cursor.fetchone()[0]
-        if total_result_count == 0:
-            return {"posts": []}
-
-        cursor.execute(
-            "SELECT \"posts\".id AS id, content, a.username, post_url, date_part('epoch', indexed_at) AS indexed_at, a.id FROM (SELECT * FROM posts WHERE posts.content_ts @@ websearch_to_tsquery('english', %s::text)) AS posts "
-            "JOIN authors a on posts.author_id = a.id "
-            "ORDER BY indexed_at DESC LIMIT 50 OFFSET %s",
-            (q, offset, ))
-        posts = cursor.fetchall()
-
-        # Get attachments of the posts
-        postIDs = []
-        for post in posts:
-            postIDs.append(post[0])
-
-        if not postIDs:
-            return {"posts": []}
-
-        cursor.execute("SELECT post_id, description, url FROM attachments WHERE post_id = ANY(%s)", (postIDs,))
-
-        attachments = cursor.fetchall()
-
-        formatted_posts = []
-        for post in posts:
-            attachments_for_post = []
-            for attachment in attachments:
-                if attachment[0] == post[0]:
-                    attachments_for_post.append({
-                        "id": attachment[0],
-                        "description": attachment[1],
-                        "url": attachment[2]
-                    })
-
-            formatted_posts.append({
-                "id": post[0],
-                "content": post[1],
-                "username": post[2],
-                "post_url": post[3],
-                "indexed_at": int(post[4])*1000,
-                "attachments": attachments_for_post,
-                "author_id": post[5]
-            })
-
-        return {"posts": formatted_posts, "total_result_count": total_result_count}
-
+async def search(q: str, cursor: str = None, offset: int = 0, order: str = "recent", images: bool = False):
+    if order not in post_search.ORDERS:
+        raise HTTPException(status_code=400, detail="order must be one of %s" % ", ".join(post_search.ORDERS))
+    q = post_search.normalize_query(q)
+    page = await search_cache.get_page(q, cursor, offset, order, images)
+    if page is not None:
+        # Already encoded
+        return FastJSONResponse(page)
+
+    after = None
+    if cursor:
+        try:
+            after = post_search.decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+        if order == "relevance" and len(after) != 3:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    async with database.get_async_db_connection() as connection:
+        db_cursor = connection.cursor()
+
+        count = await search_cache.get_count(q, images)
+        if count is None:
+            total_result_count, capped = await post_search.count_matches(db_cursor, q, SEARCH_COUNT_CAP, images=images)
+            count = {"total_result_count": total_result_count, "total_result_count_capped": capped}
+            await search_cache.put_count(q, count, images)
+
+        if count["total_result_count"] == 0:
+            posts, next_cursor = [], None
+        else:
+            posts, next_cursor = await post_search.search_posts(db_cursor, q, after=after, offset=offset, order=order, images=images)
+
+    page = responses.encode({"posts": posts, "next_cursor": next_cursor, **count})
+    await search_cache.put_page(q, cursor, offset, page, order, images)
+    return FastJSONResponse(page)
+
+
+@app.get("/api/tag/{name}")
+async def tag_page(name: str, cursor: str = None):
+    name = tags.normalize_tag(name)
+    page = await tag_page_cache.get_page(name, cursor, 0)
+    if page is not None:
+        return FastJSONResponse(page)
+
+    after = None
+    if cursor:
+        try:
+            after = post_search.decode_cursor(cursor)
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    async with database.get_async_db_connection() as connection:
+        posts, next_cursor = await tags.tag_posts(connection.cursor(), name, after=after)
+
+    page = responses.encode({"tag": name, "posts": posts, "next_cursor": next_cursor})
+    await tag_page_cache.put_page(name, cursor, 0, page)
+    return FastJSONResponse(page)
+
+@app.get("/api/tags/trending")
+async def trending_tags(hours: int = 24, limit: int = 20):
+    if not 0 < hours <= tags.WINDOW_HOURS or not 0 < limit <= 100:
+        raise HTTPException(status_code=400, detail="hours must be between 1 and %d, limit between 1 and 100" % tags.WINDOW_HOURS)
+    return await tags.trending(redis_client, hours, limit)
+
+@app.get("/api/semantic_search")
+async def semantic_search_posts(q: str, hybrid: bool = True, limit: int = 50):
+    if not 0 < limit <= 100:
+        raise HTTPException(status_code=400, detail="limit must be between 1 and 100")
+    async with database.get_async_db_connection() as connection:
+        results = await semantic_search.semantic_search(connection, query_embeddings, q, limit=limit, hybrid=hybrid)
+    return FastJSONResponse(responses.encode(results))
+
+
+async def fetch_stream_posts(post_ids):
+    with instrumentation.query_time() as total:
+        async with database.get_async_db_connection() as connection:
+            cursor = connection.cursor(row_factory=hydrate.post_row)
+            # Just-ingested posts, so only the newest partitions need to be probed
+            await cursor.execute(hydrate.select_posts("WHERE posts.id = ANY(%s::uuid[]) AND posts.indexed_at > now() - interval '1 day' "
+                                                      "ORDER BY posts.indexed_at DESC LIMIT 50"),
+                                 (post_ids,))
+            posts = await cursor.fetchall()
+    instrumentation.api_query_seconds.labels("/stream").observe(total[0])
+    return posts
+
+broadcaster = Broadcaster(redis_client, fetch_stream_posts,
+                          queue_size=int(os.getenv("STREAM_QUEUE_SIZE", 32)))
 
 @app.websocket("/stream")
 async def stream_posts(websocket: WebSocket):
     await websocket.accept()
-    last_unix = int(time.time())
+    subscriber = broadcaster.subscribe()
     try:
         while True:
-            with database.get_db_connection() as connection:
-                cursor = connection.cursor()
-                cursor.execute(
-                    "SELECT posts.id AS id, content, a.username, post_url, date_part('epoch', indexed_at), author_id AS indexed_at FROM posts "
-                    "JOIN authors a on posts.author_id = a.id WHERE indexed_at > to_timestamp(%s) "
-                    "ORDER BY indexed_at DESC LIMIT 50",
-                    (last_unix,))
-
-                posts = cursor.fetchall()
-                postIDs = []
-                for post in posts:
-                    postIDs.append(post[0])
-
-                cursor.execute("SELECT post_id, description, url FROM attachments WHERE post_id = ANY(%s)", (postIDs,))
-                attachments = cursor.fetchall()
-
-                formatted_posts = []
-                for post in posts:
-                    attachments_for_post = []
-                    for attachment in attachments:
-                        if attachment[0] == post[0]:
-                            attachments_for_post.append({
-                                "id": str(attachment[0]),
-                                "description": attachment[1],
-                                "url": attachment[2]
-                            })
-
-                    formatted_posts.append({
-                        "id": str(post[0]),
-                        "content": post[1],
-                        "username": post[2],
-                        "post_url": post[3],
-                        "indexed_at": int(post[4])*1000,
-                        "attachments": attachments_for_post,
-                        "author_id": str(post[5])
-                    })
-
-                await websocket.send_json({"posts": formatted_posts})
-
-            last_unix = int(time.time())
-            # Sleep 500ms to avoid hammering the database
-            await asyncio.sleep(1)
+            payload = await subscriber.next()
+            if payload is None:
+                # Dropped by the broadcaster for falling too far behind
+                await websocket.close(code=1013)
+                return
+            await websocket.send_text(payload)
     except Exception as e:
-        print("Stream connection closed")
-        print("Error in stream_posts:", e)
+        logging.info("Stream connection closed: %s" % e)
         raise e
+    finally:
+        broadcaster.unsubscribe(subscriber)
 
 
 class SPAStaticFiles(StaticFiles):
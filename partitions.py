@@ -0,0 +1,263 @@
+"""Range partitions of posts, attachments and post_tags by indexed_at.
+
+    python partitions.py maintain    create partitions ahead of time, apply PARTITION_RETENTION_DAYS
+    python partitions.py migrate     bring a database made by an older init.sql up to date: partition
+                                     posts/attachments, fill post_ids (stop the workers first)
+
+init.sql creates the first weeks' partitions and celery beat runs maintain daily (tasks.maintain_partitions,
+every PARTITION_MAINTENANCE_INTERVAL seconds), so new rows land in dated partitions rather than the defaults.
+
+Partitions are named <table>_p<YYYYMMDD> after the UTC day they start on and cover PARTITION_INTERVAL
+("week" or "day"). Rows that fall outside every partition go to <table>_default and are moved into their
+partition when it gets created.
+"""
+import argparse
+import logging
+import os
+import re
+from datetime import datetime, timedelta, timezone
+
+import psycopg
+from psycopg import sql
+
+import author_pages
+
+# Every table partitioned by indexed_at; attachments and post_tags rows carry their post's indexed_at
+TABLES = ("posts", "attachments", "post_tags")
+# The tables `migrate` converts from their original unpartitioned form
+MIGRATED_TABLES = ("posts", "attachments")
+INTERVALS = {"day": timedelta(days=1), "week": timedelta(weeks=1)}
+# Indexes of older schemas that the partitioned tables do not need: the (id, indexed_at) primary key covers posts(id)
+REDUNDANT_INDEXES = ("post_id_idx",)
+
+# Weekly by default: every partition adds to the planning time of the queries that cannot prune at plan time
+# (search ordering, the attachments subquery), and with daily ones that cost outweighed the scans it saved
+PARTITION_INTERVAL = os.getenv("PARTITION_INTERVAL", "week")
+# Partitions created ahead of the current one
+PARTITION_PREMAKE = int(os.getenv("PARTITION_PREMAKE", 7))
+# Partitions entirely older than this are detached, 0 keeps everything
+PARTITION_RETENTION_DAYS = int(os.getenv("PARTITION_RETENTION_DAYS", 0))
+# Drop detached partitions instead of leaving them around as plain tables
+PARTITION_RETENTION_DROP = os.getenv("PARTITION_RETENTION_DROP", "") not in ("", "0")
+
+_BOUND = re.compile(r"FROM \('([^']+)'\) TO \('([^']+)'\)")
+
+
+def period_start(moment, interval=PARTITION_INTERVAL):
+    start = moment.astimezone(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    if interval == "week":
+        start -= timedelta(days=start.weekday())
+    return start
+
+
+def partition_name(table, start):
+    return "%s_p%s" % (table, start.strftime("%Y%m%d"))
+
+
+def _parse_bound(value):
+    # Postgres prints "2024-08-01 00:00:00+00", Python 3.10 wants the offset as +00:00
+    if re.search(r"[+-]\d\d$", value):
+        value += ":00"
+    return datetime.fromisoformat(value)
+
+
+def existing_partitions(cursor, table):
+    """[(name, start, end)] of the dated partitions of table, oldest first."""
+    cursor.execute("SET LOCAL TIME ZONE 'UTC'")
+    cursor.execute("SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+                   "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = %s::regclass", (table,))
+    partitions = []
+    for name, bound in cursor.fetchall():
+        match = _BOUND.search(bound)
+        if match:
+            partitions.append((name, _parse_bound(match.group(1)), _parse_bound(match.group(2))))
+    return sorted(partitions, key=lambda partition: partition[1])
+
+
+def insertable_columns(cursor, table):
+    cursor.execute("SELECT column_name FROM information_schema.columns "
+                   "WHERE table_schema = current_schema() AND table_name = %s AND is_generated = 'NEVER' "
+                   "ORDER BY ordinal_position", (table,))
+    return [row[0] for row in cursor.fetchall()]
+
+
+def create_partition(cursor, table, start, end):
+    name = partition_name(table, start)
+    bounds = (sql.Identifier(name), sql.Identifier(table), sql.Literal(start.isoformat()), sql.Literal(end.isoformat()))
+    default = sql.Identifier(table + "_default")
+    cursor.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {} WHERE indexed_at >= %s AND indexed_at < %s)").format(default),
+                   (start, end))
+    if not cursor.fetchone()[0]:
+        cursor.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})").format(*bounds))
+        return name
+
+    # The new bounds would overlap rows in the default partition: take it out, create the partition,
+    # route those rows through the parent into it and put the default partition back
+    columns = sql.SQL(", ").join(map(sql.Identifier, insertable_columns(cursor, table)))
+    cursor.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(sql.Identifier(table), default))
+    cursor.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})").format(*bounds))
+    cursor.execute(sql.SQL("WITH moved AS (DELETE FROM {} WHERE indexed_at >= %s AND indexed_at < %s RETURNING *) "
+                           "INSERT INTO {} ({}) SELECT {} FROM moved").format(default, sql.Identifier(table), columns, columns),
+                   (start, end))
+    logging.info("Moved %d rows of %s out of the default partition" % (cursor.rowcount, name))
+    cursor.execute(sql.SQL("ALTER TABLE {} ATTACH PARTITION {} DEFAULT").format(sql.Identifier(table), default))
+    return name
+
+
+def ensure_partitions(connection, first=None, now=None, interval=PARTITION_INTERVAL, premake=PARTITION_PREMAKE):
+    """Creates the missing partitions of each table from first (default: now) up to premake intervals ahead."""
+    step = INTERVALS[interval]
+    now = now or datetime.now(timezone.utc)
+    created = []
+    with connection.transaction():
+        cursor = connection.cursor()
+        for table in TABLES:
+            cursor.execute("SELECT to_regclass(%s)", (table,))
+            if cursor.fetchone()[0] is None:
+                # Not created yet on a database that predates it
+                continue
+            existing = existing_partitions(cursor, table)
+            start = period_start(first or now, interval)
+            last = period_start(now, interval) + premake * step
+            while start <= last:
+                end = start + step
+                # Leave ranges alone that an older partition (e.g. of another interval) already covers
+                if not any(start < other_end and other_start < end for _, other_start, other_end in existing):
+                    created.append(create_partition(cursor, table, start, end))
+                start = end
+    for name in created:
+        logging.info("Created partition %s" % name)
+    return created
+
+
+def apply_retention(connection, retention_days=PARTITION_RETENTION_DAYS, drop=PARTITION_RETENTION_DROP, now=None):
+    """Detaches (and with drop, drops) the partitions whose rows are all older than retention_days."""
+    if not retention_days:
+        return []
+    cutoff = (now or datetime.now(timezone.utc)) - timedelta(days=retention_days)
+    removed = []
+    with connection.transaction():
+        cursor = connection.cursor()
+        for table in TABLES:
+            cursor.execute("SELECT to_regclass(%s)", (table,))
+            if cursor.fetchone()[0] is None:
+                continue
+            for name, start, end in existing_partitions(cursor, table):
+                if end > cutoff:
+                    break
+                if table == "posts":
+                    # While the range's attachments are still attached too
+                    author_pages.forget_range(cursor, start, end)
+                    cursor.execute("DELETE FROM post_ids WHERE indexed_at >= %s AND indexed_at < %s", (start, end))
+                cursor.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(sql.Identifier(table), sql.Identifier(name)))
+                if drop:
+                    cursor.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(name)))
+                removed.append(name)
+    for name in removed:
+        logging.info("%s partition %s" % ("Dropped" if drop else "Detached", name))
+    return removed
+
+
+def maintain(connection):
+    return ensure_partitions(connection), apply_retention(connection)
+
+
+def migrate(connection, interval=PARTITION_INTERVAL, premake=PARTITION_PREMAKE):
+    """Brings a database made by an older init.sql up to date, in one transaction.
+
+    Unpartitioned posts/attachments are rebuilt as partitioned tables; the old tables stay around as
+    posts_old/attachments_old (indexes suffixed _old) until dropped by hand. Attachments take their post's
+    indexed_at; attachments of missing posts are not carried over. Posts stored before post_ids existed get
+    their IDs claimed there.
+    """
+    with connection.transaction():
+        cursor = connection.cursor()
+        cursor.execute("SELECT relkind FROM pg_class WHERE oid = 'posts'::regclass")
+        if cursor.fetchone()[0] == "p":
+            logging.info("posts is already partitioned")
+        else:
+            _partition_tables(connection, cursor, interval, premake)
+
+        cursor.execute("CREATE TABLE IF NOT EXISTS post_ids (id UUID PRIMARY KEY, indexed_at TIMESTAMPTZ NOT NULL)")
+        cursor.execute("CREATE INDEX IF NOT EXISTS post_ids_indexed_at_idx ON post_ids(indexed_at)")
+        cursor.execute("INSERT INTO post_ids (id, indexed_at) SELECT id, min(indexed_at) FROM posts GROUP BY id "
+                       "ON CONFLICT DO NOTHING")
+        logging.info("Claimed %d post IDs" % cursor.rowcount)
+        for index in REDUNDANT_INDEXES:
+            cursor.execute(sql.SQL("DROP INDEX IF EXISTS {}").format(sql.Identifier(index)))
+
+
+def _partition_tables(connection, cursor, interval, premake):
+    cursor.execute("LOCK TABLE posts, attachments IN ACCESS EXCLUSIVE MODE")
+    index_definitions = {}
+    for table in MIGRATED_TABLES:
+        cursor.execute("SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s",
+                       (table,))
+        index_definitions[table] = cursor.fetchall()
+        for index, _ in index_definitions[table]:
+            cursor.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(sql.Identifier(index), sql.Identifier(index + "_old")))
+        cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(sql.Identifier(table), sql.Identifier(table + "_old")))
+
+        cursor.execute(sql.SQL("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING GENERATED INCLUDING STORAGE) "
+                               "PARTITION BY RANGE (indexed_at)").format(sql.Identifier(table), sql.Identifier(table + "_old")))
+        cursor.execute(sql.SQL("ALTER TABLE {} ALTER COLUMN indexed_at SET NOT NULL, ADD PRIMARY KEY (id, indexed_at)")
+                       .format(sql.Identifier(table)))
+        cursor.execute(sql.SQL("CREATE TABLE {} PARTITION OF {} DEFAULT").format(sql.Identifier(table + "_default"),
+                                                                              sql.Identifier(table)))
+    cursor.execute("ALTER TABLE posts ADD FOREIGN KEY (author_id) REFERENCES authors(id)")
+    # The id sequence would otherwise go away with attachments_old
+    cursor.execute("SELECT pg_get_serial_sequence('attachments_old', 'id')")
+    sequence = cursor.fetchone()[0]
+    if sequence:
+        cursor.execute(sql.SQL("ALTER SEQUENCE {} OWNED BY attachments.id").format(sql.SQL(sequence)))
+
+    cursor.execute("SELECT min(indexed_at) FROM posts_old")
+    ensure_partitions(connection, first=cursor.fetchone()[0], interval=interval, premake=premake)
+
+    columns = insertable_columns(cursor, "posts")
+    cursor.execute(sql.SQL("INSERT INTO posts ({}) SELECT {} FROM posts_old").format(
+        sql.SQL(", ").join(map(sql.Identifier, columns)),
+        sql.SQL(", ").join(sql.SQL("COALESCE(indexed_at, now())") if column == "indexed_at" else sql.Identifier(column)
+                           for column in columns)))
+    logging.info("Copied %d posts" % cursor.rowcount)
+
+    columns = insertable_columns(cursor, "attachments")
+    cursor.execute(sql.SQL("INSERT INTO attachments ({}) SELECT {} FROM attachments_old a "
+                           "JOIN posts p ON p.id = a.post_id").format(
+        sql.SQL(", ").join(map(sql.Identifier, columns)),
+        sql.SQL(", ").join(sql.SQL("p.indexed_at") if column == "indexed_at" else sql.Identifier("a", column)
+                           for column in columns)))
+    logging.info("Copied %d attachments" % cursor.rowcount)
+
+    for table in MIGRATED_TABLES:
+        for index, definition in index_definitions[table]:
+            if definition.startswith("CREATE UNIQUE") or index in REDUNDANT_INDEXES:
+                # Primary keys and unique indexes have to include indexed_at now, posts(id) is covered
+                continue
+            # Read before the renames, so the definition already names the new table
+            try:
+                with connection.transaction():
+                    cursor.execute(definition)
+            except psycopg.Error as e:
+                logging.warning("Could not recreate index %s on partitioned %s: %s" % (index, table, e))
+    cursor.execute("ANALYZE posts")
+    cursor.execute("ANALYZE attachments")
+
+
+def main():
+    import database
+
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("command", choices=("maintain", "migrate"))
+    args = parser.parse_args()
+
+    with database.get_db_connection() as connection:
+        if args.command == "migrate":
+            migrate(connection)
+        created, removed = maintain(connection)
+        print("%d partitions created, %d removed" % (len(created), len(removed)))
+
+
+if __name__ == "__main__":
+    main()
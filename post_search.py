@@ -0,0 +1,183 @@
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import uuid
+from datetime import datetime
+
+import orjson
+from redis import RedisError
+
+import hydrate
+
+PAGE_SIZE = 50
+
+# websearch_to_tsquery ignores case and extra whitespace, so these queries share cache entries
+def normalize_query(q):
+    return " ".join(q.lower().split())
+
+
+def encode_cursor(indexed_at, post_id, score=None):
+    raw = "%s|%s" % (indexed_at.isoformat(), post_id)
+    if score is not None:
+        raw += "|%r" % score
+    return base64.urlsafe_b64encode(raw.encode("utf-8")).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Returns (indexed_at, post_id) of the last post on the previous page, or (indexed_at, post_id, score) for
+    a page ordered by relevance. ValueError if cursor is malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf-8")
+        parts = raw.split("|")
+        if len(parts) not in (2, 3):
+            raise ValueError(raw)
+        after = (datetime.fromisoformat(parts[0]), uuid.UUID(parts[1]))
+        return after + (float(parts[2]),) if len(parts) == 3 else after
+    except (binascii.Error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError("Invalid cursor") from e
+
+
+# Posts match on their content or on the alt-text of one of their attachments. Each source goes through its
+# own GIN index (or walks its indexed_at index for common words) and gives its newest matches, then the two are
+# merged per post.
+QUERY = "websearch_to_tsquery('english', %(q)s::text)"
+WITH_IMAGES = " AND EXISTS (SELECT 1 FROM attachments WHERE attachments.post_id = posts.id AND attachments.indexed_at = posts.indexed_at)"
+
+CONTENT_MATCHES = ("SELECT posts.indexed_at, posts.id{columns} FROM posts WHERE posts.content_ts @@ {query}{images}{after} "
+                   "ORDER BY posts.indexed_at DESC, posts.id DESC LIMIT %(window)s")
+
+DESCRIPTION_MATCHES = ("SELECT {distinct}indexed_at, post_id{columns} FROM attachments WHERE description_ts @@ {query}{after} "
+                       "ORDER BY indexed_at DESC, post_id DESC LIMIT %(window)s")
+
+# Newest first: the union of both sources' newest matches holds the newest posts of either
+MATCHES = "({content}) UNION ({descriptions})"
+
+# By relevance: the best ts_rank of the post's content and its descriptions. Ranks are only computed for the
+# window, ranking every match of a common word would read all of them, the same reason counts are capped.
+RANKED_MATCHES = (
+    "SELECT indexed_at, id, MAX(score) AS score FROM ("
+    "SELECT indexed_at, id, ts_rank(content_ts, {query})::float8 AS score FROM ({content}) AS content UNION ALL "
+    "SELECT indexed_at, post_id, ts_rank(description_ts, {query})::float8 FROM ({descriptions}) AS descriptions"
+    ") AS candidates GROUP BY indexed_at, id"
+)
+
+# Counting needs no order, so neither source has to walk its indexed_at index. Mastodon allows four
+# attachments per post, four times as many matching attachments are at least as many posts.
+COUNT_MATCHES = (
+    "SELECT COUNT(*) FROM ((SELECT posts.indexed_at, posts.id FROM posts WHERE posts.content_ts @@ {query}{images} LIMIT %(window)s) "
+    "UNION (SELECT indexed_at, post_id FROM attachments WHERE description_ts @@ {query} LIMIT %(window)s * 4)) AS matches"
+)
+
+# Keyset order of each sort, on the columns of the matches
+ORDERS = {
+    "recent": "{t}indexed_at DESC, {t}id DESC",
+    "relevance": "{t}score DESC, {t}indexed_at DESC, {t}id DESC",
+}
+
+SEARCH_RANK_WINDOW = int(os.getenv("SEARCH_RANK_WINDOW", 1000))
+
+
+def _matches(images=False, after=""):
+    return MATCHES.format(
+        content=CONTENT_MATCHES.format(columns="", query=QUERY, images=WITH_IMAGES if images else "",
+                                       after=after.format(id="posts.id")),
+        descriptions=DESCRIPTION_MATCHES.format(distinct="DISTINCT ", columns="", query=QUERY, after=after.format(id="post_id")))
+
+
+def _ranked_matches(images=False):
+    return RANKED_MATCHES.format(
+        query=QUERY,
+        content=CONTENT_MATCHES.format(columns=", posts.content_ts", query=QUERY, images=WITH_IMAGES if images else "", after=""),
+        descriptions=DESCRIPTION_MATCHES.format(distinct="", columns=", description_ts", query=QUERY, after=""))
+
+
+async def count_matches(cursor, q, cap, images=False):
+    """Number of posts matching q, counted no further than cap. Returns (count, capped)."""
+    await cursor.execute(COUNT_MATCHES.format(query=QUERY, images=WITH_IMAGES if images else ""), {"q": q, "window": cap + 1})
+    count = (await cursor.fetchone())[0]
+    return min(count, cap), count > cap
+
+
+async def search_posts(cursor, q, after=None, offset=0, limit=PAGE_SIZE, order="recent", images=False):
+    """One page of posts matching q in their content or in an attachment's description, newest first or by
+    relevance, only posts with attachments if images. after is a decoded cursor; offset is only for old clients."""
+    params = {"q": q, "limit": limit, "offset": 0 if after else offset}
+    if order == "relevance":
+        params["window"] = SEARCH_RANK_WINDOW
+        matches = _ranked_matches(images)
+        if after is not None:
+            matches = "SELECT * FROM (%s) AS matches WHERE (score, indexed_at, id) < (%%(score)s, %%(indexed_at)s, %%(id)s)" % matches
+            params.update(indexed_at=after[0], id=after[1], score=after[2])
+        extra_columns = "page.score"
+    else:
+        # Enough of each source's matches to fill the page on their own
+        params["window"] = limit + params["offset"]
+        if after is not None:
+            matches = _matches(images, " AND (indexed_at, {id}) < (%(indexed_at)s, %(id)s)")
+            params.update(indexed_at=after[0], id=after[1])
+        else:
+            matches = _matches(images)
+        extra_columns = ""
+
+    page = "SELECT * FROM (%s) AS matches ORDER BY %s LIMIT %%(limit)s OFFSET %%(offset)s" % (matches, ORDERS[order].format(t=""))
+    await cursor.execute("WITH page AS (%s) " % page + hydrate.select_posts(
+        "JOIN page ON page.id = posts.id AND page.indexed_at = posts.indexed_at ORDER BY %s" % ORDERS[order].format(t="page."),
+        extra_columns), params)
+    posts = await cursor.fetchall()
+    formatted_posts = [hydrate.format_post(post[:7]) for post in posts]
+
+    next_cursor = None
+    if len(posts) == limit:
+        last = posts[-1]
+        next_cursor = encode_cursor(last[4], last[0], last[7] if order == "relevance" else None)
+    return formatted_posts, next_cursor
+
+
+class SearchCache:
+    """Short-lived search results in Redis, keyed on the normalized query, from an asyncio Redis client. A Redis
+    outage only costs the cache."""
+
+    REDIS_PREFIX = "fedibgs:search:"
+
+    def __init__(self, redis, ttl=30, count_ttl=300):
+        self.redis = redis
+        self.ttl = ttl
+        self.count_ttl = count_ttl
+
+    def _key(self, kind, *parts):
+        digest = hashlib.sha1("\x00".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+        return self.REDIS_PREFIX + kind + ":" + digest
+
+    async def _get(self, key):
+        try:
+            return await self.redis.get(key)
+        except RedisError as e:
+            logging.warning("Search cache: Redis lookup failed: %s" % e)
+            return None
+
+    async def _set(self, key, value, ttl):
+        if not ttl:
+            return
+        try:
+            await self.redis.set(key, value, ex=ttl)
+        except RedisError as e:
+            logging.warning("Search cache: Redis store failed: %s" % e)
+
+    async def get_page(self, q, cursor, offset, *options):
+        """The page as encoded JSON bytes, ready to be sent as is. options are whatever else shaped the page."""
+        return await self._get(self._key("page", q, cursor or "", offset, *options))
+
+    async def put_page(self, q, cursor, offset, page, *options):
+        await self._set(self._key("page", q, cursor or "", offset, *options), page, self.ttl)
+
+    async def get_count(self, q, *options):
+        count = await self._get(self._key("count", q, *options))
+        return orjson.loads(count) if count is not None else None
+
+    async def put_count(self, q, count, *options):
+        # Counts drift slowly and are capped anyway, so they outlive the pages. Not a count of no matches though:
+        # search skips the query while it is cached, and the first match can be ingested any moment
+        ttl = self.count_ttl if count["total_result_count"] else min(self.ttl, self.count_ttl)
+        await self._set(self._key("count", q, *options), orjson.dumps(count), ttl)
@@ -0,0 +1,19 @@
+import orjson
+from starlette.responses import Response
+
+
+def encode(content):
+    """Compact UTF-8 JSON of our response shapes: dicts, lists, str, int, bool, None and UUIDs."""
+    return orjson.dumps(content)
+
+
+class FastJSONResponse(Response):
+    """JSON response rendered by orjson. Handlers return it directly, which keeps FastAPI's jsonable_encoder
+    from walking every post; content may also be bytes that were encoded earlier, e.g. from the search cache."""
+
+    media_type = "application/json"
+
+    def render(self, content):
+        if isinstance(content, bytes):
+            return content
+        return encode(content)
@@ -1,16 +1,12 @@
 import hashlib
 import os
-import signal
 import sys
 import threading
 import time
 import uuid
 from asyncio import timeout
-from contextlib import closing
 from datetime import datetime
 
-import requests
-from mastodon import StreamListener
 from prometheus_client import Counter, Histogram
 from fastapi import FastAPI
 from prometheus_client import make_asgi_app
@@ -24,134 +20,134 @@ scraped_attachments = Counter('scraped_attachments', 'Number of attachments scra
 scraped_posts_heatmap = Histogram('post_time_by_hour', 'Post time by hour', buckets=(0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10,
                                                                                    11, 12, 13, 14, 15, 16, 17, 18, 19,
                                                                                    20, 21, 22, 23))
+stream_posts = Counter('stream_posts', 'Posts accepted from each streaming endpoint', ['endpoint'])
+stream_duplicates = Counter('stream_duplicates', 'Posts dropped because another endpoint already delivered them', ['endpoint'])
 
 import database
+import instrumentation
 import tasks
-
-STREAM_BASE = "https://fedi.buzz"
+import wire
+from attachment_resolver import AttachmentResolver
+from batcher import AdaptiveBatcher
+from dedup import SeenPosts
+from streaming import SupervisedListener, stream_timeline
+
+# Comma-separated list of instances/relays to follow, all in this process
+STREAM_BASES = ["https://fedi.buzz"]
 if len(sys.argv) >= 2 and sys.argv[1]:
-    STREAM_BASE = sys.argv[1]
+    STREAM_BASES = [base.strip().rstrip("/") for base in sys.argv[1].split(",") if base.strip()]
 
-# Get endpoint from ARGV
-FEDERATED_TIMELINE_STREAM = STREAM_BASE + "/api/v1/streaming/public"
+# Get endpoints from ARGV
+FEDERATED_TIMELINE_STREAMS = {base: base + "/api/v1/streaming/public" for base in STREAM_BASES}
 
 AUTH_HEADER = None
 if len(sys.argv) >= 3 and sys.argv[2]:
     logging.info("Using provided auth header")
     AUTH_HEADER = "Bearer " + sys.argv[2].strip()
 
-queue_buffer = []
-buffer_size = 32
-class BGSListener(StreamListener):
+
+def send_batch(batch):
+    with instrumentation.enqueue_seconds.time():
+        tasks.ingest_batch.delay(wire.pack_batch(batch))
+
+
+batcher = AdaptiveBatcher(send_batch,
+                          min_size=int(os.getenv("BATCH_MIN_SIZE", 16)),
+                          max_size=int(os.getenv("BATCH_MAX_SIZE", 512)),
+                          max_latency=float(os.getenv("BATCH_MAX_LATENCY", 5)),
+                          spill_dir=os.getenv("BATCH_SPILL_DIR", "spill"))
+
+resolver = AttachmentResolver(max_workers=int(os.getenv("RESOLVER_WORKERS", 32)),
+                              per_host=int(os.getenv("RESOLVER_PER_HOST", 4)))
+
+# Relays overlap heavily; drop posts another endpoint (or, with DEDUP_SHARED, another scraper) already delivered
+seen_posts = SeenPosts(capacity=int(os.getenv("DEDUP_CAPACITY", 1000000)),
+                       redis=database.get_redis_connection() if os.getenv("DEDUP_SHARED") else None)
+
+
+stop_streams = threading.Event()
+
+
+def buffer_post(object, attachments):
+    object["attachments"] = attachments
+    scraped_attachments.inc(len(attachments))
+    scraped_posts.inc()
+    scraped_posts_heatmap.observe(time.localtime().tm_hour)
+    batcher.add(object)
+
+
+class BGSListener(SupervisedListener):
+    def __init__(self, endpoint):
+        super().__init__()
+        self.endpoint = endpoint
+
     def on_update(self, status):
         # Verify that the id is set, that content is not empty, and that the content is not a boost
-        if not hasattr(status, "id") or not hasattr(status, "content") or (hasattr(status, "reblog") and status["reblog"]):
+        if status.id is None or status.content is None or status.reblog:
             return True
 
         # Do not include replies, we only want top-level posts
-        if status["in_reply_to_id"]:
+        if status.in_reply_to_id:
             return True
 
         # Verify that we have either an attachment or some content
-        if not status["content"] and not status["media_attachments"]:
+        if not status.content and not status.media_attachments:
             return True
 
         id_hash = hashlib.md5()
-        id_hash.update(str(status["url"]).encode("utf-8"))
+        id_hash.update(str(status.url).encode("utf-8"))
         post_uuid = uuid.UUID(id_hash.hexdigest())
 
-        attachments = []
-        for attachment in status["media_attachments"]:
-            if attachment["type"] != "image":
-                continue
-
-            # priority order: remote_url -> preview_url -> url
-            attachment_url = attachment["remote_url"] if attachment["remote_url"] else attachment["url"]
-
-            # HEAD request to check whether a redirect is present
-            try:
-                attachment_response = requests.head(attachment_url, allow_redirects=True, timeout=2, headers={"User-Agent": "FediBGS/0.0.1"})
-
-                # check that it returns a file (200 OK)
-                if attachment_response.status_code != 200:
-                    logging.warning("Attachment URL returned non-200 status code: %s - %s" % (attachment_response.status_code, attachment_url))
-                    continue
+        if seen_posts.seen(post_uuid):
+            stream_duplicates.labels(self.endpoint).inc()
+            return True
+        stream_posts.labels(self.endpoint).inc()
 
-                if attachment_response.url != attachment_url:
-                    attachment_url = attachment_response.url
-            except Exception as e:
-                logging.error("Error while checking attachment URL: %s" % e)
+        candidates = []
+        for attachment in status.media_attachments:
+            if attachment.type != "image":
                 continue
 
-            attachments.append({
-                "description": attachment["description"],
-                "url": attachment_url,
-            })
-            scraped_attachments.inc()
-
-        tags = []
-        for tag in status["tags"]:
-            tags.append(tag["name"])
+            # priority order: remote_url -> preview_url -> url
+            attachment_url = attachment.remote_url if attachment.remote_url else attachment.url
+            candidates.append((attachment.description, attachment_url))
 
         object = {
             "id": str(post_uuid),
-            "content": status["content"],
-            "attachments": attachments,
-            "postURL": status["url"],
-            "tags": tags,
+            "content": status.content,
+            "attachments": [],
+            "postURL": status.url,
+            "tags": status.tags,
             "author": {
-                "url": status["account"]["url"],
-                "username": status["account"]["username"],
+                "url": status.account_url,
+                "username": status.account_username,
             },
             "indexedAt": datetime.now(),
         }
 
-        queue_buffer.append(object)
-        scraped_posts.inc()
-        scraped_posts_heatmap.observe(time.localtime().tm_hour)
-        #print('\r- Buffered %d/%d posts - ID: %s' % (len(queue_buffer), buffer_size, object["id"]), end='', flush=True)
-
-        if len(queue_buffer) >= buffer_size:
-            tasks.ingest_batch.delay(queue_buffer)
-
-            queue_buffer.clear()
-            #print("\r- OK - Buffer flushed -", end='', flush=True)
-            logging.info("Buffer flushed - %d posts" % buffer_size)
-
+        # HEAD requests to follow attachment redirects happen on the resolver, never on the stream thread
+        resolver.resolve_post(object, candidates, buffer_post)
         return True
 
+    # handle_stream raises after this, stream_timeline reconnects. Non-200 answers never reach the listener,
+    # stream_timeline logs those itself.
     def on_abort(self, status):
-        logging.error("Stream connection aborted: %s" % status)
-        os.kill(os.getpid(), signal.SIGINT)
-
-    def on_error(self, status_code):
-        logging.error("Stream connection error: %s" % status_code)
-        os.kill(os.getpid(), signal.SIGINT)
-
+        logging.error("Stream connection to %s aborted: %s" % (self.endpoint, status))
 
-def stream_timeline(endpoint, listener, params={}):
-    def connect_func():
-        headers = {"User-Agent": "FediBGS/0.0.1", "Accept": "text/event-stream"}
-        if AUTH_HEADER:
-            headers["Authorization"] = AUTH_HEADER
 
-            # Only show first and last bits of the token
-            redacted_token = AUTH_HEADER[:10] + "..." + AUTH_HEADER[-10:]
-            logging.info("Connecting to %s with token %s" % (endpoint, redacted_token))
+def follow_stream(base):
+    headers = {"User-Agent": "FediBGS/0.0.1", "Accept": "text/event-stream"}
+    if AUTH_HEADER:
+        headers["Authorization"] = AUTH_HEADER
 
-        connection = requests.get(endpoint, headers=headers, data=params, stream=True,
-                                  timeout=None, allow_redirects=True)
+        # Only show first and last bits of the token
+        redacted_token = AUTH_HEADER[:10] + "..." + AUTH_HEADER[-10:]
+        logging.info("Connecting to %s with token %s" % (base, redacted_token))
 
-        if connection.status_code != 200:
-            logging.error("Could not connect to server. HTTP status: %i" % connection.status_code)
-            logging.error(connection.text)
-            return None
-        return connection
+    # Blocking, reconnects until stop_streams is set
+    stream_timeline(base, FEDERATED_TIMELINE_STREAMS[base], lambda: BGSListener(base), headers=headers,
+                    idle_timeout=int(os.getenv("STREAM_IDLE_TIMEOUT", 45)), stop=stop_streams)
 
-    # Blocking, never returns (can only leave via exception)
-    connection = connect_func()
-    with closing(connection) as r:
-        listener.handle_stream(r)
 
 app = FastAPI(debug=False)
 metrics_app = make_asgi_app()
@@ -162,34 +158,28 @@ def start_metrics_server():
     port = os.getenv("METRICS_PORT", 9999)
     uvicorn.run(app, host="0.0.0.0", port=port, log_level="error")
 
-# Kill program if no posts are scraped for 30 seconds
-def post_watchdog():
-    logging.info("Starting watchdog...")
-    watchdog_counter = 0
-    old_post_size = 0
-    while True:
-        if watchdog_counter >= 30:
-            logging.error("No posts scraped for 30 seconds, exiting...")
-            os.kill(os.getpid(), signal.SIGINT)
-        if len(queue_buffer) != old_post_size:
-            watchdog_counter = 0
-            old_post_size = len(queue_buffer)
-        else:
-            watchdog_counter += 1
-            if watchdog_counter % 5 == 0:
-                logging.warning("No posts scraped for %d seconds" % watchdog_counter)
-        time.sleep(1)
-
 
 if __name__ == "__main__":
     # Start the metrics server in a separate thread
     metrics_thread = threading.Thread(target=start_metrics_server, daemon=True)
     metrics_thread.start()
-
-    # Start the watchdog in a separate thread
-    watchdog_thread = threading.Thread(target=post_watchdog, daemon=True)
-    watchdog_thread.start()
-
-    # Start the main application
-    listener = BGSListener()
-    stream_timeline(FEDERATED_TIMELINE_STREAM, listener)
+    instrumentation.start_profiler("scrape")
+
+    # Start the main application, one thread per endpoint
+    stream_threads = []
+    for base in STREAM_BASES:
+        stream_thread = threading.Thread(target=follow_stream, args=(base,), daemon=True, name="stream-" + base)
+        stream_thread.start()
+        stream_threads.append(stream_thread)
+
+    try:
+        for stream_thread in stream_threads:
+            # Short joins keep the main thread responsive to SIGINT
+            while stream_thread.is_alive():
+                stream_thread.join(1)
+    finally:
+        stop_streams.set()
+        # Posts still waiting on attachment HEADs reach the batcher first, then buffered posts go out (or to
+        # disk) before exiting
+        resolver.shutdown(wait=True)
+        batcher.close()
@@ -0,0 +1,138 @@
+"""Semantic search over posts.text_embedding and attachments.vector, through the HNSW indexes in init.sql.
+
+Post results can be hybrid: the nearest posts and the best full-text matches are each ranked, and the two
+rankings are fused by reciprocal rank (score = sum of 1 / (RRF_K + rank)), so a post that is both close in
+meaning and contains the words comes first without having to make cosine distances and ts_rank comparable.
+"""
+import asyncio
+import logging
+import os
+from collections import OrderedDict
+from threading import Lock
+
+from prometheus_client import Counter
+
+import embeddings
+import hydrate
+from post_search import normalize_query
+
+query_embedding_lookups = Counter('query_embedding_lookups', 'Search query embeddings by the layer that answered them',
+                                  ['layer'])
+
+# pgvecto.rs' HNSW candidate list size: higher finds more of the true nearest neighbours, more slowly
+EF_SEARCH_SETTING = "vectors.hnsw_ef_search"
+SEMANTIC_EF_SEARCH = int(os.getenv("SEMANTIC_EF_SEARCH", 100))
+# Candidates each ranking contributes before fusion
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", 100))
+# Full-text candidates are ranked among the newest matches only; ranking every match of a common word is a
+# full index scan, the same reason post_search caps its count
+FULLTEXT_WINDOW = int(os.getenv("HYBRID_FULLTEXT_WINDOW", 1000))
+RRF_K = 60
+
+
+class QueryEmbeddingCache:
+    """Normalized query -> embedding, as a bounded in-process LRU in front of the Redis embedding cache the
+    pipeline in embeddings.py fills, so a query typed before by anyone is not sent to the encoder again."""
+
+    def __init__(self, redis, max_size=10000):
+        self.redis = redis
+        self.max_size = max_size
+        self.local = OrderedDict()
+        self.lock = Lock()
+
+    def _embed(self, q):
+        # The encoder client is only loaded once a query actually needs it
+        encoder = embeddings.get_encoder()
+        return embeddings.embed("text", [q], encoder, embeddings.EmbeddingCache(self.redis, encoder.name))[q]
+
+    async def get(self, q):
+        """Embedding of the normalized query q, or None if the encoder could not embed it."""
+        with self.lock:
+            vector = self.local.get(q)
+            if vector is not None:
+                self.local.move_to_end(q)
+        if vector is not None:
+            query_embedding_lookups.labels("local").inc()
+            return vector
+
+        query_embedding_lookups.labels("shared").inc()
+        # Redis and the encoder client are blocking
+        vector = await asyncio.to_thread(self._embed, q)
+        if vector is not None:
+            with self.lock:
+                self.local[q] = vector
+                while len(self.local) > self.max_size:
+                    self.local.popitem(last=False)
+        return vector
+
+
+NEAREST_POSTS = (
+    "SELECT id, indexed_at, row_number() OVER (ORDER BY distance) AS rank FROM ("
+    "SELECT id, indexed_at, text_embedding <=> %(vector)s::real[]::vector AS distance FROM posts "
+    "WHERE text_embedding IS NOT NULL ORDER BY text_embedding <=> %(vector)s::real[]::vector LIMIT %(candidates)s) AS nearest"
+)
+
+FULLTEXT_POSTS = (
+    "SELECT id, indexed_at, row_number() OVER (ORDER BY ts_rank_cd(content_ts, query) DESC, indexed_at DESC) AS rank "
+    "FROM (SELECT id, indexed_at, content_ts FROM posts WHERE content_ts @@ websearch_to_tsquery('english', %(q)s::text) "
+    "ORDER BY indexed_at DESC LIMIT %(window)s) AS matches, websearch_to_tsquery('english', %(q)s::text) AS query "
+    "ORDER BY rank LIMIT %(candidates)s"
+)
+
+
+def fuse(*rankings):
+    """SQL fusing rankings (queries of id, indexed_at, rank) by reciprocal rank, best first."""
+    # Each ranking in parentheses, so its own ORDER BY and LIMIT do not apply to the whole union
+    return ("SELECT id, indexed_at, SUM(1.0 / (%%(k)s + rank)) AS score FROM (%s) AS candidates "
+            "GROUP BY id, indexed_at ORDER BY score DESC, id LIMIT %%(limit)s"
+            % " UNION ALL ".join("(%s)" % ranking for ranking in rankings))
+
+
+async def _set_ef_search(cursor, ef_search):
+    # Only lasts for the surrounding transaction
+    await cursor.execute("SELECT set_config(%s, %s, true)", (EF_SEARCH_SETTING, str(ef_search)))
+
+
+async def search_posts(connection, q, vector, limit=50, hybrid=True, ef_search=SEMANTIC_EF_SEARCH):
+    """Posts nearest to vector, as hydrated posts. With hybrid, fused with the full-text matches of q."""
+    candidates = max(limit, HYBRID_CANDIDATES) if hybrid else limit
+    params = {"vector": vector, "q": q, "candidates": candidates, "window": FULLTEXT_WINDOW, "k": RRF_K, "limit": limit}
+    if hybrid:
+        ranked = fuse(NEAREST_POSTS, FULLTEXT_POSTS)
+    else:
+        ranked = "SELECT id, indexed_at, 1.0 / (%%(k)s + rank) AS score FROM (%s) AS nearest ORDER BY rank LIMIT %%(limit)s" % NEAREST_POSTS
+
+    async with connection.transaction():
+        cursor = connection.cursor(row_factory=hydrate.post_row)
+        # An HNSW scan yields at most ef_search rows
+        await _set_ef_search(cursor, max(ef_search, candidates))
+        await cursor.execute("WITH ranked AS (%s) " % ranked + hydrate.select_posts(
+            "JOIN ranked ON ranked.id = posts.id AND ranked.indexed_at = posts.indexed_at ORDER BY ranked.score DESC, posts.id"),
+                             params)
+        return await cursor.fetchall()
+
+
+async def search_attachments(connection, vector, limit=10, ef_search=SEMANTIC_EF_SEARCH):
+    """Attachments whose image is nearest to vector, with their cosine similarity."""
+    async with connection.transaction():
+        cursor = connection.cursor()
+        await _set_ef_search(cursor, max(ef_search, limit))
+        await cursor.execute("SELECT id, url, description, post_id, vector <=> %(vector)s::real[]::vector AS distance "
+                             "FROM attachments WHERE vector IS NOT NULL ORDER BY vector <=> %(vector)s::real[]::vector LIMIT %(limit)s",
+                             {"vector": vector, "limit": limit})
+        return [{"id": row[0], "url": row[1], "description": row[2], "post_id": str(row[3]), "score": 1 - row[4]}
+                for row in await cursor.fetchall()]
+
+
+async def semantic_search(connection, embedding_cache, q, limit=50, hybrid=True, attachments=10):
+    """{"posts": [...], "attachments": [...]} for the query q; empty if q is empty or cannot be embedded."""
+    q = normalize_query(q)
+    vector = await embedding_cache.get(q) if q else None
+    if vector is None:
+        if q:
+            logging.warning("Semantic search: no embedding for %r" % q)
+        return {"posts": [], "attachments": []}
+    return {
+        "posts": await search_posts(connection, q, vector, limit, hybrid),
+        "attachments": await search_attachments(connection, vector, attachments) if attachments else [],
+    }
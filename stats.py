@@ -0,0 +1,129 @@
+"""Posts and attachments indexed in the last 7 days, as per-hour counters in Redis.
+
+ingest_batch bumps the counter of the hour each committed post (and attachment) was indexed in. Counters
+expire after the window, so reading the totals is one MGET of WINDOW_HOURS keys however large the tables get.
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime
+
+from redis import RedisError
+
+PREFIX = "fedibgs:stats:"
+KINDS = ("posts", "attachments")
+BUCKET_SECONDS = 3600
+WINDOW_HOURS = 168
+
+
+def hour_bucket(timestamp):
+    return int(timestamp // BUCKET_SECONDS)
+
+
+def bucket_key(kind, bucket):
+    return "%s%s:%d" % (PREFIX, kind, bucket)
+
+
+def indexed_timestamp(indexed_at):
+    if isinstance(indexed_at, datetime):
+        return indexed_at.timestamp()
+    if isinstance(indexed_at, str):
+        # Batches that went through Celery's json serializer
+        return datetime.fromisoformat(indexed_at).timestamp()
+    return time.time()
+
+
+def record(redis, datasets, inserted):
+    """Counts the posts of datasets whose IDs are in inserted. Best effort, the posts are stored either way."""
+    if not inserted:
+        return
+    post_count = len(inserted)
+    inserted = set(inserted)
+    counts = {}
+    for dataset in datasets:
+        if str(dataset["id"]) not in inserted:
+            continue
+        inserted.discard(str(dataset["id"]))
+        bucket = hour_bucket(indexed_timestamp(dataset.get("indexedAt")))
+        counts[("posts", bucket)] = counts.get(("posts", bucket), 0) + 1
+        if dataset["attachments"]:
+            # Attachments are stored with their post's indexed_at
+            counts[("attachments", bucket)] = counts.get(("attachments", bucket), 0) + len(dataset["attachments"])
+
+    try:
+        pipeline = redis.pipeline(transaction=False)
+        for (kind, bucket), count in counts.items():
+            key = bucket_key(kind, bucket)
+            pipeline.incrby(key, count)
+            # One bucket of slack so the oldest hour is still there while it is being summed
+            pipeline.expire(key, (WINDOW_HOURS + 1) * BUCKET_SECONDS)
+        pipeline.execute()
+    except RedisError as e:
+        logging.warning("Stats: failed to record %d posts: %s" % (post_count, e))
+
+
+def backfill(redis, connection):
+    """Rebuilds the counters of the whole window from Postgres, for a fresh Redis or after an outage."""
+    cursor = connection.cursor()
+    pipeline = redis.pipeline(transaction=False)
+    for kind in KINDS:
+        cursor.execute("SELECT floor(date_part('epoch', indexed_at) / %s)::bigint AS bucket, COUNT(*) FROM " + kind + " "
+                       "WHERE indexed_at > now() - make_interval(hours => %s) GROUP BY bucket",
+                       (BUCKET_SECONDS, WINDOW_HOURS + 1))
+        for bucket, count in cursor.fetchall():
+            pipeline.set(bucket_key(kind, bucket), count, ex=(WINDOW_HOURS + 1) * BUCKET_SECONDS)
+    pipeline.execute()
+
+
+async def window_totals(redis):
+    """{"posts": n, "attachments": n} over the last WINDOW_HOURS hour buckets, from an asyncio Redis client."""
+    now = hour_bucket(time.time())
+    buckets = range(now - WINDOW_HOURS + 1, now + 1)
+    keys = [bucket_key(kind, bucket) for kind in KINDS for bucket in buckets]
+    values = await redis.mget(keys)
+    totals = {}
+    for i, kind in enumerate(KINDS):
+        totals[kind] = sum(int(value) for value in values[i * WINDOW_HOURS:(i + 1) * WINDOW_HOURS] if value is not None)
+    return totals
+
+
+class StatsSnapshot:
+    """The totals, cached in Redis for ttl seconds and shared by every API worker. When the cache expires,
+    a SET NX lock lets a single worker refresh it while the others keep answering with what they last saw."""
+
+    CACHE_KEY = PREFIX + "totals"
+    LOCK_KEY = PREFIX + "refresh"
+
+    def __init__(self, redis, ttl=60):
+        self.redis = redis
+        self.ttl = ttl
+        self.last = None
+
+    async def _cached(self):
+        cached = await self.redis.hgetall(self.CACHE_KEY)
+        if cached:
+            self.last = {kind.decode(): int(value) for kind, value in cached.items()}
+            return self.last
+        return None
+
+    async def get(self):
+        try:
+            if await self._cached():
+                return self.last
+            if await self.redis.set(self.LOCK_KEY, 1, nx=True, ex=10):
+                try:
+                    self.last = await window_totals(self.redis)
+                    async with self.redis.pipeline(transaction=True) as pipeline:
+                        await pipeline.hset(self.CACHE_KEY, mapping=self.last).expire(self.CACHE_KEY, self.ttl).execute()
+                finally:
+                    await self.redis.delete(self.LOCK_KEY)
+                return self.last
+            if self.last is None:
+                # Nothing to fall back to yet, wait for the worker holding the lock
+                for _ in range(20):
+                    await asyncio.sleep(0.05)
+                    if await self._cached():
+                        break
+        except RedisError as e:
+            logging.warning("Stats: Redis unavailable: %s" % e)
+        return self.last or dict.fromkeys(KINDS, 0)
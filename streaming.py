@@ -0,0 +1,221 @@
+import logging
+import random
+import threading
+import time
+from contextlib import closing
+
+import orjson
+import requests
+from prometheus_client import Counter, Gauge, Histogram
+from urllib3.exceptions import HTTPError
+
+import instrumentation
+
+stream_reconnects = Counter('stream_reconnects', 'Reconnects to each streaming endpoint', ['endpoint'])
+stream_connected = Gauge('stream_connected', 'Whether the stream to each endpoint is currently connected', ['endpoint'])
+stream_recovery = Histogram('stream_recovery_seconds', 'Time from losing a stream to the first event on a new connection',
+                            ['endpoint'], buckets=(0.5, 1, 2, 5, 10, 30, 60, 120, 300))
+stream_events = Counter('stream_events', 'Server-sent events received, by event name', ['event'])
+stream_malformed_events = Counter('stream_malformed_events', 'Events whose payload could not be decoded')
+
+malformed_log = instrumentation.RateLimitedLog()
+
+# Largest read from the socket at once; read1 returns whatever has arrived, up to this
+READ_SIZE = 65536
+
+
+class Attachment:
+    __slots__ = ("type", "url", "remote_url", "description")
+
+    def __init__(self, media):
+        self.type = media.get("type")
+        self.url = media.get("url")
+        self.remote_url = media.get("remote_url")
+        self.description = media.get("description")
+
+
+class Status:
+    """The fields of a streamed status that the scraper reads, instead of Mastodon.py's fully hydrated
+    AttribAccessDict (every datetime parsed, account, emoji and card objects built)."""
+
+    __slots__ = ("id", "url", "content", "reblog", "in_reply_to_id", "account_url", "account_username", "tags",
+                 "media_attachments")
+
+    def __init__(self, payload):
+        self.id = payload.get("id")
+        self.url = payload.get("url")
+        self.content = payload.get("content")
+        self.reblog = bool(payload.get("reblog"))
+        self.in_reply_to_id = payload.get("in_reply_to_id")
+        account = payload.get("account") or {}
+        self.account_url = account.get("url")
+        self.account_username = account.get("username")
+        self.tags = [tag["name"] for tag in payload.get("tags") or () if tag.get("name")]
+        self.media_attachments = [Attachment(media) for media in payload.get("media_attachments") or ()]
+
+
+class EventStreamListener:
+    """Reads the server-sent events of a Mastodon streaming response and calls on_update with a Status.
+
+    In place of Mastodon.py's StreamListener, which reads the response a byte at a time and decodes every
+    event: the socket is read in whatever pieces arrive, other events (deletes, edits) are dropped on their
+    name before their data is even joined, and updates are decoded with orjson straight into Status.
+    """
+
+    def on_update(self, status):
+        pass
+
+    def on_abort(self, err):
+        """The connection failed; the exception is raised once this returns."""
+        pass
+
+    def handle_heartbeat(self):
+        pass
+
+    def on_event(self, name):
+        """Called for every event, wanted or not."""
+        pass
+
+    def handle_stream(self, response):
+        try:
+            self._read(response)
+        except (requests.RequestException, HTTPError) as e:
+            self.on_abort(e)
+            raise
+
+    def _read(self, response):
+        raw = response.raw
+        pending = b""
+        name = None
+        data = []
+        while True:
+            chunk = raw.read1(READ_SIZE, decode_content=True)
+            if not chunk:
+                return
+            lines = (pending + chunk).split(b"\n")
+            pending = lines.pop()
+            for line in lines:
+                if line.endswith(b"\r"):
+                    line = line[:-1]
+                if not line:
+                    # A blank line ends the event
+                    if name is not None:
+                        self._dispatch(name, data)
+                    name = None
+                    data = []
+                elif line[0] == 0x3a:
+                    # ":" starts a comment, which Mastodon sends as a heartbeat
+                    self.handle_heartbeat()
+                elif line.startswith(b"event:"):
+                    name = line[6:].strip()
+                elif line.startswith(b"data:"):
+                    if name is None or name == b"update":
+                        data.append(line[6:] if line[5:6] == b" " else line[5:])
+
+    def _dispatch(self, name, data):
+        self.on_event(name)
+        stream_events.labels(name.decode("utf-8", "replace")).inc()
+        if name != b"update" or not data:
+            return
+        try:
+            status = Status(orjson.loads(b"\n".join(data)))
+        except (orjson.JSONDecodeError, AttributeError, KeyError, TypeError) as e:
+            stream_malformed_events.inc()
+            malformed_log.warning("Malformed update event", error=e)
+            return
+        self.on_update(status)
+
+
+class SupervisedListener(EventStreamListener):
+    """EventStreamListener that records when the server last showed signs of life (an event or a heartbeat)."""
+
+    def __init__(self):
+        super().__init__()
+        self.last_activity = time.monotonic()
+        self.first_event_at = None
+
+    def handle_heartbeat(self):
+        self.last_activity = time.monotonic()
+
+    def on_event(self, name):
+        self.last_activity = time.monotonic()
+        if self.first_event_at is None:
+            self.first_event_at = self.last_activity
+
+
+class Backoff:
+    """Exponential backoff with jitter: attempt n waits between half and all of min(maximum, initial * 2^n)."""
+
+    def __init__(self, initial=1.0, maximum=60.0):
+        self.initial = initial
+        self.maximum = maximum
+        self.attempt = 0
+
+    def next(self):
+        cap = min(self.maximum, self.initial * 2 ** self.attempt)
+        self.attempt += 1
+        return cap / 2 + random.uniform(0, cap / 2)
+
+    def reset(self):
+        self.attempt = 0
+
+
+def _watch(name, listener, response, idle_timeout, done, recovering_since):
+    """Closes the response once the stream has gone idle_timeout seconds without an event or heartbeat."""
+    while not done.wait(1):
+        if recovering_since is not None and listener.first_event_at is not None:
+            stream_recovery.labels(name).observe(listener.first_event_at - recovering_since)
+            recovering_since = None
+        if time.monotonic() - listener.last_activity > idle_timeout:
+            logging.warning("No events or heartbeats from %s for %ds, reconnecting" % (name, idle_timeout))
+            response.close()
+            return
+
+
+def stream_timeline(name, endpoint, make_listener, headers=None, idle_timeout=45, connect_timeout=10, stop=None,
+                    backoff=None):
+    """Follows a streaming endpoint until stop is set.
+
+    Each connection gets a fresh listener from make_listener(). Dropped, stalled (idle_timeout seconds
+    without an event or heartbeat) and refused connections are retried in-process with exponential
+    backoff; a connection that delivered events resets the backoff.
+    """
+    stop = stop or threading.Event()
+    backoff = backoff or Backoff()
+    recovering_since = None
+
+    while not stop.is_set():
+        listener = make_listener()
+        done = threading.Event()
+        try:
+            response = requests.get(endpoint, headers=headers, stream=True, allow_redirects=True,
+                                    timeout=(connect_timeout, idle_timeout))
+            if response.status_code != 200:
+                logging.error("Could not connect to %s. HTTP status: %i" % (endpoint, response.status_code))
+                response.close()
+            else:
+                logging.info("Connected to %s" % endpoint)
+                stream_connected.labels(name).set(1)
+                threading.Thread(target=_watch, args=(name, listener, response, idle_timeout, done, recovering_since),
+                                 daemon=True, name="watch-" + name).start()
+                with closing(response) as r:
+                    listener.handle_stream(r)
+                logging.warning("Stream %s ended" % endpoint)
+        except Exception as e:
+            if not stop.is_set():
+                logging.error("Stream %s failed: %s" % (endpoint, e))
+        finally:
+            done.set()
+            stream_connected.labels(name).set(0)
+
+        if listener.first_event_at is not None:
+            # This connection was healthy: start counting recovery from now, retry quickly
+            recovering_since = time.monotonic()
+            backoff.reset()
+        elif recovering_since is None:
+            recovering_since = time.monotonic()
+
+        if stop.is_set():
+            break
+        stream_reconnects.labels(name).inc()
+        stop.wait(backoff.next())
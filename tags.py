@@ -0,0 +1,133 @@
+"""Hashtags: the post_tags table behind tag pages, and per-hour tag counters in Redis behind trending tags.
+
+ingest_batch writes one post_tags row per (tag, post) in the same transaction as the posts, and bumps the
+sorted set of the hour each post was indexed in. Trending tags are a ZUNIONSTORE of the last hours' sets,
+kept for TRENDING_CACHE_TTL seconds, so they cost the same however many posts there are.
+
+Databases that predate post_tags need the post_tags statements from init.sql, then backfill().
+"""
+import logging
+import time
+
+from redis import RedisError
+
+import hydrate
+import stats
+from post_search import PAGE_SIZE, SearchCache, encode_cursor
+
+PREFIX = "fedibgs:tags:"
+WINDOW_HOURS = stats.WINDOW_HOURS
+TRENDING_CACHE_TTL = 60
+
+
+def normalize_tag(tag):
+    # Mastodon matches hashtags case-insensitively
+    return tag.strip().lstrip("#").lower()
+
+
+def post_tags(dataset):
+    """The distinct normalized tags of a post."""
+    return list(dict.fromkeys(tag for tag in map(normalize_tag, dataset["tags"]) if tag))
+
+
+def hour_key(bucket):
+    return "%shour:%d" % (PREFIX, bucket)
+
+
+def insert_post_tags(cursor, rows):
+    """rows: [(tag, indexed_at, post_id)]."""
+    if rows:
+        cursor.execute("INSERT INTO post_tags (tag, indexed_at, post_id) "
+                       "SELECT * FROM unnest(%s::text[], %s::timestamptz[], %s::uuid[]) ON CONFLICT DO NOTHING",
+                       ([row[0] for row in rows], [row[1] for row in rows], [row[2] for row in rows]))
+
+
+def record(redis, datasets, inserted):
+    """Counts the tags of the posts of datasets whose IDs are in inserted. Best effort, like stats.record."""
+    if not inserted:
+        return
+    post_count = len(inserted)
+    inserted = set(inserted)
+    counts = {}
+    for dataset in datasets:
+        if str(dataset["id"]) not in inserted:
+            continue
+        inserted.discard(str(dataset["id"]))
+        bucket = stats.hour_bucket(stats.indexed_timestamp(dataset.get("indexedAt")))
+        for tag in post_tags(dataset):
+            counts.setdefault(bucket, {})
+            counts[bucket][tag] = counts[bucket].get(tag, 0) + 1
+
+    try:
+        pipeline = redis.pipeline(transaction=False)
+        for bucket, tag_counts in counts.items():
+            for tag, count in tag_counts.items():
+                pipeline.zincrby(hour_key(bucket), count, tag)
+            pipeline.expire(hour_key(bucket), (WINDOW_HOURS + 1) * stats.BUCKET_SECONDS)
+        pipeline.execute()
+    except RedisError as e:
+        logging.warning("Tags: failed to record tags of %d posts: %s" % (post_count, e))
+
+
+def backfill(redis, connection):
+    """Fills post_tags from posts.tags and rebuilds the hour counters of the window from it."""
+    cursor = connection.cursor()
+    cursor.execute("INSERT INTO post_tags (tag, indexed_at, post_id) "
+                   "SELECT DISTINCT lower(ltrim(btrim(tag), '#')), indexed_at, id FROM posts, jsonb_array_elements_text(tags) AS tag "
+                   "WHERE ltrim(btrim(tag), '#') <> '' ON CONFLICT DO NOTHING")
+    logging.info("Tags: backfilled %d post_tags rows" % cursor.rowcount)
+    connection.commit()
+
+    cursor.execute("SELECT floor(date_part('epoch', indexed_at) / %s)::bigint AS bucket, tag, COUNT(*) FROM post_tags "
+                   "WHERE indexed_at > now() - make_interval(hours => %s) GROUP BY bucket, tag",
+                   (stats.BUCKET_SECONDS, WINDOW_HOURS + 1))
+    buckets = {}
+    for bucket, tag, count in cursor.fetchall():
+        buckets.setdefault(bucket, {})[tag] = count
+    pipeline = redis.pipeline(transaction=False)
+    for bucket, tag_counts in buckets.items():
+        pipeline.delete(hour_key(bucket))
+        pipeline.zadd(hour_key(bucket), tag_counts)
+        pipeline.expire(hour_key(bucket), (WINDOW_HOURS + 1) * stats.BUCKET_SECONDS)
+    pipeline.execute()
+
+
+async def trending(redis, hours=24, limit=20):
+    """[{"tag", "count"}] of the most used tags over the last hours, from an asyncio Redis client."""
+    key = "%strending:%d" % (PREFIX, hours)
+    try:
+        if not await redis.exists(key):
+            now = stats.hour_bucket(time.time())
+            async with redis.pipeline(transaction=True) as pipeline:
+                pipeline.zunionstore(key, [hour_key(bucket) for bucket in range(now - hours + 1, now + 1)])
+                pipeline.expire(key, TRENDING_CACHE_TTL)
+                await pipeline.execute()
+        top = await redis.zrevrange(key, 0, limit - 1, withscores=True)
+    except RedisError as e:
+        logging.warning("Tags: Redis unavailable: %s" % e)
+        return []
+    return [{"tag": tag.decode("utf-8"), "count": int(count)} for tag, count in top]
+
+
+async def tag_posts(cursor, tag, after=None, limit=PAGE_SIZE):
+    """One page of the posts tagged tag, newest first, read off the post_tags primary key."""
+    if after is not None:
+        page = ("SELECT post_id, indexed_at FROM post_tags WHERE tag = %s AND (indexed_at, post_id) < (%s, %s) "
+                "ORDER BY indexed_at DESC, post_id DESC LIMIT %s")
+        params = (normalize_tag(tag), after[0], after[1], limit)
+    else:
+        page = "SELECT post_id, indexed_at FROM post_tags WHERE tag = %s ORDER BY indexed_at DESC, post_id DESC LIMIT %s"
+        params = (normalize_tag(tag), limit)
+    await cursor.execute("WITH page AS (%s) " % page + hydrate.select_posts(
+        "JOIN page ON page.post_id = posts.id AND page.indexed_at = posts.indexed_at "
+        "ORDER BY posts.indexed_at DESC, posts.id DESC"), params)
+    posts = await cursor.fetchall()
+
+    next_cursor = None
+    if len(posts) == limit:
+        next_cursor = encode_cursor(posts[-1][4], posts[-1][0])
+    return [hydrate.format_post(post) for post in posts], next_cursor
+
+
+class TagPageCache(SearchCache):
+    REDIS_PREFIX = "fedibgs:tag:"
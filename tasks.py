@@ -1,13 +1,26 @@
 import json
+import os
 import time
 import uuid
 from datetime import datetime
 
-from io import StringIO
-from html.parser import HTMLParser
+from prometheus_client import Counter
 from psycopg import ProgrammingError
+from psycopg.errors import ForeignKeyViolation
+from redis import RedisError
 from celery import signals
+import author_pages
 import database
+import dedup
+import embeddings
+import instrumentation
+import partitions
+import stats
+import tags
+import wire
+from author_cache import AuthorCache
+from broadcast import NEW_POSTS_CHANNEL
+from html_text import strip_tags
 
 from celery import Celery, Task
 from celery.utils.log import get_task_logger
@@ -15,27 +28,18 @@ from celery.utils.log import get_task_logger
 logger = get_task_logger(__name__)
 
 app = Celery('tasks', broker=database.get_redis_url())
-
-
-class MLStripper(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.reset()
-        self.strict = False
-        self.convert_charrefs = True
-        self.text = StringIO()
-
-    def handle_data(self, d):
-        self.text.write(d)
-
-    def get_data(self):
-        return self.text.getvalue()
-
-
-def strip_tags(html):
-    s = MLStripper()
-    s.feed(html)
-    return s.get_data()
+app.conf.update(
+    task_serializer=wire.SERIALIZER,
+    # json for messages queued before the switch to the batch wire format
+    accept_content=[wire.SERIALIZER, 'json'],
+    result_serializer='json',
+    beat_schedule={
+        'embed-pending': {'task': 'tasks.embed_pending', 'schedule': float(os.getenv("EMBEDDING_INTERVAL", 60))},
+        # Partitions are made PARTITION_PREMAKE intervals ahead, so daily leaves plenty of slack
+        'maintain-partitions': {'task': 'tasks.maintain_partitions',
+                                'schedule': float(os.getenv("PARTITION_MAINTENANCE_INTERVAL", 86400))},
+    },
+)
 
 
 def defang_urls(string):
@@ -46,9 +50,16 @@ def strip_query_params(url):
     return url.split("?")[0]
 
 
+def post_text(dataset):
+    # Batches in the wire format arrive with the HTML already stripped by the scraper
+    if dataset.get("stripped"):
+        return dataset["content"]
+    return strip_tags(dataset["content"], breaks=True)
+
+
 def preprocess_dataset(dataset):
     preprocessed = {
-        "content": strip_tags(dataset["content"]),
+        "content": strip_tags(dataset["content"], breaks=True),
         "attachments": [strip_query_params(url) for url in [
             attachment["url"]
             for attachment in dataset["attachments"]
@@ -59,7 +70,26 @@ def preprocess_dataset(dataset):
     }
     return preprocessed
 
-author_id_map = {}
+author_cache = AuthorCache(database.get_redis_connection(), max_size=int(os.getenv("AUTHOR_CACHE_SIZE", 50000)),
+                           window=int(os.getenv("AUTHOR_CACHE_WINDOW", 86400)))
+
+# "bulk" (set-based, default) or "row" (one round trip per statement)
+INGEST_MODE = os.getenv("INGEST_MODE", "bulk")
+
+# Recently ingested post IDs in Redis, so that row mode does not look up posts which cannot exist yet in
+# Postgres. Bulk mode has no lookup to skip: its post_ids claim is one statement whatever the filter says.
+# So there the filter is off, unless INGEST_FILTER=1 has bulk workers mark their posts for row mode workers.
+ingest_filter = None
+if os.getenv("INGEST_FILTER", "1" if INGEST_MODE == "row" else "0") == "1":
+    ingest_filter = dedup.IngestFilter(database.get_redis_connection(),
+                                       capacity=int(os.getenv("INGEST_FILTER_CAPACITY", 2000000)),
+                                       error_rate=float(os.getenv("INGEST_FILTER_ERROR_RATE", 0.001)),
+                                       window=int(os.getenv("INGEST_FILTER_WINDOW", 86400)))
+
+ingest_duplicates = Counter('ingest_duplicates', 'Posts ingest_batch received that were stored already')
+ingest_posts = Counter('ingest_posts', 'Posts ingest_batch received')
+# Per post lines of row mode: debug, and even then a few per minute
+row_log = instrumentation.RateLimitedLog(logger)
 
 @signals.task_retry.connect
 @signals.task_failure.connect
@@ -77,21 +107,58 @@ def on_task_failure(**kwargs):
                  + str(kwargs.get('exception', '')))
 
 
-@app.task(autoretry_for=(Exception,))
-def ingest_batch(datasets):
-    with database.get_db_connection() as connection:
-        cursor = connection.cursor()
+@signals.worker_init.connect
+def start_worker_instrumentation(**kwargs):
+    # 0 for no exporter, e.g. when several workers share a host without PROMETHEUS_MULTIPROC_DIR
+    port = int(os.getenv("WORKER_METRICS_PORT", 9998))
+    if port:
+        instrumentation.start_metrics_server(port)
+    instrumentation.start_profiler("worker")
 
-        for dataset in datasets:
+
+@signals.worker_process_init.connect
+def start_process_profiler(**kwargs):
+    # Prefork pool processes; the profiler thread of the parent does not survive the fork
+    instrumentation.start_profiler("worker")
+
+
+@signals.worker_process_shutdown.connect
+def on_worker_process_shutdown(pid=None, **kwargs):
+    instrumentation.mark_process_dead(pid)
+
+
+def ingest_rows(connection, datasets):
+    cursor = connection.cursor()
+    timer = instrumentation.PhaseTimer()
+    inserted = []
+    attachment_count = 0
+
+    posts = {}
+    authors = set()
+    for dataset in datasets:
+        posts.setdefault(str(dataset["id"]), dataset)
+        authors.add(dataset["author"]["url"])
+    # Only posts the filter has seen before are looked up; the others go straight to the INSERT, whose
+    # claim on post_ids still catches what the filter missed (e.g. after Redis lost it)
+    with timer.phase("filter"):
+        maybe_seen = ingest_filter.check(list(posts)) if ingest_filter else None
+
+    for post_id, dataset in posts.items():
+        if maybe_seen is None or post_id in maybe_seen:
             # Check if the post already exists
-            cursor.execute("SELECT exists ( SELECT 1 FROM posts WHERE id = %s )", (dataset["id"],))
-            exists = cursor.fetchone()[0]
-            connection.commit()
+            with timer.phase("posts"):
+                cursor.execute("SELECT exists ( SELECT 1 FROM post_ids WHERE id = %s )", (dataset["id"],))
+                exists = cursor.fetchone()[0]
+                connection.commit()
             if exists:
-                print(f"Post {dataset['id']} already exists")
+                row_log.debug("Post already exists", post=dataset["id"])
                 continue
+            if maybe_seen is not None:
+                dedup.ingest_filter_false_positives.inc()
 
-            if dataset["author"]["url"] not in author_id_map:
+        with timer.phase("authors"):
+            author_id = author_cache.get(dataset["author"]["url"])
+            if author_id is None:
                 # Get the author's ID
                 try:
                     cursor.execute("SELECT id FROM authors WHERE url = %s", (dataset["author"]["url"],))
@@ -99,8 +166,8 @@ def ingest_batch(datasets):
                     # Check if the author exists
                     author_id = cursor.fetchone()
                     if author_id:
-                        author_id_map[dataset["author"]["url"]] = author_id[0]
                         author_id = author_id[0]
+                        author_cache.put(dataset["author"]["url"], author_id)
                     else:
                         # Insert the author if they don't exist
                         cursor.execute(
@@ -108,37 +175,262 @@ def ingest_batch(datasets):
                             (dataset["author"]["url"], dataset["author"]["username"]))
                         connection.commit()
                         author_id = cursor.fetchone()[0]
-                        logger.info(f"Inserted author {dataset['author']['url']} with ID {author_id}")
-                        author_id_map[dataset["author"]["url"]] = author_id
+                        row_log.debug("Inserted author", url=dataset["author"]["url"], id=author_id)
+                        author_cache.put(dataset["author"]["url"], author_id)
                 except ProgrammingError as e:
                     connection.rollback()
-                    raise "Failed to insert author" from e
-            else:
-                author_id = author_id_map[dataset["author"]["url"]]
+                    raise RuntimeError("Failed to insert author") from e
 
-            if not author_id:
-                raise Exception(f"Failed to get author ID for {dataset['author']['url']}")
+        if not author_id:
+            raise Exception(f"Failed to get author ID for {dataset['author']['url']}")
 
-            try:
-                # Insert the post
-                cursor.execute("INSERT INTO posts (id, content, post_url, tags, author_id, indexed_at) "
-                               "VALUES (%s, %s, %s, %s, %s, %s)", (dataset["id"], strip_tags(dataset["content"]),
-                                                               dataset["postURL"],
-                                                               json.dumps(dataset["tags"]), author_id, dataset.get("indexedAt", datetime.now())))
-                logger.info(f"Inserted post {dataset['id']}")
+        try:
+            # Insert the post
+            indexed_at = dataset.get("indexedAt", datetime.now())
+            with timer.phase("posts"):
+                # Claiming the ID is what keeps it unique across partitions; a concurrent claim of the same ID
+                # waits for the other transaction and then conflicts
+                cursor.execute("INSERT INTO post_ids (id, indexed_at) VALUES (%s, %s) ON CONFLICT DO NOTHING RETURNING id",
+                               (dataset["id"], indexed_at))
+                created = cursor.fetchone() is not None
+                if created:
+                    cursor.execute("INSERT INTO posts (id, content, post_url, tags, author_id, indexed_at) "
+                                   "VALUES (%s, %s, %s, %s::jsonb, %s, %s)",
+                                   (dataset["id"], post_text(dataset), dataset["postURL"], json.dumps(dataset["tags"]),
+                                    author_id, indexed_at))
+            if not created:
+                connection.commit()
+                row_log.debug("Post already exists", post=dataset["id"])
+                continue
+            row_log.debug("Inserted post", post=dataset["id"])
 
+            # Attachments share their post's indexed_at, and with it its partition
+            with timer.phase("attachments"):
                 for attachment in dataset["attachments"]:
-                    cursor.execute("INSERT INTO attachments (url, description, post_id) "
-                                   "VALUES (%s, %s, %s)", (attachment["url"], attachment["description"], dataset["id"]))
-                    logger.info(f"Inserted attachment {attachment['url']}")
+                    cursor.execute("INSERT INTO attachments (url, description, post_id, indexed_at) "
+                                   "VALUES (%s, %s, %s, %s)", (attachment["url"], attachment["description"], dataset["id"], indexed_at))
+
+            with timer.phase("tags"):
+                tags.insert_post_tags(cursor, [(tag, indexed_at, dataset["id"]) for tag in tags.post_tags(dataset)])
+
+            # Counted in the post's own transaction, so the counts cannot drift from the posts
+            with timer.phase("aggregates"):
+                author_pages.update_aggregates(cursor, [(author_id, len(dataset["attachments"]), indexed_at)])
+
+            with timer.phase("commit"):
+                connection.commit()
+            inserted.append(str(dataset["id"]))
+            attachment_count += len(dataset["attachments"])
+        except ForeignKeyViolation:
+            # The cached author ID is stale (e.g. the database was reset), and likely the batch's others too: the
+            # retry looks them all up again
+            connection.rollback()
+            author_cache.forget(list(authors))
+            raise
+        except:
+            connection.rollback()
+            raise Exception("Failed to insert post and attachments")
+
+    # Only once the whole batch is in Postgres: marked up front, a batch that failed and was retried would
+    # find its own posts flagged and count each one as a false positive
+    if ingest_filter:
+        with timer.phase("filter"):
+            ingest_filter.mark(list(posts))
+
+    timer.observe()
+    logger.info(f"Inserted {len(inserted)}/{len(datasets)} posts and {attachment_count} attachments")
+    return inserted
+
+
+def ingest_rows_bulk(connection, datasets):
+    """Set-based ingest: one statement each for authors, posts and attachments. New authors are committed
+    first, the posts with everything else in a single transaction."""
+    cursor = connection.cursor()
+    timer = instrumentation.PhaseTimer()
+
+    with timer.phase("authors"):
+        authors = {}
+        for dataset in datasets:
+            authors[dataset["author"]["url"]] = dataset["author"]["username"]
+        author_ids, missing = author_cache.get_many(list(authors))
+        # Sorted so concurrent workers lock author rows in the same order
+        missing.sort()
 
+    try:
+        new_author_ids = {}
+        if missing:
+            # Committed before any post ID is claimed: the posts' transaction locks author rows to count the
+            # posts on them, and an author insert holding rows of its own while it waits for a claim could
+            # deadlock with it. DO NOTHING locks no existing author row, so this waits on nothing but
+            # concurrent inserts of the same authors.
+            with timer.phase("authors"):
+                cursor.execute(
+                    "INSERT INTO authors (url, username) SELECT * FROM unnest(%s::text[], %s::text[]) "
+                    "ON CONFLICT (url) DO NOTHING RETURNING url, id",
+                    (missing, [authors[url] for url in missing]))
+                new_author_ids = dict(cursor.fetchall())
+                if len(new_author_ids) < len(missing):
+                    # Another batch inserted these first, committed by now
+                    cursor.execute("SELECT url, id FROM authors WHERE url = ANY(%s)",
+                                   ([url for url in missing if url not in new_author_ids],))
+                    new_author_ids.update(cursor.fetchall())
                 connection.commit()
-            except:
-                connection.rollback()
-                raise Exception("Failed to insert post and attachments")
+                author_ids.update(new_author_ids)
+                author_cache.put_many(new_author_ids)
+
+        posts = {}
+        indexed_at = {}
+        now = datetime.now()
+        for dataset in datasets:
+            posts.setdefault(dataset["id"], dataset)
+            indexed_at.setdefault(dataset["id"], dataset.get("indexedAt", now))
+
+        # The primary key of the partitioned posts is (id, indexed_at), so it cannot keep IDs unique; the
+        # unpartitioned post_ids can. Claimed in ID order, so batches sharing posts wait on each other
+        # instead of deadlocking, and only the claimed posts are inserted.
+        with timer.phase("posts"):
+            cursor.execute(
+                "INSERT INTO post_ids (id, indexed_at) SELECT * FROM unnest(%s::uuid[], %s::timestamptz[]) AS t(id, indexed_at) "
+                "ORDER BY id ON CONFLICT DO NOTHING RETURNING id",
+                (list(posts), list(indexed_at.values())))
+            claimed = [posts[str(row[0])] for row in cursor.fetchall()]
+            cursor.execute(
+                "INSERT INTO posts (id, content, post_url, tags, author_id, indexed_at) "
+                "SELECT id, content, post_url, tags::jsonb, author_id, indexed_at "
+                "FROM unnest(%s::uuid[], %s::text[], %s::text[], %s::text[], %s::int[], %s::timestamptz[]) "
+                "AS t(id, content, post_url, tags, author_id, indexed_at) RETURNING id",
+                ([dataset["id"] for dataset in claimed],
+                 [post_text(dataset) for dataset in claimed],
+                 [dataset["postURL"] for dataset in claimed],
+                 [json.dumps(dataset["tags"]) for dataset in claimed],
+                 [author_ids[dataset["author"]["url"]] for dataset in claimed],
+                 [indexed_at[dataset["id"]] for dataset in claimed]))
+            inserted = [str(row[0]) for row in cursor.fetchall()]
+
+        # Attachments only for posts that were actually inserted, in their post's partition
+        attachment_urls, descriptions, post_ids, attachment_indexed_at = [], [], [], []
+        for post_id in inserted:
+            for attachment in posts[post_id]["attachments"]:
+                attachment_urls.append(attachment["url"])
+                descriptions.append(attachment["description"])
+                post_ids.append(post_id)
+                attachment_indexed_at.append(indexed_at[post_id])
+
+        if attachment_urls:
+            with timer.phase("attachments"):
+                cursor.execute(
+                    "INSERT INTO attachments (url, description, post_id, indexed_at) "
+                    "SELECT * FROM unnest(%s::text[], %s::text[], %s::uuid[], %s::timestamptz[])",
+                    (attachment_urls, descriptions, post_ids, attachment_indexed_at))
+
+        with timer.phase("tags"):
+            tags.insert_post_tags(cursor, [(tag, indexed_at[post_id], post_id)
+                                           for post_id in inserted for tag in tags.post_tags(posts[post_id])])
+
+        # In the posts' transaction, after the claims, so the counts cannot drift from the posts
+        with timer.phase("aggregates"):
+            author_pages.update_aggregates(cursor, [(author_ids[posts[post_id]["author"]["url"]],
+                                                     len(posts[post_id]["attachments"]), indexed_at[post_id])
+                                                    for post_id in inserted])
+
+        with timer.phase("commit"):
+            connection.commit()
+    except ForeignKeyViolation:
+        # A cached author ID is stale (e.g. the database was reset), the retry looks the authors up again
+        connection.rollback()
+        author_cache.forget([url for url in authors if url not in new_author_ids])
+        raise
+    except:
+        connection.rollback()
+        raise
+
+    # With the filter on, every stored post goes into it, so that row mode workers can rely on it
+    if ingest_filter:
+        with timer.phase("filter"):
+            ingest_filter.mark(list(posts))
+    timer.observe()
+    logger.info(f"Inserted {len(inserted)}/{len(datasets)} posts and {len(attachment_urls)} attachments")
+    return inserted
+
+
+def publish_new_posts(post_ids):
+    """Tells the API's /stream broadcaster about committed posts. Best effort, the posts are stored either way."""
+    if not post_ids:
+        return
+    try:
+        database.get_redis_connection().publish(NEW_POSTS_CHANNEL, json.dumps(post_ids))
+    except RedisError as e:
+        logger.warning(f"Failed to publish {len(post_ids)} new posts: {e}")
+
+
+@app.task(autoretry_for=(Exception,))
+def ingest_batch(datasets):
+    datasets = wire.unpack_batch(datasets)
+    with database.get_db_connection() as connection:
+        if INGEST_MODE == "row":
+            inserted = ingest_rows(connection, datasets)
+        else:
+            inserted = ingest_rows_bulk(connection, datasets)
+    ingest_posts.inc(len(datasets))
+    ingest_duplicates.inc(len(datasets) - len(inserted))
+    with instrumentation.ingest_phase_seconds.labels("publish").time():
+        publish_new_posts(inserted)
+        stats.record(database.get_redis_connection(), datasets, inserted)
+        tags.record(database.get_redis_connection(), datasets, inserted)
     return True
 
 
+@app.task
+def backfill_stats():
+    """Rebuilds the /api/stats hour counters from Postgres, e.g. after Redis lost them."""
+    with database.get_db_connection() as connection:
+        stats.backfill(database.get_redis_connection(), connection)
+
+
+@app.task
+def backfill_tags():
+    """Fills post_tags from posts.tags and rebuilds the trending tag counters, e.g. after adding post_tags."""
+    with database.get_db_connection() as connection:
+        tags.backfill(database.get_redis_connection(), connection)
+
+
+@app.task
+def backfill_author_aggregates():
+    """Recomputes the post and attachment counts of every author, e.g. after adding the columns."""
+    with database.get_db_connection() as connection:
+        author_pages.backfill(connection)
+
+
+@app.task
+def maintain_partitions():
+    """Creates the upcoming posts/attachments partitions and applies retention, see partitions.py."""
+    with database.get_db_connection() as connection:
+        partitions.maintain(connection)
+
+
+# Seconds one embed_pending run may take before it leaves the rest to the next one
+EMBEDDING_TASK_SECONDS = int(os.getenv("EMBEDDING_TASK_SECONDS", 300))
+EMBEDDING_LOCK_KEY = "fedibgs:embedding:running"
+
+embedding_limiter = embeddings.RateLimiter(embeddings.EMBEDDING_RATE_LIMIT)
+
+
+@app.task(autoretry_for=(Exception,), retry_backoff=True, retry_backoff_max=600, max_retries=10)
+def embed_pending():
+    """Embeds posts and attachments that have no embedding yet, see embeddings.py. Scheduled by celery beat;
+    a run that finds another one still going does nothing."""
+    redis = database.get_redis_connection()
+    if not redis.set(EMBEDDING_LOCK_KEY, 1, nx=True, ex=EMBEDDING_TASK_SECONDS + 60):
+        return None
+    try:
+        encoder = embeddings.get_encoder()
+        cache = embeddings.EmbeddingCache(redis, encoder.name)
+        with database.get_db_connection() as connection:
+            return embeddings.embed_pending(connection, encoder, cache, embedding_limiter, max_seconds=EMBEDDING_TASK_SECONDS)
+    finally:
+        redis.delete(EMBEDDING_LOCK_KEY)
+
+
 @app.task(autoretry_for=(Exception,))
 def sync_posts_not_in_meilisearch():
     return
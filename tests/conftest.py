@@ -0,0 +1,47 @@
+"""Fixtures for the tests that need Postgres or Redis.
+
+TEST_DSN names a scratch database whose schema is dropped and re-created from init.sql for every test, and
+TEST_REDIS_URL a Redis database that is flushed. Tests using them are skipped when they are not set.
+"""
+import os
+
+import psycopg
+import pytest
+from redis import Redis
+from redis.backoff import NoBackoff
+from redis.retry import Retry
+
+from benchmarks.common import reset_schema
+
+TEST_DSN = os.getenv("TEST_DSN")
+TEST_REDIS_URL = os.getenv("TEST_REDIS_URL")
+
+
+@pytest.fixture
+def db():
+    if not TEST_DSN:
+        pytest.skip("TEST_DSN not set")
+    connection = psycopg.connect(TEST_DSN)
+    if connection.info.dbname == "fedibgs":
+        connection.close()
+        raise RuntimeError("Refusing to wipe the live fedibgs database, point TEST_DSN at a scratch one")
+    reset_schema(connection)
+    yield connection
+    connection.close()
+
+
+@pytest.fixture
+def redis():
+    if not TEST_REDIS_URL:
+        pytest.skip("TEST_REDIS_URL not set")
+    client = Redis.from_url(TEST_REDIS_URL)
+    client.flushdb()
+    yield client
+    client.flushdb()
+    client.close()
+
+
+@pytest.fixture
+def unreachable():
+    """A Redis client whose every command fails with a RedisError: nothing listens on port 1."""
+    return Redis(host="127.0.0.1", port=1, socket_connect_timeout=0.1, retry=Retry(NoBackoff(), 0))
@@ -0,0 +1,206 @@
+"""Local stand-ins for the remote services the scraper talks to, for the tests and the benchmarks."""
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class MediaHandler(BaseHTTPRequestHandler):
+    """Media host: /ok/<name> serves a file, /slow/<ms>/<name> answers after a delay,
+    /redirect/<name> redirects to /ok/<name>, anything else is a 404. The paths asked for are recorded in
+    server.requests, the most requests handled at once in server.max_in_flight."""
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        server = self.server
+        with server.lock:
+            server.requests.append(self.path)
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            self.respond()
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def respond(self):
+        parts = self.path.strip("/").split("/")
+        if parts[0] == "slow" and len(parts) > 1:
+            time.sleep(int(parts[1]) / 1000.0)
+            self.reply(200)
+        elif parts[0] == "ok":
+            self.reply(200)
+        elif parts[0] == "redirect":
+            self.reply(302, {"Location": "/ok/" + "/".join(parts[1:])})
+        else:
+            self.reply(404)
+
+    do_GET = do_HEAD
+
+    def reply(self, status, headers=None):
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header("Content-Type", "image/jpeg")
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def serve(handler, host="127.0.0.1", port=0):
+    """Runs handler on a background thread, returns the server (server.base_url, server.shutdown())."""
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    server.base_url = "http://%s:%d" % server.server_address
+    server.lock = threading.Lock()
+    server.requests = []
+    server.in_flight = 0
+    server.max_in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class SSEHandler(BaseHTTPRequestHandler):
+    """Mastodon streaming endpoint. Each connection takes the next step of server.plan:
+
+        {"status": 503}                        refuse with an HTTP error
+        {"events": 20, "then": "drop"}         send 20 events, then close the connection
+        {"events": 20, "then": "stall"}        send 20 events, then go silent (no heartbeats) but stay open
+        {"events": 20, "then": "hold"}         send 20 events, then only heartbeats
+
+    server.make_event(n, connection) returns the (event, data) pair for the n-th event, sent on the
+    connection-th connection. Once the plan is used up, connections get {"events": None, "then": "hold"}:
+    events forever. (time, connection) of every dropped or stalled stream is appended to server.failures.
+    """
+
+    def do_GET(self):
+        connection, step = self.server.next_step()
+        if "status" in step:
+            self.send_response(step["status"])
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        try:
+            self.wfile.write(b":)\n")
+            sent = 0
+            last_heartbeat = time.monotonic()
+            while step.get("events") is None or sent < step["events"]:
+                event, data = self.server.make_event(self.server.next_event_number(), connection)
+                self.wfile.write(("event: %s\ndata: %s\n\n" % (event, data)).encode("utf-8"))
+                self.wfile.flush()
+                sent += 1
+                if self.server.interval:
+                    time.sleep(self.server.interval)
+                if time.monotonic() - last_heartbeat > self.server.heartbeat:
+                    self.wfile.write(b":thump\n")
+                    last_heartbeat = time.monotonic()
+
+            if step["then"] == "drop":
+                self.server.failures.append((time.monotonic(), connection))
+                return
+            if step["then"] == "stall":
+                self.server.failures.append((time.monotonic(), connection))
+            while not self.server.stopped:
+                time.sleep(self.server.heartbeat)
+                if step["then"] == "hold":
+                    self.wfile.write(b":thump\n")
+                    self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_sse(make_event, plan=(), interval=0.0, heartbeat=1.0, host="127.0.0.1", port=0):
+    server = serve(SSEHandler, host, port)
+    lock = threading.Lock()
+    steps = list(plan)
+    counter = [0]
+    connections = [0]
+
+    def next_step():
+        with lock:
+            connections[0] += 1
+            return connections[0], steps.pop(0) if steps else {"events": None, "then": "hold"}
+
+    def next_event_number():
+        with lock:
+            counter[0] += 1
+            return counter[0]
+
+    server.make_event = make_event
+    server.next_step = next_step
+    server.next_event_number = next_event_number
+    server.interval = interval
+    server.heartbeat = heartbeat
+    server.failures = []
+    server.stopped = False
+    return server
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    """Mastodon streaming endpoint replaying server.events, [(offset seconds, event, data)], once across all
+    connections: a reconnecting client picks up where the last connection left off, like on a live stream.
+
+    Events go out at server.speed times their recorded pace, or as fast as the client reads with speed 0.
+    The time each event was sent is stored in server.sent_at; once all are sent, server.finished is set and
+    the stream carries only heartbeats.
+    """
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        server = self.server
+        try:
+            self.wfile.write(b":)\n")
+            last_heartbeat = time.monotonic()
+            while not server.stopped:
+                with server.lock:
+                    index = server.position
+                    server.position += 1
+                if index >= len(server.events):
+                    server.finished.set()
+                    time.sleep(server.heartbeat)
+                    self.wfile.write(b":thump\n")
+                    self.wfile.flush()
+                    continue
+
+                offset, event, data = server.events[index]
+                if server.speed:
+                    if server.started is None:
+                        server.started = time.monotonic() - offset / server.speed
+                    delay = server.started + offset / server.speed - time.monotonic()
+                    if delay > 0:
+                        time.sleep(delay)
+                self.wfile.write(b"event: %s\ndata: %s\n\n" % (event, data.replace(b"\n", b"\ndata: ")))
+                self.wfile.flush()
+                server.sent_at[index] = time.monotonic()
+                if time.monotonic() - last_heartbeat > server.heartbeat:
+                    self.wfile.write(b":thump\n")
+                    last_heartbeat = time.monotonic()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_replay(events, speed=1.0, heartbeat=1.0, host="127.0.0.1", port=0):
+    """events: [(offset, event, data)] with event and data as bytes."""
+    server = serve(ReplayHandler, host, port)
+    server.events = events
+    server.speed = speed
+    server.heartbeat = heartbeat
+    server.position = 0
+    server.started = None
+    server.sent_at = [None] * len(events)
+    server.finished = threading.Event()
+    server.stopped = False
+    return server
@@ -0,0 +1,119 @@
+import threading
+
+import pytest
+
+import attachment_resolver
+from attachment_resolver import AttachmentResolver, TTLCache
+from tests.standins import MediaHandler, serve
+
+
+@pytest.fixture
+def media():
+    server = serve(MediaHandler)
+    yield server
+    server.shutdown()
+
+
+def resolve(resolver, candidates):
+    done = threading.Event()
+    result = []
+
+    def callback(post, attachments):
+        result.append((post, attachments))
+        done.set()
+
+    resolver.resolve_post("post", candidates, callback)
+    assert done.wait(10)
+    return result[0]
+
+
+def test_follows_redirects_and_drops_failures(media):
+    resolver = AttachmentResolver()
+    post, attachments = resolve(resolver, [("a cat", media.base_url + "/redirect/cat.jpg"),
+                                           ("a dog", media.base_url + "/ok/dog.jpg"),
+                                           ("gone", media.base_url + "/missing.jpg")])
+    assert post == "post"
+    assert attachments == [{"description": "a cat", "url": media.base_url + "/ok/cat.jpg"},
+                           {"description": "a dog", "url": media.base_url + "/ok/dog.jpg"}]
+    resolver.shutdown()
+
+
+def test_slow_hosts_time_out(media):
+    resolver = AttachmentResolver(timeout=0.2)
+    _, attachments = resolve(resolver, [("", media.base_url + "/slow/2000/late.jpg"),
+                                        ("", media.base_url + "/ok/fine.jpg")])
+    assert attachments == [{"description": "", "url": media.base_url + "/ok/fine.jpg"}]
+    resolver.shutdown()
+
+
+def test_without_candidates_calls_back_inline():
+    resolver = AttachmentResolver()
+    result = []
+    resolver.resolve_post("post", [], lambda post, attachments: result.append(attachments))
+    assert result == [[]]
+    resolver.shutdown()
+
+
+def test_results_and_failures_are_cached(media):
+    resolver = AttachmentResolver()
+    candidates = [("a cat", media.base_url + "/redirect/cat.jpg"), ("gone", media.base_url + "/missing.jpg")]
+    first = resolve(resolver, candidates)
+    second = resolve(resolver, candidates)
+    assert first == second
+    assert sorted(media.requests) == ["/missing.jpg", "/ok/cat.jpg", "/redirect/cat.jpg"]
+    resolver.shutdown()
+
+
+def test_per_host_limit(media):
+    other = serve(MediaHandler)
+    resolver = AttachmentResolver(max_workers=16, per_host=2)
+    candidates = [("", server.base_url + "/slow/100/%d.jpg" % i) for i in range(8) for server in (media, other)]
+    _, attachments = resolve(resolver, candidates)
+
+    assert len(attachments) == 16
+    # Each host gets its own two connections, the rest of its requests wait in its queue
+    assert media.max_in_flight == other.max_in_flight == 2
+    resolver.shutdown()
+    other.shutdown()
+
+
+def test_overflow_gives_up(media):
+    resolver = AttachmentResolver(per_host=1, max_queued_per_host=1)
+    _, attachments = resolve(resolver, [("", media.base_url + "/slow/200/%d.jpg" % i) for i in range(4)])
+    # One in flight, one queued, the rest dropped without a request
+    assert len(attachments) == 2
+    assert len(media.requests) == 2
+    resolver.shutdown()
+
+
+def test_shutdown_drains_queued(media):
+    resolver = AttachmentResolver(per_host=1)
+    results = []
+    for i in range(5):
+        resolver.resolve_post(i, [("", media.base_url + "/slow/50/%d.jpg" % i)],
+                              lambda post, attachments: results.append((post, len(attachments))))
+    resolver.shutdown(wait=True)
+    assert sorted(results) == [(i, 1) for i in range(5)]
+
+    # Nothing is resolved after shutdown, but the post still comes back
+    resolver.resolve_post(5, [("", media.base_url + "/ok/5.jpg")],
+                          lambda post, attachments: results.append((post, len(attachments))))
+    assert results[-1] == (5, 0)
+
+
+def test_ttl_cache_expires_and_evicts(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(attachment_resolver.time, "monotonic", lambda: now[0])
+    cache = TTLCache(max_size=2)
+    cache.set("a", 1, ttl=10)
+    assert cache.get("a") == (True, 1)
+    now[0] += 11
+    assert cache.get("a") == (False, None)
+
+    cache.set("a", 1, ttl=10)
+    cache.set("b", 2, ttl=10)
+    cache.get("a")
+    cache.set("c", 3, ttl=10)
+    # b was the least recently used
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
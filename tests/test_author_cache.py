@@ -0,0 +1,71 @@
+import psycopg
+import pytest
+
+import author_cache
+import tasks
+from author_cache import AuthorCache
+from benchmarks.common import make_datasets, reset_schema
+
+
+def test_lru_evicts_least_recently_used(unreachable):
+    cache = AuthorCache(unreachable, max_size=2)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+
+    assert len(cache) == 2
+    assert cache.get_many(["a", "b", "c"]) == ({"a": 1, "c": 3}, ["b"])
+
+
+def test_works_without_redis(unreachable):
+    cache = AuthorCache(unreachable)
+    assert cache.get_many(["a", "b"]) == ({}, ["a", "b"])
+    cache.put_many({"a": 1})
+    assert cache.get_many(["a", "b"]) == ({"a": 1}, ["b"])
+    cache.forget(["a"])
+    assert cache.get("a") is None
+
+
+def test_shared_between_workers(redis):
+    AuthorCache(redis).put_many({"a": 1, "b": 2})
+    assert AuthorCache(redis).get_many(["a", "b", "c"]) == ({"a": 1, "b": 2}, ["c"])
+
+
+def test_generations(redis, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(author_cache.time, "time", lambda: now[0])
+    AuthorCache(redis, window=100).put_many({"active": 1, "idle": 2})
+
+    now[0] += 100
+    # Found in the previous generation, and carried over into the current one
+    assert AuthorCache(redis, window=100).get("active") == 1
+    now[0] += 100
+    assert AuthorCache(redis, window=100).get_many(["active", "idle"]) == ({"active": 1}, ["idle"])
+    for key in redis.keys(author_cache.REDIS_PREFIX + "*"):
+        assert 0 < redis.ttl(key) <= 200
+
+
+def test_forget(redis):
+    cache = AuthorCache(redis)
+    cache.put_many({"a": 1, "b": 2})
+    cache.forget(["a"])
+    assert cache.get_many(["a", "b"]) == ({"b": 2}, ["a"])
+    assert AuthorCache(redis).get_many(["a", "b"]) == ({"b": 2}, ["a"])
+
+
+@pytest.mark.parametrize("mode", ["row", "bulk"])
+def test_stale_ids_are_dropped(db, redis, monkeypatch, mode):
+    monkeypatch.setattr(tasks, "ingest_filter", None)
+    monkeypatch.setattr(tasks, "author_cache", AuthorCache(redis))
+    ingest_rows = tasks.ingest_rows if mode == "row" else tasks.ingest_rows_bulk
+    datasets = make_datasets(20, n_authors=5)
+    ingest_rows(db, datasets)
+
+    # A fresh database under the same Redis: the cached IDs now point at authors that do not exist
+    reset_schema(db)
+    tasks.author_cache.clear()
+    with pytest.raises(psycopg.errors.ForeignKeyViolation):
+        ingest_rows(db, datasets)
+    # What a retry of the task then does
+    assert sorted(ingest_rows(db, datasets)) == sorted({dataset["id"] for dataset in datasets})
@@ -0,0 +1,147 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import psycopg
+import pytest
+
+import author_pages
+import tasks
+from author_cache import AuthorCache
+from benchmarks.common import make_datasets
+from post_search import decode_cursor
+from tests.conftest import TEST_DSN
+
+START = datetime.now(timezone.utc) - timedelta(days=1)
+
+
+@pytest.fixture
+def ingest(db, redis, monkeypatch):
+    monkeypatch.setattr(tasks, "ingest_filter", None)
+    monkeypatch.setattr(tasks, "author_cache", AuthorCache(redis))
+    return db
+
+
+def author_datasets(n):
+    datasets = make_datasets(n, n_authors=1)
+    for i, dataset in enumerate(datasets):
+        # Pairs of posts indexed at the same instant, so pages have ties to break
+        dataset["indexedAt"] = START + timedelta(minutes=i // 2)
+    return datasets
+
+
+def author_id(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT id FROM authors")
+    (row,) = cursor.fetchall()
+    connection.commit()
+    return row[0]
+
+
+def run(pages):
+    async def connected():
+        async with await psycopg.AsyncConnection.connect(TEST_DSN) as connection:
+            return await pages(connection.cursor())
+    return asyncio.run(connected())
+
+
+async def keyset_pages(cursor, author, limit):
+    pages, after = [], None
+    while True:
+        posts, next_cursor = await author_pages.author_posts(cursor, author, after=after, limit=limit)
+        pages.append([post["id"] for post in posts])
+        if next_cursor is None:
+            return pages
+        after = decode_cursor(next_cursor)
+
+
+async def offset_pages(cursor, author, limit):
+    pages = []
+    while True:
+        posts, _ = await author_pages.author_posts(cursor, author, offset=len(pages) * limit, limit=limit)
+        pages.append([post["id"] for post in posts])
+        if len(posts) < limit:
+            return pages
+
+
+@pytest.mark.parametrize("limit", [3, 4, 20])
+def test_keyset_and_offset_pages_agree(ingest, limit):
+    datasets = author_datasets(14)
+    tasks.ingest_rows_bulk(ingest, datasets)
+    author = author_id(ingest)
+    newest_first = [str(dataset["id"]) for dataset in sorted(datasets, key=lambda dataset: (dataset["indexedAt"], dataset["id"]),
+                                                              reverse=True)]
+
+    keyset = run(lambda cursor: keyset_pages(cursor, author, limit))
+    offset = run(lambda cursor: offset_pages(cursor, author, limit))
+    assert sum(keyset, []) == sum(offset, []) == newest_first
+    assert [len(page) for page in keyset if page] == [len(page) for page in offset if page]
+
+
+def test_keyset_pages_are_stable_under_new_posts(ingest):
+    datasets = author_datasets(7)
+    tasks.ingest_rows_bulk(ingest, datasets[:6])
+    author = author_id(ingest)
+
+    async def pages(cursor):
+        first, next_cursor = await author_pages.author_posts(cursor, author, limit=3)
+        # A newer post arrives between the reads of the two pages
+        await asyncio.to_thread(tasks.ingest_rows_bulk, ingest, datasets[6:])
+        second, _ = await author_pages.author_posts(cursor, author, after=decode_cursor(next_cursor), limit=3)
+        shifted, _ = await author_pages.author_posts(cursor, author, offset=3, limit=3)
+        return [post["id"] for post in first], [post["id"] for post in second], [post["id"] for post in shifted]
+
+    first, second, shifted = run(pages)
+    assert not set(first) & set(second)
+    assert len(set(first + second)) == 6
+    # The offset page shows the last post of the first page again
+    assert shifted[0] == first[-1]
+
+
+@pytest.mark.parametrize("mode", ["row", "bulk"])
+def test_aggregates_follow_ingest(ingest, mode):
+    ingest_rows = tasks.ingest_rows if mode == "row" else tasks.ingest_rows_bulk
+    datasets = author_datasets(10)
+    ingest_rows(ingest, datasets[:6])
+    ingest_rows(ingest, datasets)
+    author = author_id(ingest)
+
+    totals = run(lambda cursor: author_pages.get_author(cursor, author))
+    assert totals["total_posts"] == 10
+    assert totals["total_attachments"] == sum(len(dataset["attachments"]) for dataset in datasets)
+    assert totals["first_seen"] == int(datasets[0]["indexedAt"].timestamp()) * 1000
+    assert totals["last_seen"] == int(datasets[-1]["indexedAt"].timestamp()) * 1000
+
+    author_pages.backfill(ingest)
+    assert run(lambda cursor: author_pages.get_author(cursor, author)) == totals
+
+
+def stored_posts(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT COUNT(*) FROM posts")
+    count = cursor.fetchone()[0]
+    connection.commit()
+    return count
+
+
+@pytest.mark.parametrize("mode", ["row", "bulk"])
+def test_posts_and_counts_commit_together(ingest, mode, monkeypatch):
+    ingest_rows = tasks.ingest_rows if mode == "row" else tasks.ingest_rows_bulk
+    datasets = author_datasets(4)
+    ingest_rows(ingest, datasets[:2])
+
+    # Counting fails, as when the worker dies right there: the posts go with the counts
+    def fail(cursor, rows):
+        raise psycopg.errors.QueryCanceled()
+
+    monkeypatch.setattr(tasks.author_pages, "update_aggregates", fail)
+    with pytest.raises(Exception):
+        ingest_rows(ingest, datasets[2:])
+    monkeypatch.undo()
+    author = author_id(ingest)
+    assert stored_posts(ingest) == 2
+    assert run(lambda cursor: author_pages.get_author(cursor, author))["total_posts"] == 2
+
+    # So the retry stores and counts them
+    ingest_rows(ingest, datasets[2:])
+    assert stored_posts(ingest) == 4
+    assert run(lambda cursor: author_pages.get_author(cursor, author))["total_posts"] == 4
@@ -0,0 +1,67 @@
+import asyncio
+
+import psycopg
+import pytest
+from redis.asyncio import Redis as AsyncRedis
+
+import author_search
+from author_search import AuthorSearchCache, like_escape
+from tests.conftest import TEST_DSN, TEST_REDIS_URL
+
+USERNAMES = ["al", "alice", "Alice_B", "malice", "bob", "a_b", "a%b"]
+
+
+def test_like_escape():
+    assert like_escape("50%_off\\") == "50\\%\\_off\\\\"
+    assert like_escape("plain") == "plain"
+
+
+@pytest.fixture
+def authors(db):
+    cursor = db.cursor()
+    for username in USERNAMES:
+        cursor.execute("INSERT INTO authors (url, username) VALUES (%s, %s)",
+                       ("https://example.social/@" + username, username))
+    db.commit()
+    cursor.execute("SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm'")
+    return cursor.fetchone() is not None
+
+
+def search(q, limit=50):
+    async def run():
+        async with await psycopg.AsyncConnection.connect(TEST_DSN) as connection:
+            return [author["username"] for author in
+                    await author_search.search_authors(connection.cursor(), q, limit)]
+    return asyncio.run(run())
+
+
+def test_short_queries_match_username_prefixes(authors):
+    # Exact match first, then the shortest names
+    assert search("AL") == ["al", "alice", "Alice_B"]
+    assert search("al", limit=2) == ["al", "alice"]
+
+
+def test_wildcards_are_literal(authors):
+    assert search("a_") == ["a_b"]
+    assert search("a%") == ["a%b"]
+    assert search("  ") == []
+
+
+def test_longer_queries_match_anywhere(authors):
+    if not authors:
+        pytest.skip("pg_trgm is not installed")
+    # Exact, then prefix matches, then the rest
+    assert search("alice") == ["alice", "Alice_B", "malice"]
+    assert search("example.social/@bob") == ["bob"]
+
+
+def test_results_are_cached(redis):
+    async def run():
+        client = AsyncRedis.from_url(TEST_REDIS_URL)
+        cache = AuthorSearchCache(client, ttl=30)
+        await cache.put_results("alice", 10, b"[]")
+        results = await cache.get_results("alice", 10), await cache.get_results("alice", 50)
+        await client.aclose()
+        return results
+
+    assert asyncio.run(run()) == (b"[]", None)
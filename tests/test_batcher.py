@@ -0,0 +1,97 @@
+import os
+import pickle
+import threading
+import time
+
+from batcher import AdaptiveBatcher
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+def test_flushes_at_size():
+    sent = []
+    batcher = AdaptiveBatcher(sent.append, min_size=4, max_size=4, max_latency=60)
+    for i in range(8):
+        batcher.add(i)
+    wait_for(lambda: len(sent) == 2)
+    assert sent == [[0, 1, 2, 3], [4, 5, 6, 7]]
+    batcher.close()
+
+
+def test_flushes_after_max_latency():
+    sent = []
+    batcher = AdaptiveBatcher(sent.append, min_size=100, max_latency=0.2)
+    batcher.add("a")
+    wait_for(lambda: sent)
+    assert sent == [["a"]]
+    batcher.close()
+
+
+def test_close_sends_buffered_posts():
+    sent = []
+    batcher = AdaptiveBatcher(sent.append, min_size=100, max_latency=60)
+    for i in range(3):
+        batcher.add(i)
+    batcher.close()
+    assert sent == [[0, 1, 2]]
+
+
+def test_add_after_close_sends_right_away():
+    sent = []
+    batcher = AdaptiveBatcher(sent.append, min_size=100, max_latency=60)
+    batcher.close()
+    batcher.add("late")
+    assert sent == [["late"]]
+    assert len(batcher) == 0
+
+
+def test_add_after_close_spills(tmp_path):
+    batcher = AdaptiveBatcher(lambda batch: None, spill_dir=str(tmp_path))
+    batcher.close()
+    batcher.add("late")
+    spilled = [name for name in os.listdir(tmp_path) if name.endswith(".batch")]
+    assert len(spilled) == 1
+    with open(tmp_path / spilled[0], "rb") as f:
+        assert pickle.load(f) == ["late"]
+
+
+def test_spilled_batches_are_replayed(tmp_path):
+    broker_up = threading.Event()
+    sent = []
+
+    def send(batch):
+        if not broker_up.is_set():
+            raise ConnectionError("broker down")
+        sent.append(batch)
+
+    batcher = AdaptiveBatcher(send, min_size=1, max_size=1, max_pending=1, spill_dir=str(tmp_path))
+    for i in range(3):
+        batcher.add(i)
+    broker_up.set()
+    wait_for(lambda: sorted(post for batch in sent for post in batch) == [0, 1, 2], timeout=15)
+    batcher.close()
+
+
+def test_unreadable_spill_file_is_moved_aside(tmp_path):
+    with open(tmp_path / "1.batch", "wb") as f:
+        # Cut off mid-write
+        f.write(pickle.dumps(["lost"] * 100)[:20])
+    with open(tmp_path / "2.batch", "wb") as f:
+        pickle.dump(["kept"], f)
+
+    sent = []
+    batcher = AdaptiveBatcher(sent.append, spill_dir=str(tmp_path))
+    wait_for(lambda: sent)
+    assert sent == [["kept"]]
+    assert sorted(os.listdir(tmp_path)) == ["1.batch.bad"]
+
+    # The sender is still alive
+    batcher.add("after")
+    batcher.close()
+    assert sent == [["kept"], ["after"]]
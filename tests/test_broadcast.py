@@ -0,0 +1,83 @@
+import asyncio
+import json
+
+import pytest
+from redis.asyncio import Redis as AsyncRedis
+
+from broadcast import NEW_POSTS_CHANNEL, Broadcaster
+from tests.conftest import TEST_REDIS_URL
+
+
+def test_fan_out_to_every_subscriber():
+    broadcaster = Broadcaster(None, None, queue_size=4)
+
+    async def run():
+        first, second = broadcaster.subscribe(), broadcaster.subscribe()
+        broadcaster.publish("one")
+        broadcaster.publish("two")
+        return [await first.next(), await first.next()], [await second.next(), await second.next()]
+
+    assert asyncio.run(run()) == (["one", "two"], ["one", "two"])
+
+
+def test_slow_subscriber_is_dropped():
+    broadcaster = Broadcaster(None, None, queue_size=2)
+
+    async def run():
+        slow, fast = broadcaster.subscribe(), broadcaster.subscribe()
+        received = []
+        for payload in ("one", "two", "three"):
+            broadcaster.publish(payload)
+            received.append(await fast.next())
+        # The backlog is thrown away, the slow one only gets told it was dropped
+        return received, await slow.next(), slow.dropped
+
+    assert asyncio.run(run()) == (["one", "two", "three"], None, True)
+    assert len(broadcaster.subscribers) == 1
+
+
+def test_unsubscribe():
+    broadcaster = Broadcaster(None, None)
+
+    async def run():
+        subscriber = broadcaster.subscribe()
+        broadcaster.unsubscribe(subscriber)
+        broadcaster.publish("one")
+        return subscriber.queue.empty()
+
+    assert asyncio.run(run())
+    assert not broadcaster.subscribers
+
+
+def test_published_posts_are_fetched_once_per_interval(redis):
+    fetched = []
+
+    async def fetch(post_ids):
+        fetched.append(post_ids)
+        return [{"id": post_id} for post_id in post_ids]
+
+    async def run():
+        client = AsyncRedis.from_url(TEST_REDIS_URL)
+        broadcaster = Broadcaster(client, fetch, interval=0.5)
+        subscriber = broadcaster.subscribe()
+        broadcaster.start()
+        # Wait for the subscription before publishing
+        while (await client.pubsub_numsub(NEW_POSTS_CHANNEL))[0][1] == 0:
+            await asyncio.sleep(0.01)
+        # Two batches committed at the same time
+        async with client.pipeline(transaction=True) as pipeline:
+            pipeline.publish(NEW_POSTS_CHANNEL, json.dumps(["a", "b"]))
+            pipeline.publish(NEW_POSTS_CHANNEL, json.dumps(["c"]))
+            await pipeline.execute()
+        updates = []
+        while not any(update["posts"] for update in updates):
+            updates.append(json.loads(await asyncio.wait_for(subscriber.next(), 5)))
+        await broadcaster.stop()
+        await client.aclose()
+        return updates
+
+    updates = asyncio.run(run())
+    assert [post["id"] for post in updates[-1]["posts"]] == ["a", "b", "c"]
+    # Updates without new posts are heartbeats
+    assert all(update == {"posts": []} for update in updates[:-1])
+    assert fetched == [["a", "b", "c"]]
@@ -0,0 +1,87 @@
+import hashlib
+import uuid
+
+import pytest
+
+from dedup import BloomFilter, RotatingBloomFilter, SeenPosts, bloom_geometry, bloom_indexes
+
+
+def keys(n, start=0):
+    # Post UUIDs are MD5 digests of the post URL
+    return [uuid.UUID(hashlib.md5(b"%d" % i).hexdigest()) for i in range(start, start + n)]
+
+
+def test_geometry():
+    size, hashes = bloom_geometry(1000000, 0.001)
+    # About 1.8 MiB and 10 hashes for a million keys at 0.1%
+    assert 14000000 < size < 15000000
+    assert hashes == 10
+
+
+def test_indexes_are_the_same_for_every_form_of_a_uuid():
+    key = uuid.uuid4()
+    assert bloom_indexes(key, 1000, 7) == bloom_indexes(str(key), 1000, 7) == bloom_indexes(key.bytes, 1000, 7)
+
+
+def test_no_false_negatives_and_bounded_false_positives():
+    bloom = BloomFilter(10000, error_rate=0.01)
+    for key in keys(10000):
+        bloom.add(key)
+    assert all(key in bloom for key in keys(10000))
+
+    false_positives = sum(1 for key in keys(100000, start=10000) if key in bloom)
+    assert false_positives < 100000 * 0.01 * 1.5
+
+
+def test_add_reports_presence():
+    bloom = BloomFilter(100)
+    key = uuid.uuid4()
+    assert not bloom.add(key)
+    assert bloom.add(key)
+    assert bloom.count == 1
+
+
+def test_rotation_keeps_two_generations():
+    bloom = RotatingBloomFilter(capacity=1000, error_rate=0.001)
+    memory = bloom.memory_bytes
+    fresh = iter(keys(10000))
+
+    def fill():
+        """Adds new keys until the current generation is full and rotates."""
+        generation = bloom.current
+        added = []
+        while bloom.current is generation:
+            added.append(next(fresh))
+            bloom.add(added[-1])
+        return added
+
+    first = fill()
+    second = fill()
+    assert all(key in bloom for key in second)
+    # Two generations on, the first keys are forgotten, save for false positives
+    assert sum(1 for key in first if key in bloom) < 10
+    assert bloom.memory_bytes == memory
+
+
+def test_seen_posts_locally():
+    seen = SeenPosts(capacity=1000)
+    key = uuid.uuid4()
+    assert not seen.seen(key)
+    assert seen.seen(key)
+
+
+def test_seen_posts_shared(redis):
+    key = uuid.uuid4()
+    first, second = SeenPosts(capacity=1000, redis=redis, ttl=60), SeenPosts(capacity=1000, redis=redis, ttl=60)
+    assert not first.seen(key)
+    # Another scraper enqueued it already
+    assert second.seen(key)
+    assert 0 < redis.ttl(SeenPosts.REDIS_PREFIX + str(key)) <= 60
+
+
+def test_seen_posts_without_redis(unreachable):
+    seen = SeenPosts(capacity=1000, redis=unreachable)
+    key = uuid.uuid4()
+    # Redis failing lets the post through, the local filter still catches the repeat
+    assert not seen.seen(key)
+    assert seen.seen(key)
@@ -0,0 +1,109 @@
+import math
+
+import pytest
+
+import embeddings
+from embeddings import EmbeddingCache, HashEncoder, RateLimiter
+
+
+def cosine(a, b):
+    return sum(x * y for x, y in zip(a, b))
+
+
+def test_hash_encoder():
+    encoder = HashEncoder(dimensions=64)
+    coffee, more_coffee, cats, empty = encoder.encode("text", ["Coffee in the morning", "coffee in the MORNING!",
+                                                               "cats sleeping all day", ""])
+    assert len(coffee) == 64
+    assert math.isclose(math.sqrt(sum(x * x for x in coffee)), 1.0)
+    assert coffee == more_coffee
+    assert cosine(coffee, cats) < 0.9
+    assert empty == [0.0] * 64
+    assert encoder.encode("text", ["Coffee in the morning"]) == [coffee]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """A monotonic clock that only moves when sleeping or when told to."""
+    now = [100.0]
+    slept = []
+
+    def sleep(seconds):
+        slept.append(seconds)
+        now[0] += seconds
+
+    monkeypatch.setattr(embeddings.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(embeddings.time, "sleep", sleep)
+    return now, slept
+
+
+def test_rate_limiter(clock):
+    now, slept = clock
+    limiter = RateLimiter(10)
+    # A second's worth goes through at once
+    limiter.wait(10)
+    assert slept == []
+    # Then the bucket refills at rate per second
+    limiter.wait(5)
+    assert slept == [pytest.approx(0.5)]
+    now[0] += 10
+    limiter.wait(10)
+    assert len(slept) == 1
+
+
+def test_rate_limiter_disabled(clock):
+    limiter = RateLimiter(0)
+    limiter.wait(1000000)
+    assert clock[1] == []
+
+
+def test_embedding_cache(redis):
+    cache = EmbeddingCache(redis, "hash4", ttl=60, failure_ttl=10)
+    assert cache.get_many("text", []) == {}
+    cache.put_many("text", {"a": [0.5, -0.25, 0.0, 1.0], "gone": None})
+    assert cache.get_many("text", ["a", "b", "gone"]) == {"a": [0.5, -0.25, 0.0, 1.0], "gone": False}
+    # Per kind and per model
+    assert cache.get_many("image", ["a"]) == {}
+    assert EmbeddingCache(redis, "clip:other").get_many("text", ["a"]) == {}
+    assert 0 < redis.ttl(cache._key("text", "gone")) <= 10 < redis.ttl(cache._key("text", "a")) <= 60
+
+
+def test_embedding_cache_without_redis(unreachable):
+    cache = EmbeddingCache(unreachable, "hash4")
+    cache.put_many("text", {"a": [1.0]})
+    assert cache.get_many("text", ["a"]) == {}
+
+
+class CountingEncoder(HashEncoder):
+    """Fails on contents containing "bad", and counts the contents it was asked for."""
+
+    def __init__(self, fail_all=False):
+        super().__init__(dimensions=4)
+        self.encoded = []
+        self.fail_all = fail_all
+
+    def encode(self, kind, contents):
+        if self.fail_all or any("bad" in content for content in contents):
+            raise RuntimeError("cannot encode")
+        self.encoded.extend(contents)
+        return super().encode(kind, contents)
+
+
+def test_embed_encodes_each_content_once(redis):
+    encoder = CountingEncoder()
+    cache = EmbeddingCache(redis, encoder.name)
+    vectors = embeddings.embed("text", ["a", "b", "a", "bad one", "c"], encoder, cache, batch_size=2)
+    assert set(vectors) == {"a", "b", "bad one", "c"}
+    assert vectors["bad one"] is None
+    assert sorted(encoder.encoded) == ["a", "b", "c"]
+
+    # Cached, the failure included
+    encoder.encoded.clear()
+    assert embeddings.embed("text", ["a", "bad one", "d"], encoder, cache) == {
+        "a": vectors["a"], "bad one": None, "d": HashEncoder(dimensions=4).encode("text", ["d"])[0]}
+    assert encoder.encoded == ["d"]
+
+
+def test_embed_raises_when_the_encoder_is_down(unreachable):
+    with pytest.raises(RuntimeError):
+        embeddings.embed("text", ["a", "b"], CountingEncoder(fail_all=True), EmbeddingCache(unreachable, "hash4"))
@@ -0,0 +1,52 @@
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import hydrate
+
+NOW = datetime(2024, 8, 1, 12, 0, 0, 500000, tzinfo=timezone.utc)
+
+
+def test_format_post():
+    post_id = uuid.uuid4()
+    attachments = [{"id": str(post_id), "description": "a cat", "url": "https://media.example.social/1.jpg"}]
+    assert hydrate.format_post((post_id, "text", "user", "https://example.social/@user/1", NOW, 7, attachments)) == {
+        "id": str(post_id), "content": "text", "username": "user", "post_url": "https://example.social/@user/1",
+        # Milliseconds, truncated to the second
+        "indexed_at": 1722513600000, "attachments": attachments, "author_id": 7,
+    }
+
+
+def test_select_posts_appends_extra_columns():
+    query = hydrate.select_posts("WHERE posts.id = %s", "page.score")
+    assert query.startswith("SELECT " + hydrate.POST_COLUMNS + ", page.score FROM posts JOIN authors")
+    assert query.endswith("WHERE posts.id = %s")
+
+
+def test_hydrates_posts_with_their_attachments(db):
+    cursor = db.cursor()
+    cursor.execute("INSERT INTO authors (url, username) VALUES ('https://example.social/@user', 'user') RETURNING id")
+    author_id = cursor.fetchone()[0]
+    now = datetime.now(timezone.utc)
+    posts = [(uuid.uuid4(), now - timedelta(minutes=i)) for i in range(3)]
+    for i, (post_id, indexed_at) in enumerate(posts):
+        cursor.execute("INSERT INTO posts (id, content, post_url, tags, author_id, indexed_at) "
+                       "VALUES (%s, %s, %s, '[]', %s, %s)", (post_id, "post %d" % i, "https://example.social/@user/%d" % i,
+                                                             author_id, indexed_at))
+        # Post i has i attachments
+        for n in range(i):
+            cursor.execute("INSERT INTO attachments (url, description, post_id, indexed_at) VALUES (%s, %s, %s, %s)",
+                           ("https://media.example.social/%d_%d.jpg" % (i, n), "attachment %d" % n, post_id, indexed_at))
+    db.commit()
+
+    cursor = db.cursor(row_factory=hydrate.post_row)
+    cursor.execute(hydrate.select_posts("ORDER BY posts.indexed_at DESC"))
+    hydrated = cursor.fetchall()
+
+    assert [post["id"] for post in hydrated] == [str(post_id) for post_id, _ in posts]
+    assert [post["content"] for post in hydrated] == ["post 0", "post 1", "post 2"]
+    assert all(post["username"] == "user" and post["author_id"] == author_id for post in hydrated)
+    assert [[attachment["url"] for attachment in post["attachments"]] for post in hydrated] == [
+        [], ["https://media.example.social/1_0.jpg"],
+        ["https://media.example.social/2_0.jpg", "https://media.example.social/2_1.jpg"]]
+    assert hydrated[2]["attachments"][1] == {"id": str(posts[2][0]), "description": "attachment 1",
+                                             "url": "https://media.example.social/2_1.jpg"}
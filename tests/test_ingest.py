@@ -0,0 +1,73 @@
+import copy
+from datetime import timedelta
+
+import pytest
+
+import tasks
+from author_cache import AuthorCache
+from benchmarks.common import make_datasets, reset_schema
+
+
+@pytest.fixture
+def ingest(db, redis, monkeypatch):
+    monkeypatch.setattr(tasks, "ingest_filter", None)
+
+    def run(mode, batches):
+        reset_schema(db)
+        redis.flushdb()
+        monkeypatch.setattr(tasks, "author_cache", AuthorCache(redis))
+        ingest_rows = tasks.ingest_rows if mode == "row" else tasks.ingest_rows_bulk
+        inserted = [sorted(ingest_rows(db, batch)) for batch in batches]
+        return inserted, snapshot(db)
+
+    return run
+
+
+def snapshot(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT p.id, p.content, p.post_url, p.tags, a.url, a.username, p.indexed_at FROM posts p "
+                   "JOIN authors a ON a.id = p.author_id ORDER BY p.id")
+    posts = cursor.fetchall()
+    cursor.execute("SELECT post_id, url, description, indexed_at FROM attachments ORDER BY post_id, url")
+    attachments = cursor.fetchall()
+    cursor.execute("SELECT tag, post_id, indexed_at FROM post_tags ORDER BY tag, post_id")
+    post_tags = cursor.fetchall()
+    cursor.execute("SELECT url, username, post_count, attachment_count, first_seen, last_seen FROM authors ORDER BY url")
+    authors = cursor.fetchall()
+    cursor.execute("SELECT id, indexed_at FROM post_ids ORDER BY id")
+    post_ids = cursor.fetchall()
+    connection.commit()
+    return {"posts": posts, "attachments": attachments, "post_tags": post_tags, "authors": authors,
+            "post_ids": post_ids}
+
+
+def batches():
+    datasets = make_datasets(60, duplicate_ratio=0.2, n_authors=10, attachment_ratio=0.5)
+    first, second = datasets[:40], datasets[40:]
+    # Posts seen again a week later, when they would land in another partition
+    later = [copy.deepcopy(dataset) for dataset in first[:5]]
+    for dataset in later:
+        dataset["indexedAt"] += timedelta(days=7)
+    return [first, second + later + first[5:10]]
+
+
+def test_row_and_bulk_store_the_same(ingest):
+    posts = batches()
+    row_inserted, row = ingest("row", copy.deepcopy(posts))
+    bulk_inserted, bulk = ingest("bulk", posts)
+
+    assert row_inserted == bulk_inserted
+    assert row == bulk
+
+
+def test_duplicates_are_stored_once(ingest):
+    posts = batches()
+    inserted, stored = ingest("bulk", posts)
+
+    unique = {dataset["id"] for batch in posts for dataset in batch}
+    assert sum(len(batch) for batch in inserted) == len(unique)
+    assert len(stored["posts"]) == len(stored["post_ids"]) == len(unique)
+    # The second batch repeats posts of the first, only its new ones go in
+    assert not set(inserted[0]) & set(inserted[1])
+    assert sum(author[2] for author in stored["authors"]) == len(unique)
+    assert sum(author[3] for author in stored["authors"]) == len(stored["attachments"])
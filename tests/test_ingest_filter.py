@@ -0,0 +1,81 @@
+import uuid
+
+import psycopg
+import pytest
+
+import dedup
+import tasks
+from author_cache import AuthorCache
+from benchmarks.common import make_datasets, reset_schema
+from dedup import IngestFilter
+
+IDS = [str(uuid.uuid4()) for _ in range(20)]
+
+
+def test_marked_posts_are_seen(redis):
+    ingest_filter = IngestFilter(redis, capacity=1000)
+    assert ingest_filter.check([]) == set()
+    assert ingest_filter.check(IDS) == set()
+    ingest_filter.mark(IDS[:10])
+    assert ingest_filter.check(IDS) == set(IDS[:10])
+    # Checking marks nothing
+    assert IngestFilter(redis, capacity=1000).check(IDS[10:]) == set()
+
+
+def test_posts_are_remembered_for_one_to_two_windows(redis, monkeypatch):
+    now = [1000000.0]
+    monkeypatch.setattr(dedup.time, "time", lambda: now[0])
+    ingest_filter = IngestFilter(redis, capacity=1000, window=100)
+    ingest_filter.mark(IDS[:5])
+
+    now[0] += 100
+    assert ingest_filter.check(IDS[:5]) == set(IDS[:5])
+    ingest_filter.mark(IDS[:2])
+    assert redis.ttl(ingest_filter._key(10001)) == 200
+
+    now[0] += 100
+    assert ingest_filter.check(IDS[:5]) == set(IDS[:2])
+
+
+def test_unavailable(unreachable):
+    ingest_filter = IngestFilter(unreachable, capacity=1000)
+    assert ingest_filter.check(IDS) is None
+    ingest_filter.mark(IDS)
+
+
+def false_positives():
+    return dedup.ingest_filter_false_positives._value.get()
+
+
+@pytest.fixture
+def ingest(db, redis, monkeypatch):
+    monkeypatch.setattr(tasks, "ingest_filter", IngestFilter(redis, capacity=1000))
+    monkeypatch.setattr(tasks, "author_cache", AuthorCache(redis))
+    return db
+
+
+@pytest.mark.parametrize("mode", ["row", "bulk"])
+def test_ingest_marks_stored_posts(ingest, mode):
+    datasets = make_datasets(20, n_authors=5)
+    (tasks.ingest_rows if mode == "row" else tasks.ingest_rows_bulk)(ingest, datasets)
+    ids = [str(dataset["id"]) for dataset in datasets]
+    assert tasks.ingest_filter.check(ids) == set(ids)
+
+    before = false_positives()
+    assert tasks.ingest_rows(ingest, datasets) == []
+    assert false_positives() == before
+
+
+def test_failed_batch_is_not_marked(ingest):
+    datasets = make_datasets(20, n_authors=5)
+    tasks.ingest_rows(ingest, datasets[:10])
+    # Stale cached author IDs fail the next batch, which is then retried
+    reset_schema(ingest)
+    tasks.author_cache.clear()
+    before = false_positives()
+    with pytest.raises(psycopg.errors.ForeignKeyViolation):
+        tasks.ingest_rows(ingest, datasets[10:])
+    assert tasks.ingest_filter.check([str(dataset["id"]) for dataset in datasets[10:]]) == set()
+
+    assert len(tasks.ingest_rows(ingest, datasets[10:])) == 10
+    assert false_positives() == before
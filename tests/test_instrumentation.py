@@ -0,0 +1,88 @@
+import logging
+import threading
+
+import pytest
+from prometheus_client import CollectorRegistry, Histogram
+
+import instrumentation
+from instrumentation import PhaseTimer, RateLimitedLog
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(instrumentation.time, "monotonic", lambda: now[0])
+    monkeypatch.setattr(instrumentation.time, "perf_counter", lambda: now[0])
+    return now
+
+
+@pytest.fixture
+def logger(caplog):
+    caplog.set_level(logging.DEBUG, logger="test_instrumentation")
+    return logging.getLogger("test_instrumentation")
+
+
+def test_rate_limited_log(clock, logger, caplog):
+    log = RateLimitedLog(logger, interval=60, burst=2)
+    for i in range(5):
+        log.debug("Post already exists", post=i)
+    log.info("Inserted post", post=9)
+    assert [record.getMessage() for record in caplog.records] == [
+        "Post already exists post=0", "Post already exists post=1", "Inserted post post=9"]
+    assert caplog.records[0].fields == {"post": 0}
+
+    # The next window reports how many were held back, once
+    clock[0] += 60
+    for i in range(5, 8):
+        log.debug("Post already exists", post=i)
+    assert [record.getMessage() for record in caplog.records[3:]] == [
+        "Post already exists post=5 suppressed=3", "Post already exists post=6"]
+
+
+def test_rate_limited_log_skips_disabled_levels(clock, logger, caplog):
+    logger.setLevel(logging.INFO)
+    log = RateLimitedLog(logger, burst=1)
+    log.debug("Post already exists", post=1)
+    log.warning("Post already exists", post=2)
+    assert [record.getMessage() for record in caplog.records] == ["Post already exists post=2"]
+    logger.setLevel(logging.NOTSET)
+
+
+def test_rate_limited_log_is_thread_safe(logger, caplog):
+    log = RateLimitedLog(logger, burst=10)
+    threads = [threading.Thread(target=lambda: [log.debug("busy") for _ in range(100)]) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(caplog.records) == 10
+
+
+def test_phase_timer(clock):
+    histogram = Histogram("phase_seconds", "", ["phase"], registry=CollectorRegistry())
+    timer = PhaseTimer(histogram)
+    for seconds in (0.5, 0.25):
+        with timer.phase("posts"):
+            clock[0] += seconds
+    with pytest.raises(ValueError):
+        with timer.phase("commit"):
+            clock[0] += 1
+            raise ValueError()
+    assert timer.seconds == {"posts": 0.75, "commit": 1.0}
+
+    # One observation per phase and batch
+    timer.observe()
+    assert histogram.labels("posts")._sum.get() == 0.75
+    assert histogram.labels("commit")._sum.get() == 1.0
+    assert sum(bucket.get() for bucket in histogram.labels("posts")._buckets) == 1
+
+
+def test_query_time():
+    instrumentation.add_query_time(1.0)
+    with instrumentation.query_time() as outer:
+        instrumentation.add_query_time(0.5)
+        with instrumentation.query_time() as inner:
+            instrumentation.add_query_time(0.25)
+        instrumentation.add_query_time(0.5)
+    assert outer == [1.0]
+    assert inner == [0.25]
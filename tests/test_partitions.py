@@ -0,0 +1,136 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import partitions
+from partitions import _parse_bound, period_start
+
+UTC = timezone.utc
+# Thursday 2024-08-01 23:30 in UTC-2 is Friday 01:30 UTC
+MOMENT = datetime(2024, 8, 1, 23, 30, tzinfo=timezone(timedelta(hours=-2)))
+
+
+def test_period_start():
+    assert period_start(MOMENT, "day") == datetime(2024, 8, 2, tzinfo=UTC)
+    assert period_start(MOMENT, "week") == datetime(2024, 7, 29, tzinfo=UTC)
+    monday = datetime(2024, 7, 29, tzinfo=UTC)
+    assert period_start(monday, "week") == monday
+
+
+def test_parse_bound():
+    assert _parse_bound("2024-08-01 00:00:00+00") == datetime(2024, 8, 1, tzinfo=UTC)
+    assert _parse_bound("2024-08-01 00:00:00+05:30") == datetime(2024, 7, 31, 18, 30, tzinfo=UTC)
+    assert partitions.partition_name("posts", datetime(2024, 8, 1, tzinfo=UTC)) == "posts_p20240801"
+
+
+def test_no_retention_touches_nothing():
+    assert partitions.apply_retention(None, retention_days=0) == []
+
+
+def dated_partitions(cursor, table):
+    return [name for name, _, _ in partitions.existing_partitions(cursor, table)]
+
+
+def test_retention_removes_partitions_ending_by_the_cutoff(db):
+    now = datetime(2024, 8, 21, 12, tzinfo=UTC)
+    partitions.ensure_partitions(db, first=datetime(2024, 7, 29, tzinfo=UTC), now=now, interval="day", premake=0)
+    cursor = db.cursor()
+    cursor.execute("INSERT INTO authors (url, username) VALUES ('https://example.social/@a', 'a') RETURNING id")
+    author_id = cursor.fetchone()[0]
+    for day in (29, 30, 31):
+        indexed_at = datetime(2024, 7, day, 12, tzinfo=UTC)
+        cursor.execute("INSERT INTO post_ids (id, indexed_at) VALUES (gen_random_uuid(), %s) RETURNING id", (indexed_at,))
+        cursor.execute("INSERT INTO posts (id, content, post_url, tags, author_id, indexed_at) "
+                       "VALUES (%s, 'hi', 'https://example.social/@a/1', '[]', %s, %s)",
+                       (cursor.fetchone()[0], author_id, indexed_at))
+    db.commit()
+
+    # 20 days before now is 2024-08-01 12:00: the July partitions end by then, August's first does not
+    removed = partitions.apply_retention(db, retention_days=20, drop=True, now=now)
+    assert sorted(name for name in removed if name.startswith("posts_")) == [
+        "posts_p20240729", "posts_p20240730", "posts_p20240731"]
+    assert dated_partitions(cursor, "posts")[0] == "posts_p20240801"
+    assert dated_partitions(cursor, "attachments")[0] == "attachments_p20240801"
+    cursor.execute("SELECT COUNT(*) FROM post_ids")
+    assert cursor.fetchone()[0] == 0
+    db.commit()
+
+
+LEGACY_POSTS = """
+CREATE TABLE posts (
+       id UUID PRIMARY KEY,
+       content TEXT NOT NULL,
+       post_url TEXT NOT NULL,
+       tags JSONB NOT NULL,
+       author_id INT NOT NULL REFERENCES authors(id),
+       indexed_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE TABLE attachments (
+     id SERIAL PRIMARY KEY,
+     post_id UUID NOT NULL REFERENCES posts(id) ON DELETE CASCADE,
+     description TEXT,
+     url TEXT NOT NULL,
+     indexed_at TIMESTAMPTZ DEFAULT NOW()
+);
+CREATE INDEX post_id_idx ON posts(id);
+CREATE INDEX posts_author_id_idx ON posts(author_id)
+"""
+
+
+def indexes(cursor, table):
+    cursor.execute("SELECT indexname FROM pg_indexes WHERE schemaname = current_schema() AND tablename = %s", (table,))
+    return {row[0] for row in cursor.fetchall()}
+
+
+def add_legacy_post(cursor):
+    cursor.execute("INSERT INTO authors (url, username) VALUES ('https://example.social/@a', 'a') RETURNING id")
+    cursor.execute("INSERT INTO posts (id, content, post_url, tags, author_id) "
+                   "VALUES (gen_random_uuid(), 'hi', 'https://example.social/@a/1', '[]', %s) RETURNING id",
+                   (cursor.fetchone()[0],))
+    post_id = cursor.fetchone()[0]
+    cursor.execute("INSERT INTO attachments (post_id, url) VALUES (%s, 'https://example.social/1.jpg')", (post_id,))
+    return post_id
+
+
+def test_migrate_partitions_unpartitioned_tables(db):
+    cursor = db.cursor()
+    cursor.execute("DROP TABLE posts, attachments, post_ids CASCADE")
+    for statement in LEGACY_POSTS.split(";\n"):
+        cursor.execute(statement)
+    post_id = add_legacy_post(cursor)
+    db.commit()
+
+    partitions.migrate(db)
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = 'posts'::regclass")
+    assert cursor.fetchone()[0] == "p"
+    cursor.execute("SELECT p.id, a.post_id FROM posts p JOIN attachments a ON a.indexed_at = p.indexed_at")
+    assert cursor.fetchall() == [(post_id, post_id)]
+    cursor.execute("SELECT id FROM post_ids")
+    assert cursor.fetchall() == [(post_id,)]
+    assert "posts_author_id_idx" in indexes(cursor, "posts")
+    assert "post_id_idx" not in indexes(cursor, "posts")
+    db.commit()
+
+
+def test_migrate_updates_partitioned_tables(db):
+    cursor = db.cursor()
+    cursor.execute("DROP TABLE post_ids")
+    cursor.execute("CREATE INDEX post_id_idx ON posts(id)")
+    post_id = add_legacy_post(cursor)
+    db.commit()
+
+    partitions.migrate(db)
+    partitions.migrate(db)
+    cursor.execute("SELECT id FROM post_ids")
+    assert cursor.fetchall() == [(post_id,)]
+    assert "post_id_idx" not in indexes(cursor, "posts")
+    db.commit()
+
+
+@pytest.mark.parametrize("table", ["posts", "attachments", "post_tags"])
+def test_init_sql_makes_dated_partitions(db, table):
+    cursor = db.cursor()
+    names = dated_partitions(cursor, table)
+    assert len(names) == partitions.PARTITION_PREMAKE + 1
+    assert names[0] == partitions.partition_name(table, period_start(datetime.now(UTC), "week"))
+    db.commit()
@@ -0,0 +1,79 @@
+import asyncio
+import uuid
+from datetime import datetime, timezone
+
+import pytest
+from redis.asyncio import Redis as AsyncRedis
+
+from post_search import SearchCache, decode_cursor, encode_cursor, normalize_query
+from tests.conftest import TEST_REDIS_URL
+
+INDEXED_AT = datetime(2024, 8, 1, 12, 30, 15, 123456, tzinfo=timezone.utc)
+POST_ID = uuid.UUID("0f8fad5b-d9cb-469f-a165-70867728950e")
+
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(INDEXED_AT, POST_ID)) == (INDEXED_AT, POST_ID)
+
+
+def test_relevance_cursor_round_trip():
+    assert decode_cursor(encode_cursor(INDEXED_AT, POST_ID, 0.1234567)) == (INDEXED_AT, POST_ID, 0.1234567)
+
+
+def test_cursor_is_url_safe():
+    cursor = encode_cursor(INDEXED_AT, POST_ID, 0.5)
+    assert "=" not in cursor and "+" not in cursor and "/" not in cursor
+
+
+@pytest.mark.parametrize("cursor", ["", "not a cursor", "!!!", encode_cursor(INDEXED_AT, "not-a-uuid"),
+                                    "MjAyNC0wOC0wMVQxMjowMDowMA"])
+def test_invalid_cursor(cursor):
+    with pytest.raises(ValueError):
+        decode_cursor(cursor)
+
+
+def test_normalize_query():
+    assert normalize_query("  Cats   AND\tdogs ") == "cats and dogs"
+
+
+def run_with_cache(redis_url, test, **kwargs):
+    async def run():
+        client = AsyncRedis.from_url(redis_url)
+        try:
+            await test(client, SearchCache(client, **kwargs))
+        finally:
+            await client.aclose()
+    asyncio.run(run())
+
+
+def test_cache_pages_and_counts(redis):
+    async def test(client, cache):
+        assert await cache.get_page("cats", None, 0, "recent", False) is None
+        await cache.put_page("cats", None, 0, b'{"posts":[]}', "recent", False)
+        assert await cache.get_page("cats", None, 0, "recent", False) == b'{"posts":[]}'
+        # Anything else that shapes the page is part of the key
+        assert await cache.get_page("cats", None, 0, "relevance", False) is None
+
+        count = {"total_result_count": 12, "total_result_count_capped": False}
+        await cache.put_count("cats", count, False)
+        assert await cache.get_count("cats", False) == count
+
+    run_with_cache(TEST_REDIS_URL, test, ttl=30, count_ttl=300)
+
+
+def test_zero_counts_expire_with_the_pages(redis):
+    async def test(client, cache):
+        await cache.put_count("cats", {"total_result_count": 12, "total_result_count_capped": False})
+        await cache.put_count("no such thing", {"total_result_count": 0, "total_result_count_capped": False})
+        assert 30 < await client.ttl(cache._key("count", "cats")) <= 300
+        assert 0 < await client.ttl(cache._key("count", "no such thing")) <= 30
+
+    run_with_cache(TEST_REDIS_URL, test, ttl=30, count_ttl=300)
+
+
+def test_cache_without_redis():
+    async def test(client, cache):
+        await cache.put_page("cats", None, 0, b"{}")
+        assert await cache.get_page("cats", None, 0) is None
+
+    run_with_cache("redis://127.0.0.1:1/0?socket_connect_timeout=0.1", test)
@@ -0,0 +1,59 @@
+import asyncio
+import uuid
+
+import pytest
+
+import embeddings
+import semantic_search
+from semantic_search import QueryEmbeddingCache, fuse
+
+IDS = {name: uuid.UUID(int=i) for i, name in enumerate("abcde", 1)}
+
+
+def ranking(*names):
+    rows = ", ".join("('%s'::uuid, '2024-08-01'::timestamptz, %d)" % (IDS[name], rank) for rank, name in enumerate(names, 1))
+    return "SELECT * FROM (VALUES %s) AS ranking (id, indexed_at, rank)" % rows
+
+
+def fused(db, *rankings, limit=10):
+    cursor = db.cursor()
+    cursor.execute(fuse(*rankings), {"k": semantic_search.RRF_K, "limit": limit})
+    names = {post_id: name for name, post_id in IDS.items()}
+    return [(names[post_id], float(score)) for post_id, _, score in cursor.fetchall()]
+
+
+def test_fuse_by_reciprocal_rank(db):
+    k = semantic_search.RRF_K
+    results = fused(db, ranking("a", "b", "c"), ranking("c", "d"))
+    # c is in both; b and d tie and go by id
+    assert [name for name, _ in results] == ["c", "a", "b", "d"]
+    assert results[0][1] == pytest.approx(1 / (k + 3) + 1 / (k + 1))
+    assert results[2][1] == results[3][1] == pytest.approx(1 / (k + 2))
+    assert [name for name, _ in fused(db, ranking("a", "b", "c"), ranking("c", "d"), limit=2)] == ["c", "a"]
+
+
+def test_fuse_keeps_each_ranking_limit_to_itself(db):
+    # Unparenthesized, the second ranking's ORDER BY and LIMIT would cut the union down to one row
+    results = fused(db, ranking("a", "b"), ranking("e", "d", "c") + " ORDER BY rank LIMIT 1")
+    assert [name for name, _ in results] == ["a", "e", "b"]
+
+
+def test_query_embeddings_are_cached(unreachable, monkeypatch):
+    encoder = embeddings.HashEncoder(dimensions=8)
+    calls = []
+    monkeypatch.setattr(embeddings, "get_encoder", lambda: calls.append(1) or encoder)
+    cache = QueryEmbeddingCache(unreachable, max_size=2)
+
+    async def run():
+        vectors = [await cache.get(q) for q in ("coffee", "coffee", "tea", "cats", "coffee")]
+        return vectors
+
+    vectors = asyncio.run(run())
+    assert vectors[0] == vectors[1] == vectors[4] == encoder.encode("text", ["coffee"])[0]
+    # The second lookup was local, the last one after coffee had been evicted
+    assert len(calls) == 4
+    assert list(cache.local) == ["cats", "coffee"]
+
+
+def test_empty_query_searches_nothing():
+    assert asyncio.run(semantic_search.semantic_search(None, None, "   ")) == {"posts": [], "attachments": []}
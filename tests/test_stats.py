@@ -0,0 +1,105 @@
+import asyncio
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+from redis.asyncio import Redis as AsyncRedis
+
+import stats
+from stats import StatsSnapshot
+from tests.conftest import TEST_REDIS_URL
+
+
+def dataset(indexed_at, attachments=0):
+    return {"id": str(uuid.uuid4()), "indexedAt": indexed_at, "attachments": [{"url": "", "description": None}] * attachments}
+
+
+def run(test):
+    async def main():
+        client = AsyncRedis.from_url(TEST_REDIS_URL)
+        try:
+            return await test(client)
+        finally:
+            await client.aclose()
+    return asyncio.run(main())
+
+
+def test_indexed_timestamp():
+    indexed_at = datetime(2024, 8, 1, 12, 0, tzinfo=timezone.utc)
+    assert stats.indexed_timestamp(indexed_at) == indexed_at.timestamp()
+    assert stats.indexed_timestamp(indexed_at.isoformat()) == indexed_at.timestamp()
+    assert abs(stats.indexed_timestamp(None) - time.time()) < 5
+    assert stats.hour_bucket(indexed_at.timestamp() + 3599) == stats.hour_bucket(indexed_at.timestamp())
+
+
+def test_record_counts_only_inserted_posts(redis):
+    now = datetime.now(timezone.utc)
+    datasets = [dataset(now, attachments=2), dataset(now - timedelta(hours=2)), dataset(now, attachments=1)]
+    # The last one was a duplicate, and the first is in the batch twice
+    stats.record(redis, datasets + datasets[:1], [datasets[0]["id"], datasets[1]["id"]])
+
+    bucket = stats.hour_bucket(now.timestamp())
+    assert int(redis.get(stats.bucket_key("posts", bucket))) == 1
+    assert int(redis.get(stats.bucket_key("attachments", bucket))) == 2
+    assert int(redis.get(stats.bucket_key("posts", bucket - 2))) == 1
+    assert redis.get(stats.bucket_key("attachments", bucket - 2)) is None
+    assert 0 < redis.ttl(stats.bucket_key("posts", bucket)) <= (stats.WINDOW_HOURS + 1) * stats.BUCKET_SECONDS
+
+
+def test_window_totals_leave_out_older_hours(redis):
+    now = datetime.now(timezone.utc)
+    posts = [dataset(now), dataset(now - timedelta(hours=stats.WINDOW_HOURS - 1), attachments=3),
+             dataset(now - timedelta(hours=stats.WINDOW_HOURS + 1), attachments=1)]
+    stats.record(redis, posts, [post["id"] for post in posts])
+    assert run(stats.window_totals) == {"posts": 2, "attachments": 3}
+
+
+def test_snapshot_is_cached_for_its_ttl(redis):
+    now = datetime.now(timezone.utc)
+    first = dataset(now)
+    stats.record(redis, [first], [first["id"]])
+
+    async def test(client):
+        snapshot = StatsSnapshot(client, ttl=60)
+        before = await snapshot.get()
+        second = dataset(now)
+        stats.record(redis, [second], [second["id"]])
+        # Another worker answers from the shared cache too
+        return before, await snapshot.get(), await StatsSnapshot(client).get()
+
+    assert run(test) == ({"posts": 1, "attachments": 0},) * 3
+    assert 0 < redis.ttl(StatsSnapshot.CACHE_KEY) <= 60
+    assert not redis.exists(StatsSnapshot.LOCK_KEY)
+
+
+def test_snapshot_answers_stale_while_another_worker_refreshes(redis):
+    async def test(client):
+        snapshot = StatsSnapshot(client, ttl=60)
+        await snapshot.get()
+        await client.delete(StatsSnapshot.CACHE_KEY)
+        await client.set(StatsSnapshot.LOCK_KEY, 1)
+        post = dataset(datetime.now(timezone.utc))
+        stats.record(redis, [post], [post["id"]])
+        stale = await snapshot.get()
+
+        # A worker with nothing to fall back to waits for the refresh instead
+        fresh = StatsSnapshot(client)
+
+        async def refresh():
+            await asyncio.sleep(0.2)
+            await client.hset(StatsSnapshot.CACHE_KEY, mapping={"posts": 1, "attachments": 0})
+        _, waited = await asyncio.gather(refresh(), fresh.get())
+        return stale, waited
+
+    assert run(test) == ({"posts": 0, "attachments": 0}, {"posts": 1, "attachments": 0})
+
+
+def test_snapshot_without_redis():
+    async def test():
+        client = AsyncRedis.from_url("redis://127.0.0.1:1/0?socket_connect_timeout=0.1")
+        snapshot = StatsSnapshot(client)
+        totals = await snapshot.get()
+        await client.aclose()
+        return totals
+
+    assert asyncio.run(test()) == {"posts": 0, "attachments": 0}
@@ -0,0 +1,140 @@
+import json
+import threading
+
+import pytest
+import requests
+
+import streaming
+from streaming import Backoff, EventStreamListener, SupervisedListener, stream_timeline
+
+
+def update(n):
+    return json.dumps({"id": str(n), "url": "https://example.social/@a/%d" % n, "content": "<p>%d</p>" % n,
+                       "in_reply_to_id": None, "reblog": None, "tags": [{"name": "cats"}],
+                       "media_attachments": [{"type": "image", "url": "https://media.example.social/%d.jpg" % n,
+                                              "description": "a cat"}],
+                       "account": {"url": "https://example.social/@a", "username": "a"}})
+
+
+class FakeRaw:
+    def __init__(self, chunks):
+        self.chunks = list(chunks)
+
+    def read1(self, size, decode_content=True):
+        return self.chunks.pop(0) if self.chunks else b""
+
+
+class FakeResponse:
+    def __init__(self, chunks=(), status_code=200):
+        self.status_code = status_code
+        self.raw = FakeRaw(chunks)
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class RecordingListener(SupervisedListener):
+    def __init__(self):
+        super().__init__()
+        self.statuses = []
+        self.heartbeats = 0
+
+    def on_update(self, status):
+        self.statuses.append(status)
+
+    def handle_heartbeat(self):
+        super().handle_heartbeat()
+        self.heartbeats += 1
+
+
+def test_parses_updates_split_across_reads():
+    body = (":thump\n\nevent: delete\ndata: 123\n\nevent: update\r\ndata: %s\r\n\n"
+            "event: update\ndata: %s\n\n" % (update(1), update(2))).encode()
+    listener = RecordingListener()
+    # Split at every 7th byte, so lines and events straddle reads
+    listener.handle_stream(FakeResponse([body[i:i + 7] for i in range(0, len(body), 7)]))
+
+    assert [status.id for status in listener.statuses] == ["1", "2"]
+    assert listener.heartbeats == 1
+    status = listener.statuses[0]
+    assert status.account_url == "https://example.social/@a"
+    assert status.account_username == "a"
+    assert status.tags == ["cats"]
+    assert status.media_attachments[0].url == "https://media.example.social/1.jpg"
+    assert status.media_attachments[0].description == "a cat"
+    assert not status.reblog
+
+
+def test_skips_malformed_updates():
+    listener = RecordingListener()
+    listener.handle_stream(FakeResponse([b"event: update\ndata: {not json\n\nevent: update\ndata: %s\n\n"
+                                         % update(3).encode()]))
+    assert [status.id for status in listener.statuses] == ["3"]
+
+
+def test_on_abort_then_raises():
+    class FailingRaw:
+        def read1(self, size, decode_content=True):
+            raise requests.ConnectionError("reset")
+
+    aborted = []
+
+    class Listener(EventStreamListener):
+        def on_abort(self, err):
+            aborted.append(err)
+
+    response = FakeResponse()
+    response.raw = FailingRaw()
+    with pytest.raises(requests.ConnectionError):
+        Listener().handle_stream(response)
+    assert len(aborted) == 1
+
+
+def test_backoff_grows_with_jitter_and_resets():
+    backoff = Backoff(initial=1, maximum=8)
+    waits = [backoff.next() for _ in range(6)]
+    for wait, cap in zip(waits, (1, 2, 4, 8, 8, 8)):
+        assert cap / 2 <= wait <= cap
+    backoff.reset()
+    assert backoff.next() <= 1
+
+
+def test_reconnects_until_stopped(monkeypatch):
+    stop = threading.Event()
+    calls = []
+
+    def get(endpoint, **kwargs):
+        calls.append(endpoint)
+        if len(calls) == 1:
+            raise requests.ConnectionError("refused")
+        if len(calls) == 2:
+            return FakeResponse(status_code=503)
+        if len(calls) == 3:
+            return FakeResponse([b":thump\n\nevent: update\ndata: %s\n\n" % update(1).encode()])
+        stop.set()
+        return FakeResponse([b"event: update\ndata: %s\n\n" % update(2).encode()])
+
+    monkeypatch.setattr(streaming.requests, "get", get)
+    listeners = []
+
+    def make_listener():
+        listeners.append(RecordingListener())
+        return listeners[-1]
+
+    attempts = []
+
+    class RecordingBackoff(Backoff):
+        def next(self):
+            attempts.append(self.attempt)
+            return super().next()
+
+    backoff = RecordingBackoff(initial=0.001, maximum=0.01)
+    stream_timeline("test", "https://example.social/api/v1/streaming/public", make_listener, stop=stop,
+                    backoff=backoff)
+
+    assert len(calls) == 4
+    # A fresh listener per connection
+    assert [[status.id for status in listener.statuses] for listener in listeners] == [[], [], ["1"], ["2"]]
+    # Backing off further after each failure, until the healthy third connection reset it
+    assert attempts == [0, 1, 0]
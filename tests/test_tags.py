@@ -0,0 +1,119 @@
+import asyncio
+
+import psycopg
+import pytest
+from redis.asyncio import Redis as AsyncRedis
+
+import tags
+import tasks
+from author_cache import AuthorCache
+from benchmarks.common import make_datasets
+from post_search import decode_cursor
+from tests.conftest import TEST_DSN, TEST_REDIS_URL
+
+TAGS = [["Coffee", "#coffee", " #Morning "], ["##COFFEE", "#", ""], [], ["tea"]]
+
+
+def test_normalize_tag():
+    assert tags.normalize_tag(" #Coffee ") == "coffee"
+    assert tags.normalize_tag("##TeA") == "tea"
+    assert tags.normalize_tag("#") == ""
+
+
+def test_post_tags_are_distinct_and_normalized():
+    assert [tags.post_tags({"tags": post}) for post in TAGS] == [["coffee", "morning"], ["coffee"], [], ["tea"]]
+
+
+def datasets():
+    posts = make_datasets(len(TAGS), n_authors=2)
+    for dataset, post in zip(posts, TAGS):
+        dataset["tags"] = post
+    return posts
+
+
+def stored_tags(connection):
+    cursor = connection.cursor()
+    cursor.execute("SELECT tag, post_id::text FROM post_tags ORDER BY tag, post_id")
+    rows = cursor.fetchall()
+    connection.commit()
+    return rows
+
+
+@pytest.fixture
+def ingest(db, redis, monkeypatch):
+    monkeypatch.setattr(tasks, "ingest_filter", None)
+    monkeypatch.setattr(tasks, "author_cache", AuthorCache(redis))
+    return db
+
+
+@pytest.mark.parametrize("mode", ["row", "bulk"])
+def test_ingest_extracts_tags(ingest, mode):
+    posts = datasets()
+    (tasks.ingest_rows if mode == "row" else tasks.ingest_rows_bulk)(ingest, posts)
+    assert stored_tags(ingest) == sorted([("coffee", posts[0]["id"]), ("morning", posts[0]["id"]),
+                                          ("coffee", posts[1]["id"]), ("tea", posts[3]["id"])])
+
+
+def test_backfill_matches_ingest(ingest, redis):
+    tasks.ingest_rows_bulk(ingest, datasets())
+    extracted = stored_tags(ingest)
+    ingest.execute("TRUNCATE post_tags")
+    ingest.commit()
+
+    tags.backfill(redis, ingest)
+    assert stored_tags(ingest) == extracted
+    # Ties come in reverse tag order
+    assert asyncio.run(trending()) == [{"tag": "coffee", "count": 2}, {"tag": "tea", "count": 1},
+                                       {"tag": "morning", "count": 1}]
+
+
+async def trending(hours=24):
+    client = AsyncRedis.from_url(TEST_REDIS_URL)
+    try:
+        return await tags.trending(client, hours)
+    finally:
+        await client.aclose()
+
+
+def test_record_counts_inserted_posts(redis):
+    posts = datasets()
+    tags.record(redis, posts + posts[:1], [posts[0]["id"], posts[1]["id"]])
+    assert asyncio.run(trending()) == [{"tag": "coffee", "count": 2}, {"tag": "morning", "count": 1}]
+    # Cached for TRENDING_CACHE_TTL
+    tags.record(redis, posts, [posts[3]["id"]])
+    assert len(asyncio.run(trending())) == 2
+    assert len(asyncio.run(trending(hours=1))) == 3
+
+
+def test_trending_without_redis():
+    async def run():
+        client = AsyncRedis.from_url("redis://127.0.0.1:1/0?socket_connect_timeout=0.1")
+        try:
+            return await tags.trending(client)
+        finally:
+            await client.aclose()
+
+    assert asyncio.run(run()) == []
+
+
+def test_tag_pages(ingest):
+    posts = make_datasets(5, n_authors=2)
+    for dataset in posts:
+        dataset["tags"] = ["Coffee"]
+    tasks.ingest_rows_bulk(ingest, posts)
+
+    async def pages():
+        async with await psycopg.AsyncConnection.connect(TEST_DSN) as connection:
+            seen, after = [], None
+            while True:
+                page, next_cursor = await tags.tag_posts(connection.cursor(), "#COFFEE", after=after, limit=2)
+                seen.append([post["id"] for post in page])
+                if next_cursor is None:
+                    return seen
+                after = decode_cursor(next_cursor)
+
+    newest_first = [str(dataset["id"]) for dataset in sorted(posts, key=lambda dataset: (dataset["indexedAt"], dataset["id"]),
+                                                              reverse=True)]
+    seen = asyncio.run(pages())
+    assert [len(page) for page in seen] == [2, 2, 1]
+    assert sum(seen, []) == newest_first
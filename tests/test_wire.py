@@ -0,0 +1,73 @@
+import uuid
+from datetime import datetime, timezone
+
+from kombu.serialization import dumps, loads
+
+import wire
+
+
+def make_dataset(n, **overrides):
+    dataset = {
+        "id": str(uuid.UUID(int=n)),
+        "content": "<p>post %d &amp; more</p><p>second<br>line</p>" % n,
+        "postURL": "https://example.social/@user/%d" % n,
+        "tags": ["fediverse"],
+        "author": {"url": "https://example.social/@user", "username": "user"},
+        "attachments": [{"url": "https://media.example.social/%d.jpg" % n, "description": "a cat"}],
+    }
+    dataset.update(overrides)
+    return dataset
+
+
+def test_batch_round_trip():
+    indexed_at = datetime(2024, 8, 1, 12, 0, tzinfo=timezone.utc)
+    datasets = [make_dataset(1, indexedAt=indexed_at), make_dataset(2, attachments=[])]
+
+    unpacked = wire.unpack_batch(wire.loads(wire.dumps(wire.pack_batch(datasets))))
+
+    assert [dataset["id"] for dataset in unpacked] == [dataset["id"] for dataset in datasets]
+    assert unpacked[0]["content"] == "post 1 & more\n\nsecond\nline"
+    assert unpacked[0]["stripped"]
+    assert unpacked[0]["indexedAt"] == indexed_at
+    assert "indexedAt" not in unpacked[1]
+    for original, dataset in zip(datasets, unpacked):
+        assert dataset["attachments"] == original["attachments"]
+        assert dataset["author"] == original["author"]
+        assert dataset["postURL"] == original["postURL"]
+        assert dataset["tags"] == original["tags"]
+
+
+def test_large_bodies_are_compressed():
+    small = wire.dumps({"a": 1})
+    large = wire.dumps({"a": "x" * (wire.COMPRESS_THRESHOLD * 2)})
+    assert small[1] & wire.FLAG_ZLIB == 0
+    assert large[1] & wire.FLAG_ZLIB
+    assert wire.loads(large) == {"a": "x" * (wire.COMPRESS_THRESHOLD * 2)}
+
+
+def test_naive_datetimes_stay_naive():
+    naive = datetime(2024, 8, 1, 12, 0, 0, 250000)
+    assert wire.loads(wire.dumps([naive])) == [naive]
+
+
+def test_old_messages_pass_through():
+    datasets = [make_dataset(1)]
+    assert wire.unpack_batch(datasets) is datasets
+
+
+def test_unknown_version_is_rejected():
+    data = wire.dumps({"v": wire.VERSION, "posts": []})
+    try:
+        wire.loads(bytes((wire.VERSION + 1,)) + data[1:])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError("loads accepted an unknown version")
+
+
+def test_registered_as_celery_serializer():
+    batch = wire.pack_batch([make_dataset(1)])
+    content_type, content_encoding, body = dumps(((batch,), {}, {}), serializer=wire.SERIALIZER)
+    assert content_type == wire.CONTENT_TYPE
+    (received,), _, _ = loads(body, content_type, content_encoding)
+    assert wire.unpack_batch(received)[0]["id"] == make_dataset(1)["id"]
@@ -0,0 +1,107 @@
+"""Broker wire format for ingest batches.
+
+Batches are packed into positional rows with the HTML already stripped (pack_batch), and every
+message body is msgpack-encoded behind a two byte header - format version and flags - and zlib
+compressed once it is larger than COMPRESS_THRESHOLD bytes.
+"""
+import struct
+import uuid
+import zlib
+from datetime import datetime, timezone
+
+import msgpack
+from kombu.serialization import register
+
+from html_text import strip_tags
+
+SERIALIZER = "fedibgs"
+CONTENT_TYPE = "application/x-fedibgs"
+VERSION = 1
+COMPRESS_THRESHOLD = 1024
+
+FLAG_ZLIB = 0x01
+EXT_DATETIME = 1
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        # 8 bytes for naive (local) datetimes, a 9th marks an aware one
+        if obj.tzinfo is None:
+            return msgpack.ExtType(EXT_DATETIME, struct.pack(">d", obj.timestamp()))
+        return msgpack.ExtType(EXT_DATETIME, struct.pack(">dB", obj.timestamp(), 1))
+    if isinstance(obj, uuid.UUID):
+        return str(obj)
+    raise TypeError("Cannot serialize %r" % type(obj))
+
+
+def _ext_hook(code, data):
+    if code == EXT_DATETIME:
+        timestamp = struct.unpack(">d", data[:8])[0]
+        if len(data) > 8:
+            return datetime.fromtimestamp(timestamp, timezone.utc)
+        return datetime.fromtimestamp(timestamp)
+    return msgpack.ExtType(code, data)
+
+
+def dumps(obj):
+    body = msgpack.packb(obj, default=_default, use_bin_type=True)
+    flags = 0
+    if len(body) > COMPRESS_THRESHOLD:
+        body = zlib.compress(body, 1)
+        flags |= FLAG_ZLIB
+    return bytes((VERSION, flags)) + body
+
+
+def loads(data):
+    if isinstance(data, str):
+        data = data.encode("latin-1")
+    if data[0] != VERSION:
+        raise ValueError("Unsupported wire format version %d" % data[0])
+    body = data[2:]
+    if data[1] & FLAG_ZLIB:
+        body = zlib.decompress(body)
+    return msgpack.unpackb(body, ext_hook=_ext_hook, raw=False, strict_map_key=False)
+
+
+register(SERIALIZER, dumps, loads, content_type=CONTENT_TYPE, content_encoding="binary")
+
+
+def pack_batch(datasets):
+    """Scraper posts -> compact rows: stripped text, binary UUIDs, no repeated keys."""
+    rows = []
+    for dataset in datasets:
+        rows.append([
+            uuid.UUID(dataset["id"]).bytes,
+            strip_tags(dataset["content"], breaks=True),
+            dataset["postURL"],
+            dataset["tags"],
+            dataset["author"]["url"],
+            dataset["author"]["username"],
+            dataset.get("indexedAt"),
+            [[attachment["url"], attachment["description"]] for attachment in dataset["attachments"]],
+        ])
+    return {"v": VERSION, "posts": rows}
+
+
+def unpack_batch(batch):
+    """Inverse of pack_batch. Lists of post dicts (messages from older scrapers) are passed through."""
+    if not isinstance(batch, dict):
+        return batch
+    if batch.get("v") != VERSION:
+        raise ValueError("Unsupported batch version %s" % batch.get("v"))
+
+    datasets = []
+    for post_id, text, post_url, tags, author_url, username, indexed_at, attachments in batch["posts"]:
+        dataset = {
+            "id": str(uuid.UUID(bytes=post_id)),
+            "content": text,
+            "stripped": True,
+            "attachments": [{"url": url, "description": description} for url, description in attachments],
+            "postURL": post_url,
+            "tags": tags,
+            "author": {"url": author_url, "username": username},
+        }
+        if indexed_at is not None:
+            dataset["indexedAt"] = indexed_at
+        datasets.append(dataset)
+    return datasets